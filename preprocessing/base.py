@@ -1,17 +1,619 @@
 import os.path
+import shutil
 from abc import ABCMeta, abstractmethod
-from os import sep, makedirs, walk
-from os.path import exists, basename, isdir
+from os import makedirs, walk
+from os.path import exists, basename, isdir, abspath
+from hashlib import blake2b
 import tarfile
-from json import load, loads
+import gzip
+import io
+import codecs
+import re
+from json import loads, JSONDecoder, JSONDecodeError, JSONEncoder
 import zstandard as zstd
-import pathlib
 import zipfile
+import multiprocessing
+from itertools import islice
+from collections import deque
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import fakeredis
 import pandas as pd
+from tqdm import tqdm
 from preprocessing.datasource.redis import RedisDataSource
+from preprocessing.datasource.bloom import BloomFilterDataSource
+from preprocessing.datasource.prefetch import PrefetchDataSource
+from preprocessing.cache import ValidationCache, ValidationStore
+from preprocessing.index.bloom import BloomFilter
+from preprocessing.index.citing import CitingIdIndex, CitingIdIndexWriter, build_id_run
 from oc_meta.lib.csvmanager import CSVManager
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson converts the integers which do not fit in 64 bits into floats, thus the documents containing
+# long sequences of digits are always decoded with the standard library
+_long_number_bytes = re.compile(rb"\d{19}")
+_long_number_str = re.compile(r"\d{19}")
+# encoders reused across calls, with the same settings of the defaults of json.dumps
+_json_encoder = JSONEncoder()
+_json_encoder_no_ascii = JSONEncoder(ensure_ascii=False)
+
+
+def json_loads(data):
+    """This function decodes a json document, given either as a string or as utf-8 encoded bytes,
+    so that lines read from binary streams do not need to be decoded first. If orjson is installed,
+    it is used as a faster parser, falling back on the standard library for the documents it rejects
+    (e.g.: NaN values) or would decode differently (i.e.: integers which do not fit in 64 bits)."""
+    if orjson is not None:
+        long_number = _long_number_bytes if isinstance(data, (bytes, bytearray)) else _long_number_str
+        if not long_number.search(data):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+    return loads(data)
+
+
+def json_dumps(obj, ensure_ascii=True):
+    """This function encodes an object as a json string which is identical to the output of json.dumps
+    with the same ensure_ascii value. The encoders are created once and reused, instead of being
+    created at each call. Note that orjson is not used for encoding, since it does not allow to
+    reproduce the separators and the escaping of non-ascii characters of the standard library."""
+    if ensure_ascii:
+        return _json_encoder.encode(obj)
+    return _json_encoder_no_ascii.encode(obj)
+
+
+def iter_json_items(file, key, read_size=2 ** 20):
+    """This function parses incrementally a json file containing a single object, and yields one
+    by one the elements of the array stored as the value of the key in input (e.g.: 'items'), so
+    that the whole file is never loaded in memory at once. The file object in input is read in
+    chunks of read_size bytes. The values of the other keys of the object are parsed and discarded."""
+    decoder = JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    state = {"buf": "", "pos": 0, "eof": False}
+
+    def read_more():
+        # drop the part of the buffer which was already parsed and, in the case of values bigger
+        # than the chunk size, read at least as much data as it is already in the buffer
+        buf = state["buf"][state["pos"]:]
+        chunk = file.read(max(read_size, len(buf)))
+        state["eof"] = not chunk
+        state["buf"] = buf + text_decoder.decode(chunk, final=state["eof"])
+        state["pos"] = 0
+
+    def next_char():
+        while True:
+            buf, pos = state["buf"], state["pos"]
+            while pos < len(buf) and buf[pos] in " \t\n\r":
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if state["eof"]:
+                return None
+            read_more()
+
+    def expect(chars):
+        char = next_char()
+        if char is None or char not in chars:
+            raise ValueError("Unexpected character %r while parsing the json file" % char)
+        state["pos"] += 1
+        return char
+
+    def next_value():
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state["buf"], state["pos"])
+                # a number at the end of the buffer could continue in the next chunk
+                if state["eof"] or (end < len(state["buf"]) and state["buf"][end] in " \t\n\r,]}"):
+                    state["pos"] = end
+                    return value
+            except JSONDecodeError:
+                if state["eof"]:
+                    raise
+            read_more()
+
+    expect("{")
+    if next_char() == "}":
+        return
+    while True:
+        cur_key = next_value()
+        expect(":")
+        if cur_key == key and next_char() == "[":
+            expect("[")
+            if next_char() == "]":
+                expect("]")
+            else:
+                while True:
+                    yield next_value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            next_value()
+        if expect(",}") == "}":
+            break
+
+
+# the preprocessor and the record source used by a worker process, see Preprocessing.iter_processed
+_worker_state = dict()
+
+
+def _init_worker(preprocessor, source, method):
+    _worker_state["preprocessor"] = preprocessor
+    _worker_state["source"] = source
+    _worker_state["method"] = method
+    preprocessor.init_worker()
+
+
+def _process_task(task):
+    preprocessor = _worker_state["preprocessor"]
+    method = _worker_state["method"]
+    process = getattr(preprocessor, method)
+    name, content = task
+    records = _worker_state["source"].read_task(name, content)
+    if method in preprocessor._prefetch_methods:
+        records = preprocessor.prefetched(records)
+    results = [process(record) for record in records]
+    preprocessor.flush_validation_store()
+    preprocessor.flush_spooled_ids()
+    return results
+
+
+def _process_task_records(task):
+    process = getattr(_worker_state["preprocessor"], _worker_state["method"])
+    name, content = task
+    return process(_worker_state["source"].read_task(name, content))
+
+
+def _ordered_map(executor, fn, tasks, max_pending, group_of=None, max_groups=None):
+    # like executor.map, but the tasks are submitted only when less than max_pending of them are waiting,
+    # so that the input is not read in memory all at once. If max_groups is specified, the waiting tasks
+    # belong to at most max_groups distinct groups, as returned by group_of (e.g.: the files they read)
+    pending = deque()
+    for task in tasks:
+        group = group_of(task) if max_groups else None
+        while max_groups and pending and group not in {g for g, future in pending} and \
+                len({g for g, future in pending}) >= max_groups:
+            yield pending.popleft()[1].result()
+        pending.append((group, executor.submit(fn, task)))
+        if len(pending) >= max_pending:
+            yield pending.popleft()[1].result()
+    while pending:
+        yield pending.popleft()[1].result()
+
+
+class _FileRange(io.RawIOBase):
+    # a read-only file object exposing the bytes from start to end of the file object in input
+    def __init__(self, f, start, end):
+        super(_FileRange, self).__init__()
+        f.seek(start)
+        self._f = f
+        self._left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._f.read(min(len(b), self._left))
+        b[:len(data)] = data
+        self._left -= len(data)
+        return len(data)
+
+
+class RecordSource(object):
+    """This class provides a single entry point for reading the records of a dump, whatever the container
+    they are stored in. The input can be a directory, a tar archive (compressed with gzip or not), a zip
+    archive (possibly containing other zip archives, if nested is True), or a single gz or zst compressed
+    file. The files of the required format are read lazily, one at a time, without extracting them on
+    disk, and the gz and zst compressed files are decompressed on the fly (e.g.: a 'dump.ndjson.zst' file
+    is read as a '.ndjson' file). The records of each file are decoded according to the record type:
+    - 'file': the file object itself;
+    - 'json': the whole json file, as a single record;
+    - 'json_items': the elements of the array stored at the json_key of a json file, parsed one at a time
+    if stream_items is True;
+    - 'ndjson': the json objects stored in the non-empty lines of the file (the malformed lines are reported and
+    skipped if skip_invalid is True);
+    - 'lines': the lines of the file, as bytes;
+    - 'csv': the rows of a csv file as dictionaries, read by pandas in chunks (see csv_params).
+    Iterating over a RecordSource yields all the records of all the files, in the order in which the files
+    are stored in the container."""
+    _record_types = {"file", "json", "json_items", "ndjson", "lines", "csv"}
+    _compressed_types = (".gz", ".zst")
+
+    def __init__(self, path, req_type, record_type="file", json_key=None, stream_items=False, csv_params=None,
+                 nested=False, shard_size=None, batch_size=None, read_size=2 ** 24, json_read_size=2 ** 20,
+                 skip_invalid=False):
+        if record_type not in self._record_types:
+            raise ValueError("Unknown record type: %s" % record_type)
+        self.path = path
+        self.req_type = req_type
+        self.record_type = record_type
+        self.json_key = json_key
+        self.stream_items = stream_items
+        self.csv_params = csv_params if csv_params else dict()
+        # if True, the zip archives found in the input are opened in memory and read as well
+        self.nested = nested and req_type != ".zip"
+        # if specified, the files of lines are split in tasks of about shard_size bytes (see iter_tasks)
+        self.shard_size = shard_size if record_type in {"ndjson", "lines"} else None
+        # if specified, the files are read in memory and sent in tasks of batch_size files (see iter_tasks)
+        self.batch_size = batch_size
+        self.read_size = read_size
+        self.json_read_size = json_read_size
+        # if True, the lines of an ndjson file which are not valid json are reported and skipped
+        self.skip_invalid = skip_invalid
+
+    def __iter__(self):
+        for name, f in self.iter_files():
+            yield from self.read_records(name, f)
+
+    def fingerprint(self, *params):
+        """This method returns a digest identifying the input of the source, computed from the absolute path, the
+        size and the modification time of each of its files (the directories are walked recursively), together
+        with the settings of the source which determine its records and the additional parameters in input. The
+        content of the files is not read, so that the fingerprint of a large dump is computed in a few seconds."""
+        digest = blake2b(digest_size=16)
+        for value in (self.req_type, self.record_type, self.json_key, self.nested) + params:
+            digest.update(repr(value).encode("utf-8") + b"\0")
+        if isdir(self.path):
+            paths = sorted(os.path.join(cur_dir, cur_file) for cur_dir, cur_subdir, cur_files in walk(self.path)
+                           for cur_file in cur_files)
+        else:
+            paths = [self.path]
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(("%s\0%d\0%d\n" % (abspath(path), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def iter_records(self):
+        """This method yields (filename, record) pairs for all the records of the input."""
+        for name, f in self.iter_files():
+            for record in self.read_records(name, f):
+                yield name, record
+
+    def _is_hidden(self, name):
+        return basename(name).startswith(".")
+
+    def _compression(self, name):
+        for compr_type in self._compressed_types:
+            if name.endswith(compr_type) and not name.endswith(".tar" + compr_type):
+                return compr_type
+        return None
+
+    def _is_required(self, name):
+        if self._is_hidden(name):
+            return False
+        if name.endswith(self.req_type):
+            return True
+        compr_type = self._compression(name)
+        return compr_type is not None and name[:-len(compr_type)].endswith(self.req_type)
+
+    def _is_nested_zip(self, name):
+        return self.nested and name.endswith(".zip") and not self._is_hidden(name)
+
+    def decompress(self, name, f):
+        """This method returns a file object which decompresses on the fly the content of the gz or zst
+        compressed file object in input, by using buffers of read_size bytes. Any other file object is
+        returned as it is."""
+        compr_type = self._compression(name)
+        if compr_type == ".gz":
+            return io.BufferedReader(gzip.GzipFile(fileobj=f, mode="rb"), buffer_size=self.read_size)
+        if compr_type == ".zst":
+            reader = zstd.ZstdDecompressor().stream_reader(f, read_size=self.read_size)
+            return io.BufferedReader(reader, buffer_size=self.read_size)
+        return f
+
+    def _open_member(self, name, f):
+        # the compressed files which are not explicitly required are read as the files they contain
+        if name.endswith(self.req_type):
+            yield name, f
+        else:
+            yield name[:-len(self._compression(name))], self.decompress(name, f)
+
+    def iter_files(self):
+        """This method yields (filename, file object) pairs for all the files of the required format of the
+        input, with the file objects opened in binary mode. The filename is the full path of the file on disk
+        or the name of the member of the archive, without the extension of the compression if the file is
+        decompressed (e.g.: 'dump/sample.ndjson' for 'dump/sample.ndjson.zst'). In the case of a tar archive, the members are
+        read in a single sequential pass over the (possibly compressed) stream, so that the archive is
+        decompressed exactly once and the first file is available as soon as it is reached. The members
+        of a zip archive are opened directly from the archive. Note that each file object is only valid
+        until the next pair is requested."""
+        path = self.path
+        if hasattr(path, "read"):
+            yield from self.iter_zip_members(path)
+        elif isdir(path):
+            for cur_dir, cur_subdir, cur_files in walk(path):
+                for cur_file in cur_files:
+                    cur_path = os.path.join(cur_dir, cur_file)
+                    if self._is_required(cur_file):
+                        with open(cur_path, "rb") as f:
+                            yield from self._open_member(cur_path, f)
+                    elif self._is_nested_zip(cur_file):
+                        yield from self.iter_zip_members(cur_path)
+        elif path.endswith("tar.gz") or path.endswith(".tar"):
+            mode = "r|gz" if path.endswith("tar.gz") else "r|"
+            with tarfile.open(path, mode, encoding="utf-8") as tar_fd:
+                for cur_file in tar_fd:
+                    if cur_file.isfile() and self._is_required(cur_file.name):
+                        yield from self._open_member(cur_file.name, tar_fd.extractfile(cur_file))
+        elif path.endswith("zip"):
+            yield from self.iter_zip_members(path)
+        elif self._compression(path) and self._is_required(path):
+            with open(path, "rb") as f:
+                yield from self._open_member(path, f)
+        elif self._is_required(path) and exists(path):
+            with open(path, "rb") as f:
+                yield path, f
+        else:
+            print("It is not possible to process the input path.", path)
+
+    def iter_zip_members(self, zip_file):
+        """This method yields (member name, file object) pairs for all the members of the required
+        format of a zip archive, which can be specified either as a filepath or as a file object (e.g.:
+        an io.BytesIO containing a zip archive nested in another one). The members are opened directly
+        from the archive, without extracting them on disk. In nested mode, the zip archives contained in
+        the archive are read in memory and their members are yielded as well."""
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            for cur_file in zip_ref.infolist():
+                if cur_file.is_dir():
+                    continue
+                if self._is_required(cur_file.filename):
+                    with zip_ref.open(cur_file) as f:
+                        yield from self._open_member(cur_file.filename, f)
+                elif self._is_nested_zip(cur_file.filename):
+                    # the nested archives are small enough to be read in memory
+                    yield from self.iter_zip_members(io.BytesIO(zip_ref.read(cur_file)))
+
+    def iter_tasks(self):
+        """This method yields (filename, content) pairs for all the files of the required format of the
+        input, meant to be sent to other processes and read with read_task: the content is the path
+        of the file, if it is stored on disk, the (path, start, end) byte range of the file, if it is a
+        member of a plain tar archive, or the bytes of the file, if it is a member of a tar.gz or zip
+        archive. Thus, only the members of the tar.gz and zip archives are read in memory, as a whole, by
+        the current process, and the other files are read as streams by the process running the task.
+        In nested mode, the zip archives found in the input are yielded as a whole, instead of their
+        members. The compressed files are not decompressed.
+        If a shard_size is specified for a source of lines, each file is split in tasks of about
+        shard_size bytes, so that even a single huge file can be processed by many processes: the
+        files on disk are split in (path, start, end) byte ranges aligned to the start of the lines,
+        while the other ones are decompressed and yielded as blocks of complete lines.
+        If a batch_size is specified instead, the files are read in memory as they are returned by
+        iter_files (i.e.: with the members of the nested zip archives read one by one) and yielded in
+        lists of batch_size (filename, bytes) pairs, which is convenient for many small files."""
+        if self.batch_size:
+            yield from self._iter_batch_tasks()
+            return
+        path = self.path
+        if isdir(path):
+            for cur_dir, cur_subdir, cur_files in walk(path):
+                for cur_file in cur_files:
+                    if self._is_required(cur_file) or self._is_nested_zip(cur_file):
+                        cur_path = os.path.join(cur_dir, cur_file)
+                        yield from self._iter_file_tasks(cur_path)
+        elif path.endswith(".tar") and self.shard_size is None:
+            # only the headers of the members are read, in order to find the byte range of each member
+            with tarfile.open(path, "r:", encoding="utf-8") as tar_fd:
+                for cur_file in tar_fd:
+                    if cur_file.isfile() and self._is_required(cur_file.name):
+                        yield cur_file.name, (path, cur_file.offset_data, cur_file.offset_data + cur_file.size)
+        elif path.endswith("tar.gz") or path.endswith(".tar"):
+            mode = "r|gz" if path.endswith("tar.gz") else "r|"
+            with tarfile.open(path, mode, encoding="utf-8") as tar_fd:
+                for cur_file in tar_fd:
+                    if cur_file.isfile() and self._is_required(cur_file.name):
+                        yield from self._iter_member_tasks(cur_file.name, tar_fd.extractfile(cur_file))
+        elif path.endswith("zip"):
+            with zipfile.ZipFile(path, "r") as zip_ref:
+                for cur_file in zip_ref.infolist():
+                    if not cur_file.is_dir() and (self._is_required(cur_file.filename) or self._is_nested_zip(cur_file.filename)):
+                        with zip_ref.open(cur_file) as f:
+                            yield from self._iter_member_tasks(cur_file.filename, f)
+        elif self._is_required(path) and exists(path):
+            yield from self._iter_file_tasks(path)
+        else:
+            print("It is not possible to process the input path.", path)
+
+    def _iter_batch_tasks(self):
+        batch = []
+        for name, f in self.iter_files():
+            batch.append((name, f.read()))
+            if len(batch) == self.batch_size:
+                yield batch[0][0], batch
+                batch = []
+        if batch:
+            yield batch[0][0], batch
+
+    def _iter_file_tasks(self, path):
+        if self.shard_size is None or self._is_nested_zip(path):
+            yield path, path
+        elif self._compression(path):
+            with open(path, "rb") as f:
+                yield from self._iter_member_tasks(path, f)
+        else:
+            size = os.path.getsize(path)
+            with open(path, "rb") as f:
+                start = 0
+                while start < size:
+                    # the end of the range is moved to the start of the next line
+                    f.seek(start + self.shard_size)
+                    f.readline()
+                    end = min(f.tell(), size)
+                    yield path, (path, start, end)
+                    start = end
+
+    def _iter_member_tasks(self, name, f):
+        if self.shard_size is None or self._is_nested_zip(name):
+            yield name, f.read()
+            return
+        compr_type = self._compression(name)
+        if compr_type:
+            f = self.decompress(name, f)
+            name = name[:-len(compr_type)]
+        while True:
+            block = f.read(self.shard_size)
+            if not block:
+                break
+            yield name, block + f.readline()
+
+    def task_file(self, name, content):
+        """This method returns the path of the file on disk read by a task returned by iter_tasks, or
+        None if the content of the task is stored in memory."""
+        if isinstance(content, str):
+            return content
+        if isinstance(content, tuple):
+            return content[0]
+        return None
+
+    def read_task(self, name, content):
+        """This method yields the records of a task returned by iter_tasks. The byte ranges of the files
+        on disk are read as streams, by using buffers of read_size bytes."""
+        if isinstance(content, str):
+            with open(content, "rb") as f:
+                yield from self.read_records(name, f)
+        elif isinstance(content, tuple):
+            path, start, end = content
+            with open(path, "rb") as f:
+                yield from self.read_records(name, io.BufferedReader(_FileRange(f, start, end), buffer_size=self.read_size))
+        elif isinstance(content, list):
+            for file_name, data in content:
+                yield from self.read_records(file_name, io.BytesIO(data))
+        else:
+            yield from self.read_records(name, io.BytesIO(content))
+
+    def read_records(self, name, f):
+        """This method yields the records stored in the file object in input, according to the record type
+        of the source. The gz and zst compressed files are decompressed while they are read and, in nested
+        mode, the records of all the members of a zip archive are yielded."""
+        if self._is_nested_zip(name) and not self._is_required(name):
+            for member_name, member in self.iter_zip_members(f):
+                yield from self.read_records(member_name, member)
+            return
+        if self.record_type == "file":
+            yield f
+            return
+        if self._compression(name):
+            f = self.decompress(name, f)
+        if self.record_type == "json":
+            yield json_loads(f.read())
+        elif self.record_type == "json_items":
+            if self.stream_items:
+                yield from iter_json_items(f, self.json_key, self.json_read_size)
+            else:
+                yield from json_loads(f.read()).get(self.json_key, [])
+        elif self.record_type == "ndjson":
+            for line in f:
+                if line.strip():
+                    try:
+                        record = json_loads(line)
+                    except ValueError:
+                        if not self.skip_invalid:
+                            raise
+                        print(ValueError, line)
+                        continue
+                    yield record
+        elif self.record_type == "lines":
+            yield from f
+        elif self.record_type == "csv":
+            with pd.read_csv(f, **self.csv_params) as reader:
+                for chunk in reader:
+                    chunk.fillna("", inplace=True)
+                    yield from chunk.to_dict("records")
+
+
+class _TokenBucket(object):
+    """Token bucket allowing rate calls per second on average, and bursts of at most capacity calls."""
+
+    def __init__(self, rate, capacity=None):
+        self._rate = rate
+        self._capacity = capacity or max(1, rate)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class ValidationExecutor(object):
+    """This class validates groups of ids through the APIs of their id managers concurrently, by means of a
+    pool of max_workers threads. The calls to the API of each service (i.e. the schema of the ids, e.g.: 'doi')
+    are limited by the pair (concurrency, rate) of the service in limits, or by default_limit if the service is
+    not in limits: at most concurrency calls are made at the same time, and at most rate calls per second on
+    average (see _TokenBucket). The threads are started at the first call in each process, so that the
+    executor can be used by the worker processes forked from the current one. Since the forked processes would
+    inherit the locks held by the running threads, the threads must be stopped before forking (see shutdown)."""
+
+    def __init__(self, max_workers=8, limits=None, default_limit=(4, 10)):
+        self._max_workers = max_workers
+        self._limits = limits or dict()
+        self._default_limit = default_limit
+        self._pool = None
+        self._pid = None
+        self._services = dict()
+
+    def _service(self, service):
+        # the semaphore and the token bucket of each service are created at its first call, before submitting the
+        # calls to the pool (see map), so that the threads calling the same service share them
+        if service not in self._services:
+            concurrency, rate = self._limits.get(service, self._default_limit)
+            self._services[service] = threading.BoundedSemaphore(concurrency), _TokenBucket(rate)
+        return self._services[service]
+
+    def _call(self, service, fn, *args):
+        semaphore, bucket = self._service(service)
+        with semaphore:
+            bucket.acquire()
+            return fn(*args)
+
+    def map(self, service_of, fn, items):
+        """This method returns the list of the results of fn called with each one of the items in input, in the
+        same order of the items. The service of each call is given by the function service_of."""
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self._max_workers)
+            self._pid = os.getpid()
+            self._services = dict()
+        services = [service_of(item) for item in items]
+        for service in set(services):
+            self._service(service)
+        futures = [self._pool.submit(self._call, service, fn, item) for service, item in zip(services, items)]
+        return [future.result() for future in futures]
+
+    def validate(self, ids):
+        """This method takes in input a list of pairs containing a normalised id (with prefix) and its id manager,
+        and returns the list of the results of their validation through the APIs, in the same order."""
+        return self.map(lambda pair: pair[0].split(":")[0], lambda pair: bool(pair[1].is_valid(pair[0])), ids)
+
+    def shutdown(self):
+        """This method stops the threads started by the current process, which are started again at the next call."""
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+        self._pid = None
+
+
+class _DeferredCitingIdIndex(object):
+    """This class replaces the citing id index while the input dump is processed in a single pass (see
+    Preprocessing.iter_single_pass): since the citing ids are not known yet, all the ids looked up in it are
+    accepted, and they are validated again in the fix-up phase."""
+
+    def get_value(self, id_string):
+        return True
+
 
 class Preprocessing(metaclass=ABCMeta):
     """This is the interface for implementing preprocessors for specific datasources.
@@ -21,97 +623,580 @@ class Preprocessing(metaclass=ABCMeta):
     RA_redis_test = fakeredis.FakeStrictRedis()
     RA_redis = RedisDataSource("DB-META-RA")
     csv_man = CSVManager()
+    # size in bytes of the buffers used when reading compressed streams
+    _read_size = 2 ** 24
+    # size in bytes of the chunks read when parsing json files incrementally
+    _json_read_size = 2 ** 20
+    # number of processes used for processing the input files, see iter_processed
+    _workers = 1
+    # maximum number of input files waiting to be processed by each worker process
+    _tasks_per_worker = 2
+    # false positive rate of the Bloom filter stored with the citing map (None for no filter), see build_citing_map
+    _bloom_error_rate = None
+    # if True, the citing map is built even if the one in the citing map directory matches the input, see load_citing_map
+    _rebuild_citing_map = False
+    # if True, the citing map is built while processing the input dump, see iter_single_pass
+    _single_pass = False
+    # if True, the ids which must be validated through the APIs are accepted provisionally while processing the input
+    # dump, and validated all at once after it, see iter_deferred_validation
+    _deferred_validation = False
+    # number of distinct ids spooled in deferred validation mode which are validated at once, see validate_spooled_ids
+    _deferred_batch_size = 10000
+    # size in bytes of the parts of the spill file of the single pass mode processed by each worker, see iter_single_pass
+    _spill_shard_size = 2 ** 26
+    # number of records whose ids are retrieved from redis at once, see prefetched
+    _prefetch_size = 100
+    # the methods processing the records of the input dump, whose ids are retrieved from redis in advance
+    _prefetch_methods = {"process_record", "process_record_deferred"}
+    # maximum numbers of valid and invalid ids whose validation results are kept in memory, see validate_id
+    _positive_cache_size = 2 ** 20
+    _negative_cache_size = 2 ** 18
+    # path of the sqlite database storing the results of the validations through the APIs across runs (None
+    # for no database), and time to live in seconds of the results of each schema, see validate_id
+    _validation_store_path = None
+    _validation_ttl = {"doi": 90 * 24 * 3600, "orcid": 90 * 24 * 3600}
+    _validation_default_ttl = 30 * 24 * 3600
+    # number of threads validating the ids through the APIs at the same time (1 for validating them one at a time),
+    # and maximum number of concurrent calls and of calls per second to the API of each schema: the schemas which
+    # are not listed are limited by the default_limit of ValidationExecutor, i.e. 4 concurrent calls and 10 calls
+    # per second
+    _api_workers = 1
+    _api_limits = {"doi": (8, 50), "orcid": (4, 20), "pmid": (2, 3), "pmcid": (2, 3), "issn": (4, 10), "jid": (4, 10)}
+    # if True, the statistics of the validation cache are reported once the records of the input dump have been
+    # processed, see report_cache_stats
+    _cache_stats = False
+
+    # the options shared by the preprocessors, set by the constructor, and the ones which only apply to the
+    # preprocessors building a citing map, see add_arguments
+    _options = ("redis_bloom", "positive_cache_size", "negative_cache_size", "validation_store", "api_workers",
+                "cache_stats")
+    _citing_map_options = ("single_pass", "rebuild_citing_map", "bloom_error_rate", "deferred_validation")
 
-    def __init__(self, **params):
-        """preprocessor constructor."""
+    def __init__(self, redis_bloom=None, positive_cache_size=None, negative_cache_size=None, validation_store=None,
+                 api_workers=None, cache_stats=False, single_pass=False, rebuild_citing_map=False,
+                 bloom_error_rate=None, deferred_validation=False, **params):
+        """preprocessor constructor. It sets the options shared by the preprocessors, thus it must be called by
+        the constructors of the subclasses once their redis databases are set, and before building the citing map:
+        redis_bloom is the path of the Bloom filter of the keys of the META redis databases (see
+        load_redis_bloom_filter), positive_cache_size and negative_cache_size the sizes of the validation cache (0
+        for no cache), validation_store the path of the validation store, api_workers the number of threads
+        validating the ids through the APIs, and cache_stats whether the statistics of the validation cache are
+        reported (see report_cache_stats). single_pass, rebuild_citing_map, bloom_error_rate and
+        deferred_validation only apply to the preprocessors building a citing map (see iter_single_pass,
+        load_citing_map, build_citing_map and iter_deferred_validation). The options which are not specified
+        keep the default values of the class attributes."""
         for key in params:
             setattr(self, key, params[key])
+        if redis_bloom:
+            self.load_redis_bloom_filter(redis_bloom)
+        if positive_cache_size is not None:
+            self._positive_cache_size = positive_cache_size
+        if negative_cache_size is not None:
+            self._negative_cache_size = negative_cache_size
+        if validation_store:
+            self._validation_store_path = validation_store
+        if api_workers:
+            self._api_workers = api_workers
+        if cache_stats:
+            self._cache_stats = cache_stats
+        self._single_pass = single_pass
+        self._rebuild_citing_map = rebuild_citing_map
+        if bloom_error_rate is not None:
+            self._bloom_error_rate = bloom_error_rate
+        self._deferred_validation = deferred_validation
+        self._validation_cache = ValidationCache(self._positive_cache_size, self._negative_cache_size)
+        self._validation_executor = None
+        if self._api_workers > 1:
+            self._validation_executor = ValidationExecutor(self._api_workers, self._api_limits)
+        self._validation_store = None
+        if self._validation_store_path:
+            self._validation_store = ValidationStore(self._validation_store_path, self._validation_ttl, self._validation_default_ttl)
+        # the spool file of the ids accepted provisionally by the current process in deferred validation mode, the ids
+        # already spooled, and the results of their validation once they are validated, see spool_unresolved_ids
+        self._spool_pid = None
+        self._spool_file = None
+        self._spooled_ids = set()
+        self._deferred_results = None
+        # the ids normalised while the current group of records is prefetched, see normalise_id
+        self._normalised_ids = None
+        # the redis databases are wrapped, so that the ids of a group of records are retrieved at once, and
+        # the ids stored or removed through them are validated again
+        for attr in ("_redis_db", "_redis_db_ra"):
+            if hasattr(self, attr) and not isinstance(getattr(self, attr), PrefetchDataSource):
+                setattr(self, attr, PrefetchDataSource(getattr(self, attr), self._validation_cache.discard))
+
+    @classmethod
+    def add_arguments(cls, arg_parser, citing_map=True):
+        """This method adds to the ArgumentParser in input the command line options shared by the preprocessors,
+        including the ones of the citing map if citing_map is True. Their values are passed to the constructor
+        of the preprocessor by means of get_options."""
+        arg_parser.add_argument('-rb', '--redis_bloom', dest='redis_bloom', required=False, type=str, default=None,
+                                help='Path of the Bloom filter of the keys of the META redis databases, created with preprocessing/index/bloom.py')
+        arg_parser.add_argument('-pcs', '--positive_cache_size', dest='positive_cache_size', required=False, type=int, default=None,
+                                help='Maximum number of valid ids whose validation result is kept in memory (0 for no cache)')
+        arg_parser.add_argument('-ncs', '--negative_cache_size', dest='negative_cache_size', required=False, type=int, default=None,
+                                help='Maximum number of invalid ids whose validation result is kept in memory (0 for no cache)')
+        arg_parser.add_argument('-vs', '--validation_store', dest='validation_store', required=False, type=str, default=None,
+                                help='Path of the sqlite database storing the results of the validations through the APIs, reused across runs')
+        arg_parser.add_argument('-aw', '--api_workers', dest='api_workers', required=False, type=int, default=None,
+                                help='Number of threads validating the ids through the APIs at the same time (default 1, i.e. one at a time)')
+        arg_parser.add_argument('-cst', '--cache_stats', dest='cache_stats', required=False, action='store_true',
+                                help='report the hits, misses and evictions of the validation cache once the input dump has been processed')
+        if citing_map:
+            arg_parser.add_argument('-sp', '--single_pass', dest='single_pass', required=False, action='store_true',
+                                    help='build the citing map while processing the input dump, instead of reading it twice')
+            arg_parser.add_argument('-rcm', '--rebuild_citing_map', dest='rebuild_citing_map', required=False, action='store_true',
+                                    help='build the citing map again, even if the one stored in the citing map directory was built from the same input')
+            arg_parser.add_argument('-be', '--bloom_error_rate', dest='bloom_error_rate', required=False, type=float, default=None,
+                                    help='False positive rate of the Bloom filter stored with the citing map (no filter by default)')
+            arg_parser.add_argument('-dv', '--deferred_validation', dest='deferred_validation', required=False, action='store_true',
+                                    help='validate the ids which are not in the META redis databases all at once, after processing the input dump')
+
+    @classmethod
+    def get_options(cls, args):
+        """This method returns the dictionary of the values of the options shared by the preprocessors (see
+        add_arguments) in the parsed command line arguments in input."""
+        return {key: value for key, value in vars(args).items() if key in cls._options + cls._citing_map_options}
 
     # def set_from_zip(self, zip_dir):
     #     set_from_zip = self.csv_man.load_csv_column_as_set(zip_dir, "id")
     #     print("citing IDs index set: created")
     #     return set_from_zip
 
-    def get_all_files(self, i_dir_or_compr, req_type):
-        """This method is meant to extract all the files of a given format from the compressed file
-        or directory at the filepath in input. It takes in input a filepath and the string of the
-        required filename extension, such as '.csv', '.json', '.ndjson', etc. The output includes
-        a list of extracted files and a targz opener, if required."""
-        result = []
-        targz_fd = None
+    def record_source(self, i_dir_or_compr, req_type, record_type="file", **params):
+        """This method returns a RecordSource reading the file or directory in input, by using the buffer
+        sizes of the preprocessor. See RecordSource for the supported containers and record types."""
+        return RecordSource(i_dir_or_compr, req_type, record_type, read_size=self._read_size,
+                            json_read_size=self._json_read_size, **params)
 
-        if isdir(i_dir_or_compr):
+    def iter_processed(self, source, max_open_files=None, method="process_record"):
+        """This method yields the lists of output entities returned by process_record (or by the method of the
+        preprocessor with the name in input, e.g. for building the citing map) for all the records of the
+        RecordSource in input, in the same order of the records. If the preprocessor has more than one
+        worker, the input files are distributed across a pool of _workers processes, each one processing all
+        the records of a file (or of a part of it, see RecordSource.iter_tasks) at a time. Since the results
+        are yielded in input order, the output files are the same of a single process run, regardless of the
+        scheduling of the workers. Note that the members of the tar.gz and zip archives are read whole by the
+        current process before being sent to the workers (unless the source is split in shards), thus up to
+        _workers * _tasks_per_worker of them are held in memory at the same time, while the files on disk and
+        the members of the plain tar archives are read as streams by the workers. If max_open_files is specified,
+        the tasks being processed at the same time read at most max_open_files distinct files on disk (e.g.: tar
+        archives). The worker processes are
+        forked from the current one, so that they share the data already loaded (e.g.: the citing map),
+        and they have their own copies of the id managers and their own redis connections (see init_worker).
+        Where the fork start method is not available, the records are processed in the current process."""
+        if self._workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with self.worker_pool(source, method) as executor:
+                for results in _ordered_map(executor, _process_task, source.iter_tasks(),
+                                            self._workers * self._tasks_per_worker,
+                                            lambda task: source.task_file(*task), max_open_files):
+                    yield from results
+        else:
+            process = getattr(self, method)
+            for record in (self.prefetched(source) if method in self._prefetch_methods else source):
+                yield process(record)
+            self.flush_validation_store()
+            self.flush_spooled_ids()
 
-            for cur_dir, cur_subdir, cur_files in walk(i_dir_or_compr):
-                for cur_file in cur_files:
-                    if cur_file.endswith(req_type) and not basename(cur_file).startswith("."):
-                        result.append(os.path.join(cur_dir, cur_file))
-        elif i_dir_or_compr.endswith("tar.gz"):
-            targz_fd = tarfile.open(i_dir_or_compr, "r:gz", encoding="utf-8")
-            for cur_file in targz_fd:
-                if cur_file.name.endswith(req_type) and not basename(cur_file.name).startswith("."):
-                    result.append(cur_file)
-        elif i_dir_or_compr.endswith("zip"):
-            with zipfile.ZipFile(i_dir_or_compr, 'r') as zip_ref:
-                dest_dir = ".".join(i_dir_or_compr.split(".")[:-1]) + "_decompr_zip_dir"
-                if not exists(dest_dir):
-                    makedirs(dest_dir)
-                zip_ref.extractall(dest_dir)
-            for cur_dir, cur_subdir, cur_files in walk(dest_dir):
-                for cur_file in cur_files:
-                    if cur_file.endswith(req_type) and not basename(cur_file).startswith("."):
-                        result.append(cur_dir + sep + cur_file)
-
-        elif i_dir_or_compr.endswith("zst"):
-            input_file = pathlib.Path(i_dir_or_compr)
-            dest_dir = ".".join(i_dir_or_compr.split(".")[:-1]) + "_decompr_zst_dir"
-            with open(input_file, 'rb') as compressed:
-                decomp = zstd.ZstdDecompressor()
-                if not exists(dest_dir):
-                    makedirs(dest_dir)
-                output_path = pathlib.Path(dest_dir) / input_file.stem
-                if not exists(output_path):
-                    with open(output_path, 'wb') as destination:
-                        decomp.copy_stream(compressed, destination)
-            for cur_dir, cur_subdir, cur_files in walk(dest_dir):
-                for cur_file in cur_files:
-                    if cur_file.endswith(req_type) and not basename(cur_file).startswith("."):
-                        result.append(cur_dir + sep + cur_file)
-        elif i_dir_or_compr.endswith(".tar"):
-            dest_dir = ".".join(i_dir_or_compr.split(".")[:-1]) + "_open_tar_dir"
-            with tarfile.open(i_dir_or_compr, "r") as tf:
-                tf.extractall(path=dest_dir)
-            for cur_dir, cur_subdir, cur_files in walk(dest_dir):
-                for cur_file in cur_files:
-                    if cur_file.endswith(req_type) and not basename(cur_file).startswith("."):
-                        result.append(cur_dir + sep + cur_file)
+    def worker_pool(self, source, method):
+        """This method returns the pool of _workers processes forked from the current one, which process the tasks
+        of the RecordSource in input with the method of the preprocessor with the name in input (see
+        iter_processed). The threads of the validation executor of the current process are stopped first, so that
+        no thread is running while the workers are forked: each worker starts its own threads (see
+        ValidationExecutor)."""
+        if self._validation_executor is not None:
+            self._validation_executor.shutdown()
+        return ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context("fork"),
+                                   initializer=_init_worker, initargs=(self, source, method))
+
+    def iter_processed_tasks(self, source, method, max_open_files=None):
+        """This method yields the results of the method of the preprocessor with the name in input, called once for
+        each task of the RecordSource in input (see RecordSource.iter_tasks) with the iterable of the records of the
+        task, in the same order of the tasks. As in iter_processed, the tasks are distributed across the worker
+        processes if the preprocessor has more than one worker, so that the method can aggregate the records of a
+        whole task (e.g.: the citing ids of a file, see get_citing_id_run) before sending them back."""
+        if self._workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with self.worker_pool(source, method) as executor:
+                yield from _ordered_map(executor, _process_task_records, source.iter_tasks(),
+                                        self._workers * self._tasks_per_worker,
+                                        lambda task: source.task_file(*task), max_open_files)
         else:
-            print("It is not possible to process the input path.", i_dir_or_compr)
-        return result, targz_fd
+            process = getattr(self, method)
+            for name, content in source.iter_tasks():
+                yield process(source.read_task(name, content))
 
-    def load_json(self, file, targz_fd):
-        """This method is meant to open a json file and load its content in a python dictionary"""
+    def init_worker(self):
+        """This method is called at the start of each worker process. It drops the redis connections
+        inherited from the parent process, so that each worker opens its own ones."""
+        for redis_db in (getattr(self, "_redis_db", None), getattr(self, "_redis_db_ra", None)):
+            if isinstance(redis_db, (RedisDataSource, BloomFilterDataSource, PrefetchDataSource)):
+                redis_db.reset_connections()
 
-        if targz_fd is None:
-            with open(file, encoding="utf8") as f:
-                result = load(f)
+    def get_prefetch_ids(self, record):
+        """This method takes in input a record of the input dump, and returns a pair of lists containing the ids
+        (with prefix) which may be looked up while processing it in the BR and in the RA redis databases
+        respectively, so that they are checked in advance (see prefetched). The ids which are not returned are
+        looked up one at a time. By default, no id is checked in advance."""
+        return [], []
 
-        else:
-            cur_tar_file = targz_fd.extractfile(file)
-            json_str = cur_tar_file.read()
+    def prefetched(self, records):
+        """This method yields the records in input, checking whether the ids of each group of _prefetch_size
+        records (see get_prefetch_ids) are stored in redis with a single request for each database, before
+        yielding the first record of the group. The ids which are found in the citing map or in the validation
+        cache (or which have been spooled in deferred validation mode) are not checked, since they are not looked up
+        in redis. The results are used by the exists method of the redis databases until
+        the next group. The ids normalised by get_prefetch_ids are kept until the next group as well, so that they
+        are not normalised again while processing the records (see normalise_id). Once all the records have been
+        yielded, the statistics of the validation cache are reported (see report_cache_stats)."""
+        records = iter(records)
+        try:
+            while True:
+                chunk = list(islice(records, self._prefetch_size))
+                if not chunk:
+                    break
+                self._normalised_ids = dict()
+                br_ids = dict()
+                ra_ids = dict()
+                for record in chunk:
+                    cur_br_ids, cur_ra_ids = self.get_prefetch_ids(record)
+                    br_ids.update(dict.fromkeys(cur_br_ids))
+                    ra_ids.update(dict.fromkeys(cur_ra_ids))
+                citing_id_index = getattr(self, "citing_id_index", None)
+                if citing_id_index is not None:
+                    br_ids = [x for x in br_ids if not citing_id_index.get_value(x.split(":")[1])]
+                br_ids = [x for x in br_ids if not self._validation_cache.contains(x) and x not in self._spooled_ids]
+                ra_ids = [x for x in ra_ids if not self._validation_cache.contains(x) and x not in self._spooled_ids]
+                if isinstance(getattr(self, "_redis_db", None), PrefetchDataSource):
+                    self._redis_db.prefetch(list(br_ids))
+                if isinstance(getattr(self, "_redis_db_ra", None), PrefetchDataSource):
+                    self._redis_db_ra.prefetch(list(ra_ids))
+                yield from chunk
+            self.report_cache_stats()
+        finally:
+            self._normalised_ids = None
+            for redis_db in (getattr(self, "_redis_db", None), getattr(self, "_redis_db_ra", None)):
+                if isinstance(redis_db, PrefetchDataSource):
+                    redis_db.clear()
+
+    def report_cache_stats(self):
+        """This method writes the statistics of the validation cache (see ValidationCache.stats) below the progress
+        bars, if the preprocessor reports them (see _cache_stats). The worker processes do not report them, since
+        each one of them only processes a part of the input dump with its own cache."""
+        if self._cache_stats and not _worker_state:
+            tqdm.write("validation cache: %s" % self._validation_cache.stats())
+
+    def normalise_id(self, id_man, id_string, include_prefix=True):
+        """This method returns the id string in input normalised by the id manager in input (see the normalise
+        method of the id managers). While the records of a group are prefetched, the result is kept until the next
+        group, so that each id which is normalised by get_prefetch_ids is not normalised again while processing
+        its record (see prefetched)."""
+        if self._normalised_ids is None:
+            return id_man.normalise(id_string, include_prefix=include_prefix)
+        key = (id_man, id_string, include_prefix)
+        if key not in self._normalised_ids:
+            self._normalised_ids[key] = id_man.normalise(id_string, include_prefix=include_prefix)
+        return self._normalised_ids[key]
+
+    def load_redis_bloom_filter(self, path):
+        """This method loads the Bloom filter of the keys of the META redis databases stored in the file in
+        input (see preprocessing/index/bloom.py), so that the identifiers which are certainly not stored in META
+        are not looked up in redis. The filter must be built again whenever the databases are updated."""
+        bloom_filter = BloomFilter.load(path)
+        self._redis_db = BloomFilterDataSource(self._redis_db, bloom_filter)
+        if hasattr(self, "_redis_db_ra"):
+            self._redis_db_ra = BloomFilterDataSource(self._redis_db_ra, bloom_filter)
+
+    def process_record(self, record):
+        """This method takes in input a record of the input dump, as returned by the RecordSource of the
+        preprocessor, and returns the list of the (possibly zero) processed entities to be stored in the
+        output files. It must be implemented by the preprocessors which support multiple workers."""
+        raise NotImplementedError
+
+    def get_citing_ids(self, record):
+        """This method takes in input a record of the input dump, as returned by the RecordSource of the
+        preprocessor, and returns the list of the normalised identifiers (without prefix) of the citing
+        entities it contains. It must be implemented by the preprocessors which build a citing map."""
+        raise NotImplementedError
+
+    def get_citing_id_run(self, records):
+        """This method returns the run (see build_id_run) of the citing ids of the records in input (see
+        get_citing_ids), i.e. their sorted hashes, so that they are hashed and sorted by the worker processes."""
+        return build_id_run(citing_id for record in records for citing_id in self.get_citing_ids(record))
+
+    def build_citing_map(self, source):
+        """This method builds the index of the identifiers of the citing entities of the RecordSource in input
+        (see get_citing_ids), and stores it in the citing map directory of the preprocessor. The input files are
+        distributed across the worker processes as in split_input, each one returning the sorted run of the citing
+        ids of a task (see get_citing_id_run), and the runs are merged by the CitingIdIndexWriter, which sorts the
+        buckets of the index and removes the duplicated ids with the worker processes too. If _bloom_error_rate is set,
+        a Bloom filter of the identifiers is stored with the index. It returns the CitingIdIndex. If the citing map
+        directory already contains the index built from the same input, it is reused (see load_citing_map)."""
+        index_path = os.path.join(self._citing_file_dir, "citing_ids")
+        fingerprint = source.fingerprint(type(self).__name__)
+        citing_id_index = self.load_citing_map(index_path, fingerprint)
+        if citing_id_index is not None:
+            print("citing index: reused")
+            return citing_id_index
+        self.remove_citing_map_fingerprint(index_path)
+        with CitingIdIndexWriter(index_path, self._bloom_error_rate, self._workers) as index_writer:
+            for run in tqdm(self.iter_processed_tasks(source, "get_citing_id_run")):
+                index_writer.add_run(*run)
+        self.save_citing_map_fingerprint(index_path, fingerprint)
+        print("citing index: created")
+        return CitingIdIndex(index_path)
+
+    def load_citing_map(self, index_path, fingerprint):
+        """This method returns the CitingIdIndex stored at the path in input if it was built from an input with
+        the fingerprint in input (see RecordSource.fingerprint), e.g. when the preprocessing of the same dump is
+        started again after a failure, and None otherwise or if _rebuild_citing_map is True. The fingerprint is
+        stored in the '.fingerprint' file of the index only once the index is complete. If the false positive
+        rate of the Bloom filter is changed, the filter is built again from the hashes stored in the index."""
+        fingerprint_path = index_path + ".fingerprint"
+        if self._rebuild_citing_map or not exists(fingerprint_path) or not CitingIdIndex.exists(index_path):
+            return None
+        with open(fingerprint_path, "rb") as f:
+            stored = json_loads(f.read())
+        if stored.get("fingerprint") != fingerprint:
+            return None
+        citing_id_index = CitingIdIndex(index_path)
+        if stored.get("bloom_error_rate") != self._bloom_error_rate:
+            citing_id_index.set_bloom_filter(self._bloom_error_rate)
+            self.save_citing_map_fingerprint(index_path, fingerprint)
+        return citing_id_index
+
+    def save_citing_map_fingerprint(self, index_path, fingerprint):
+        with open(index_path + ".fingerprint", "w", encoding="utf8") as f:
+            f.write(json_dumps({"fingerprint": fingerprint, "bloom_error_rate": self._bloom_error_rate}))
+
+    def remove_citing_map_fingerprint(self, index_path):
+        if exists(index_path + ".fingerprint"):
+            os.remove(index_path + ".fingerprint")
+
+    def iter_single_pass(self):
+        """This method is an alternative to building the citing map before processing the input dump (i.e. to
+        reading the dump twice). It reads the dump once, building the citing map while processing the records with
+        a _DeferredCitingIdIndex, so that the ids which would be looked up in the citing map are accepted without
+        validating them. The processed entities are stored in a spill file in the citing map directory. Then, in a
+        fix-up phase, the spill file is read again and the accepted ids are validated against the complete citing
+        map, redis and the API (see resolve_deferred_ids and is_valid_deferred_id). It yields the lists of output
+        entities as iter_processed does, and the output is the same of a two pass run. Note that the other ids of
+        the entities which are discarded in the fix-up phase (e.g.: the ORCIDs of the authors) are validated too.
+        In deferred validation mode, the ids spooled while reading the dump are validated before the fix-up phase
+        (see iter_deferred_validation), while the ids accepted by the _DeferredCitingIdIndex which are not found in
+        the complete citing map are still validated one at a time in the fix-up phase."""
+        index_path = os.path.join(self._citing_file_dir, "citing_ids")
+        spill_path = os.path.join(self._citing_file_dir, "deferred_entities.ndjson")
+        source = self.get_record_source()
+        fingerprint = source.fingerprint(type(self).__name__)
+        citing_id_index = self.load_citing_map(index_path, fingerprint)
+        if citing_id_index is not None:
+            # the citing map is already available, so that the ids do not need to be deferred
+            print("citing index: reused")
+            self.citing_id_index = citing_id_index
+            yield from self.iter_deferred_validation(source) if self._deferred_validation else self.iter_processed(source)
+            return
+        self.remove_citing_map_fingerprint(index_path)
+        self.citing_id_index = _DeferredCitingIdIndex()
+        if self._deferred_validation:
+            self.clear_spooled_ids()
+        with CitingIdIndexWriter(index_path, self._bloom_error_rate, self._workers) as index_writer, \
+                open(spill_path, "w", encoding="utf8") as spill_file:
+            for citing_ids, processed_entities in tqdm(self.iter_processed(source, method="process_record_deferred")):
+                index_writer.add_all(citing_ids)
+                for processed_entity in processed_entities:
+                    spill_file.write(json_dumps(processed_entity, ensure_ascii=False) + "\n")
+        self.save_citing_map_fingerprint(index_path, fingerprint)
+        print("citing index: created")
+        self.citing_id_index = CitingIdIndex(index_path)
+        if self._deferred_validation:
+            self.validate_spooled_ids()
+        spill_source = self.record_source(spill_path, ".ndjson", "ndjson", shard_size=self._spill_shard_size)
+        yield from self.iter_processed(spill_source, method="resolve_deferred_ids")
+        os.remove(spill_path)
 
-            # In Python 3.5 it seems that, for some reason, the extractfile method returns an
-            # object 'bytes' that cannot be managed by the function 'load' in the json package.
-            # Thus, to avoid issues, in case an object having type 'bytes' is return, it is
-            # transformed as a string before passing it to the function 'loads'. Please note
-            # that Python 3.9 does not show this behaviour, and it works correctly without
-            # any transformation.
-            if type(json_str) is bytes:
-                json_str = json_str.decode("utf-8")
+    def iter_deferred_validation(self, source):
+        """This method is an alternative to validating the ids through the APIs while processing the input dump. It
+        processes the records of the RecordSource in input accepting provisionally the ids which are not found in the
+        citing map, in the validation cache, in redis or in the validation store, and spooling them to a file of the
+        citing map directory (see spool_unresolved_ids). The processed entities are stored in a spill file in the
+        citing map directory. Then, in a bulk phase, each distinct spooled id is validated through the APIs only once
+        (see validate_spooled_ids), and in the fix-up phase of the single pass mode the spill file is read again,
+        removing the invalid ids from the entities or discarding them (see resolve_deferred_ids). It yields the lists
+        of output entities as iter_processed does, and the output is the same of a run validating the ids inline."""
+        spill_path = os.path.join(self._citing_file_dir, "provisional_entities.ndjson")
+        self.clear_spooled_ids()
+        with open(spill_path, "w", encoding="utf8") as spill_file:
+            for processed_entities in tqdm(self.iter_processed(source)):
+                for processed_entity in processed_entities:
+                    spill_file.write(json_dumps(processed_entity, ensure_ascii=False) + "\n")
+        self.validate_spooled_ids()
+        spill_source = self.record_source(spill_path, ".ndjson", "ndjson", shard_size=self._spill_shard_size)
+        yield from self.iter_processed(spill_source, method="resolve_deferred_ids")
+        os.remove(spill_path)
 
-            result = loads(json_str)
+    def clear_spooled_ids(self):
+        """This method creates the empty directory storing the spool files of the deferred validation mode in the
+        citing map directory, removing the ones left by a previous run, if any."""
+        spool_dir = os.path.join(self._citing_file_dir, "unresolved_ids")
+        if exists(spool_dir):
+            shutil.rmtree(spool_dir)
+        makedirs(spool_dir)
+        self._deferred_results = None
+
+    def spool_unresolved_ids(self, ids):
+        """This method takes in input a list of pairs containing a normalised id (with prefix) and its id manager,
+        which could not be validated without the APIs in deferred validation mode, and accepts them provisionally,
+        returning a list of True values. The ids which have not been spooled by the current process yet are appended
+        to its spool file, so that they are validated in the bulk phase (see validate_spooled_ids)."""
+        if self._spool_pid != os.getpid():
+            self._spool_pid = os.getpid()
+            self._spooled_ids = set()
+            self._spool_file = open(os.path.join(self._citing_file_dir, "unresolved_ids", "%d.txt" % self._spool_pid),
+                                    "a", encoding="utf8")
+        for norm_id, id_man in ids:
+            if norm_id not in self._spooled_ids:
+                self._spooled_ids.add(norm_id)
+                self._spool_file.write(norm_id + "\n")
+        return [True] * len(ids)
+
+    def flush_spooled_ids(self):
+        """This method writes the ids spooled by the current process which are still buffered, if any (see
+        spool_unresolved_ids). It is called once all the records of a task or of a source have been processed."""
+        if self._spool_file is not None and self._spool_pid == os.getpid():
+            self._spool_file.flush()
+
+    def validate_spooled_ids(self):
+        """This method is the bulk phase of the deferred validation mode: it reads the ids spooled by all the
+        processes, and validates each distinct id through the APIs, _deferred_batch_size ids at a time (see
+        validate_ids_api). The results are kept in memory until the end of the run, in order to patch the processed
+        entities (see is_valid_deferred_id and is_valid_provisional_id), and the spool files are removed."""
+        spool_dir = os.path.join(self._citing_file_dir, "unresolved_ids")
+        if self._spool_file is not None and self._spool_pid == os.getpid():
+            self._spool_file.close()
+        self._spool_pid = None
+        self._spool_file = None
+        self._spooled_ids = set()
+        unresolved = dict()
+        for name in sorted(os.listdir(spool_dir)):
+            with open(os.path.join(spool_dir, name), encoding="utf8") as f:
+                unresolved.update(dict.fromkeys(line.rstrip("\n") for line in f))
+        unresolved = list(unresolved)
+        self._deferred_results = dict()
+        for start in tqdm(range(0, len(unresolved), self._deferred_batch_size)):
+            norm_ids = unresolved[start:start + self._deferred_batch_size]
+            ids = [(norm_id, self.get_id_manager(norm_id.split(":")[0], self._id_man_dict)) for norm_id in norm_ids]
+            self._deferred_results.update(zip(norm_ids, self.validate_ids_api(ids)))
+        self.flush_validation_store()
+        shutil.rmtree(spool_dir)
+        print("deferred validation: %d ids, %d invalid" % (len(unresolved), list(self._deferred_results.values()).count(False)))
+
+    def process_record_deferred(self, record):
+        """This method returns both the citing ids (see get_citing_ids) and the processed entities (see
+        process_record) of the record in input, for processing the input dump in a single pass."""
+        return self.get_citing_ids(record), self.process_record(record)
+
+    def resolve_deferred_ids(self, entity):
+        """This method takes in input an entity processed in single pass mode (see iter_single_pass), and
+        returns the list containing the entity with the ids accepted by the _DeferredCitingIdIndex validated
+        (see is_valid_deferred_id), or an empty list if the entity must be discarded. In deferred validation
+        mode, the other ids accepted provisionally are validated too (see is_valid_provisional_id). It must be
+        implemented by the preprocessors which support the single pass or the deferred validation mode."""
+        raise NotImplementedError
+
+    def is_valid_deferred_id(self, norm_id):
+        """This method validates an id (with prefix) accepted by the _DeferredCitingIdIndex, by checking the
+        citing map, redis and the API in this order, as done by to_validated_id_list. In deferred validation
+        mode, the ids spooled while processing the input dump are checked against the results of the bulk phase,
+        and the others have already been validated, unless the citing map was not available yet."""
+        if self._deferred_results is not None:
+            if norm_id in self._deferred_results:
+                return self._deferred_results[norm_id]
+            if not self._single_pass:
+                return True
+        id_man = self.get_id_manager(norm_id.split(":")[0], self._id_man_dict)
+        return self.validate_id(norm_id, id_man, self._redis_db)
+
+    def is_valid_provisional_id(self, norm_id):
+        """This method returns False if the id (with prefix) in input was accepted provisionally in deferred
+        validation mode and found invalid in the bulk phase, and True otherwise (see validate_spooled_ids)."""
+        return self._deferred_results is None or self._deferred_results.get(norm_id, True)
+
+    def validate_id(self, norm_id, id_man, redis_db, citing_map=True):
+        """This method returns True if the normalised id (with prefix) in input is valid, by checking the citing
+        map (unless citing_map is False), the redis database in input and the API of the id manager in this
+        order. Apart from the citing map, which is already in memory, the results are cached, so that each id
+        is looked up in redis and validated through the API at most once (see ValidationCache). If a validation
+        store is used, the results of the API are also stored in it, and reused by the next runs until they
+        expire (see ValidationStore). In deferred validation mode, the ids which must be validated through the API
+        are accepted provisionally (see validate_unresolved_ids)."""
+        valid = self.resolve_id(norm_id, redis_db, citing_map)
+        if valid is None:
+            valid = self.validate_unresolved_ids([(norm_id, id_man)])[0]
+        return valid
+
+    def validate_ids(self, ids, redis_db, citing_map=True):
+        """This method takes in input a list of pairs containing a normalised id (with prefix) and its id
+        manager, and returns the list of the results of their validation, in the same order, as validate_id
+        does for each id. The ids which must be validated through the APIs are validated concurrently (see
+        validate_ids_api)."""
+        results = [self.resolve_id(norm_id, redis_db, citing_map) for norm_id, id_man in ids]
+        # the unresolved ids must be deduplicated for thread safety, and not only for validating each id once: the
+        # id managers are shared by the threads of the ValidationExecutor, and is_valid stores an empty result for
+        # the id before calling the API, which would be returned by a concurrent call validating the same id
+        unresolved = {norm_id: id_man for (norm_id, id_man), valid in zip(ids, results) if valid is None}
+        validated = dict(zip(unresolved, self.validate_unresolved_ids(list(unresolved.items()))))
+        return [validated[norm_id] if valid is None else valid for (norm_id, id_man), valid in zip(ids, results)]
+
+    def resolve_id(self, norm_id, redis_db, citing_map=True):
+        """This method returns the result of the validation of the normalised id (with prefix) in input if it
+        can be obtained without calling the API, i.e. from the citing map (unless citing_map is False), the
+        validation cache, the redis database in input or the validation store, and None otherwise. In deferred
+        validation mode, the ids already spooled by the current process are accepted (see spool_unresolved_ids)."""
+        if citing_map and self.citing_id_index.get_value(norm_id.split(":")[1]):
+            return True
+        valid = self._validation_cache.get(norm_id)
+        if valid is None and norm_id in self._spooled_ids:
+            # the id has already been accepted provisionally by the current process, see spool_unresolved_ids
+            return True
+        if valid is None:
+            if redis_db.exists(norm_id):
+                valid = True
+            elif self._validation_store is not None:
+                valid = self._validation_store.get(norm_id)
+            if valid is not None:
+                self._validation_cache.put(norm_id, valid)
+        return valid
+
+    def validate_unresolved_ids(self, ids):
+        """This method takes in input a list of pairs containing a normalised id (with prefix) and its id manager,
+        which could not be validated without the APIs (see resolve_id), and returns the list of the results of
+        their validation, in the same order. In deferred validation mode, the ids are accepted provisionally until
+        the bulk phase (see spool_unresolved_ids), otherwise they are validated through the APIs at once."""
+        if self._deferred_validation and self._deferred_results is None:
+            return self.spool_unresolved_ids(ids)
+        return self.validate_ids_api(ids)
+
+    def validate_ids_api(self, ids):
+        """This method takes in input a list of pairs containing a normalised id (with prefix) and its id
+        manager, and returns the list of the results of their validation through the APIs, in the same order.
+        The ids in input must be distinct (see validate_ids). The ids are validated concurrently and within the rate limits of their APIs, unless _api_workers is 1
+        (see ValidationExecutor). The results are stored in the validation cache and in the validation store, if
+        any."""
+        if self._validation_executor is not None:
+            results = self._validation_executor.validate(ids)
+        else:
+            results = [bool(id_man.is_valid(norm_id)) for norm_id, id_man in ids]
+        for (norm_id, id_man), valid in zip(ids, results):
+            self._validation_cache.put(norm_id, valid)
+            if self._validation_store is not None:
+                self._validation_store.put(norm_id, valid)
+        return results
 
-        return result
+    def flush_validation_store(self):
+        """This method writes the pending results of the validation store, if any (see ValidationStore.flush).
+        It is called once all the records of a task or of a source have been processed."""
+        if self._validation_store is not None:
+            self._validation_store.flush()
 
     def get_id_manager(self, schema, id_man_dict):
         """Given as input the string of a schema (e.g.:'pmid') and a dictionary mapping strings of
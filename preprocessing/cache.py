@@ -0,0 +1,143 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import os
+import time
+import sqlite3
+from collections import OrderedDict
+
+
+class ValidationCache(object):
+    """This class stores the results of the validation of the normalised ids (with prefix) in memory, so that
+    the ids which occur many times in a dump (e.g.: the DOIs of popular cited entities, the ISSNs of journals,
+    the ORCIDs of prolific authors) are checked once. The valid and the invalid ids are stored in two separate
+    LRU caches of positive_size and negative_size ids respectively (a size of 0 disables the cache), which
+    discard the least recently used ids when they are full. The numbers of hits, misses and evictions are
+    counted, see stats."""
+
+    def __init__(self, positive_size=2 ** 20, negative_size=2 ** 18):
+        self.positive_size = positive_size
+        self.negative_size = negative_size
+        self._positive = OrderedDict()
+        self._negative = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, norm_id):
+        """This method returns True if the id in input is stored as valid, False if it is stored as invalid,
+        and None if it is not stored."""
+        for cache, valid in ((self._positive, True), (self._negative, False)):
+            if norm_id in cache:
+                cache.move_to_end(norm_id)
+                self.hits += 1
+                return valid
+        self.misses += 1
+        return None
+
+    def contains(self, norm_id):
+        """This method returns True if the result of the validation of the id in input is stored, without
+        counting a hit or a miss."""
+        return norm_id in self._positive or norm_id in self._negative
+
+    def put(self, norm_id, valid):
+        """This method stores the result of the validation of the id in input."""
+        cache, size = (self._positive, self.positive_size) if valid else (self._negative, self.negative_size)
+        if size <= 0:
+            return
+        cache[norm_id] = None
+        cache.move_to_end(norm_id)
+        if len(cache) > size:
+            cache.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, norm_id):
+        """This method removes the result of the validation of the id in input, e.g. after it has been stored in
+        or removed from redis."""
+        self._positive.pop(norm_id, None)
+        self._negative.pop(norm_id, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "positive": len(self._positive), "negative": len(self._negative)}
+
+
+class ValidationStore(object):
+    """This class stores the results of the validation of the normalised ids (with prefix) through the APIs in
+    a sqlite database, so that they are reused across runs. Each result is stored with the time of the
+    validation, and it is ignored once it is older than the time to live (in seconds) of the schema of the id,
+    i.e. the value of ttl for the schema or default_ttl if it is not specified. The results are written in
+    batches of batch_size results (see flush). The database can be used at the same time by more processes
+    (e.g.: the worker processes of a preprocessor): each process opens its own connection, and the database is
+    in WAL mode, so that the readers are not blocked by the writers."""
+
+    def __init__(self, path, ttl=None, default_ttl=30 * 24 * 3600, batch_size=1000, timeout=60):
+        self._path = path
+        self._ttl = ttl or dict()
+        self._default_ttl = default_ttl
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._pending = dict()
+        self._conn = None
+        self._pid = None
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS validation (id TEXT PRIMARY KEY, valid INTEGER NOT NULL, time REAL NOT NULL)")
+
+    def _connection(self):
+        # the connections can not be shared with the forked processes, whose pending results are the ones of
+        # the parent process, which writes them
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, timeout=self._timeout)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+            self._pending = dict()
+        return self._conn
+
+    def ttl(self, norm_id):
+        return self._ttl.get(norm_id.split(":")[0], self._default_ttl)
+
+    def get(self, norm_id):
+        """This method returns True if the id in input was validated, False if it was not, and None if no
+        result of its validation is stored or the result is expired."""
+        if norm_id in self._pending:
+            return self._pending[norm_id][0]
+        row = self._connection().execute("SELECT valid, time FROM validation WHERE id = ?", (norm_id,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl(norm_id):
+            return None
+        return bool(row[0])
+
+    def put(self, norm_id, valid):
+        """This method stores the result of the validation of the id in input. The results are written when
+        batch_size results are pending."""
+        self._connection()
+        self._pending[norm_id] = (bool(valid), time.time())
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """This method writes the pending results in a single transaction."""
+        conn = self._connection()
+        if self._pending:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO validation (id, valid, time) VALUES (?, ?, ?)",
+                                 [(k, int(v), t) for k, (v, t) in self._pending.items()])
+            self._pending = dict()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+        self._conn = None
+        self._pid = None
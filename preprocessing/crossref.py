@@ -15,22 +15,18 @@
 
 from argparse import ArgumentParser
 from os import makedirs
-import json
 import os
-import csv
 from tqdm import tqdm
 from datetime import datetime
 import os.path
-import shutil
 from os.path import exists
-from preprocessing.base import Preprocessing
+from preprocessing.base import Preprocessing, json_dumps
 from oc_idmanager.doi import DOIManager
 from oc_idmanager.issn import ISSNManager
 from oc_idmanager.isbn import ISBNManager
 from oc_idmanager.ror import RORManager
 from oc_idmanager.viaf import ViafManager
 from oc_idmanager.orcid import ORCIDManager
-from oc_meta.lib.csvmanager import CSVManager
 
 
 class CrossrefPreProcessing(Preprocessing):
@@ -39,13 +35,14 @@ class CrossrefPreProcessing(Preprocessing):
     _entity_keys_to_update = {"ISSN", "author", "reference", "editor", "ISBN", "DOI"}
     _entity_keys_to_keep = {"container-title", "issued", "member", "issued", "issue", "prefix", "title", "type", "publisher", "volume", "deposited", "page", "original-title", "content-updated"}
 
-    def __init__(self, input_dir, output_dir, interval, citing_map_dir, testing=False):
+    def __init__(self, input_dir, output_dir, interval, citing_map_dir, testing=False, stream_items=False, workers=1, **params):
         if testing:
             self._redis_db = self.BR_redis_test
             self._redis_db_ra = self.RA_redis_test
         else:
             self._redis_db = self.BR_redis
             self._redis_db_ra = self.RA_redis
+        super(CrossrefPreProcessing, self).__init__(**params)
         self._input_dir = input_dir
         self._output_dir = output_dir
         if not exists(self._output_dir):
@@ -53,10 +50,11 @@ class CrossrefPreProcessing(Preprocessing):
         self._citing_file_dir = citing_map_dir
         if not exists(self._citing_file_dir):
             makedirs(self._citing_file_dir)
-        self._dir_to_compr = os.path.join(self._citing_file_dir, "dir_to_compr")
-        if not exists(self._dir_to_compr):
-            makedirs(self._dir_to_compr)
         self._interval = interval
+        # if True, the items of each input json file are parsed one at a time instead of loading the whole file
+        self._stream_items = stream_items
+        # number of processes used for processing the input json files in split_input
+        self._workers = workers
         self._doi_manager = DOIManager()
         self._issn_manager = ISSNManager()
         self._isbn_manager = ISBNManager()
@@ -65,132 +63,135 @@ class CrossrefPreProcessing(Preprocessing):
         self._orcid_manager = ORCIDManager()
         self._id_man_dict = {"doi":self._doi_manager, "issn": self._issn_manager, "isbn": self._isbn_manager, "viaf":self._viaf_manager, "ror": self._ror_manager, "orcid":self._orcid_manager}
         # CREATE THE CITING ID FILE
-        self.zip_filepath = self.create_citing_map()
-        self.citing_id_index = CSVManager(self.zip_filepath)
-        super(CrossrefPreProcessing, self).__init__()
+        if not self._single_pass:
+            self.citing_id_index = self.create_citing_map()
+
+    def get_citing_ids(self, obj):
+        """This method returns the list containing the normalised DOI of the entity in input, if any, in
+        order to build the citing map."""
+        if obj.get("DOI"):
+            doi_entity = self.normalise_id(self._doi_manager, obj['DOI'], include_prefix=False)
+            if doi_entity:
+                return [doi_entity]
+        return []
 
     def create_citing_map(self):
-        data = []
-        count = 0
-        filecount = 0
-
-        all_files, targz_fd = self.get_all_files(self._input_dir, self._req_type)
-        for file_idx, file in enumerate(tqdm(all_files), 1):
-            file_data = self.load_json(file, targz_fd)
-            if "items" in file_data:
-                for obj in tqdm(file_data["items"]):
-                    if obj.get("DOI"):
-                        doi_entity = self._doi_manager.normalise(obj['DOI'])
-                        if doi_entity:
-                            data.append(doi_entity)
-                            count += 1
-                            if count == 1000:
-                                # List that we want to add as a new row
-                                rows_to_append = [[x]for x in data]
-                                # Open our existing CSV file in append mode
-                                # Create a file object for this file
-                                with open(os.path.join(self._dir_to_compr, str(filecount)+".csv"), 'w') as f_object:
-                                    # Pass this file object to csv.writer()
-                                    # and get a writer object
-                                    writer_object = csv.writer(f_object)
-                                    writer_object.writerow(["id"])
-                                    # Pass the list as an argument into
-                                    # the writerow()
-                                    writer_object.writerows(rows_to_append)
-                                    # Close the file object
-                                    f_object.close()
-
-                                filecount += 1
-                                count = 0
-                                data = []
-        if data:
-            rows_to_append = [[x] for x in data]
-            with open(os.path.join(self._dir_to_compr, str(filecount+1)+".csv"), 'w') as f_object:
-                # Pass this file object to csv.writer()
-                # and get a writer object
-                writer_object = csv.writer(f_object)
-                writer_object.writerow(["id"])
-                # Pass the list as an argument into
-                # the writerow()
-                writer_object.writerows(rows_to_append)
-                # Close the file object
-                f_object.close()
-        print("citing index: created")
-        shutil.make_archive(os.path.join(self._citing_file_dir, "zip_citing_map"), 'zip', self._dir_to_compr)
-        print("citing index: compressed")
-        shutil.rmtree(self._dir_to_compr)
-        compressed_filepath = os.path.join(self._citing_file_dir, "zip_citing_map.zip")
-        return compressed_filepath
+        """This method builds the index of the DOIs of the citing entities of the dump (see build_citing_map)."""
+        return self.build_citing_map(self.get_record_source())
+
+    def get_record_source(self):
+        """This method returns the source of the entities stored in the 'items' arrays of the Crossref
+        json files. In stream_items mode, the items are parsed one at a time instead of loading each file."""
+        return self.record_source(self._input_dir, self._req_type, "json_items", json_key="items",
+                                  stream_items=self._stream_items)
+
+    def process_record(self, obj):
+        if obj.get("DOI") and obj.get("reference"):
+            doi_entity = self.normalise_id(self._doi_manager, obj['DOI'], include_prefix=False)
+            if doi_entity:
+
+                # add k,v pairs which do not need to be modified
+                processed_entity = {k: v for k, v in obj.items() if
+                                    k in self._entity_keys_to_keep}
+
+                # update k,v pairs which need to be updated before being added to the processed_entity dict
+
+                # "reference"
+                references = self.to_validated_id_list(obj.get("reference"), "citations")
+                if references:
+                    processed_entity['reference'] = references
+                else:
+                    return []
+
+                #"DOI"
+                processed_entity['DOI'] = doi_entity
+
+                # "author"
+                if obj.get("author"):
+                    authors = self.to_validated_id_list(obj.get("author"), "responsible_agents")
+                    processed_entity['author'] = authors
+
+                #"editor"
+                if obj.get("editor"):
+                    editors = self.to_validated_id_list(obj.get("editor"), "responsible_agents")
+                    processed_entity['editor'] = editors
+
+                # ISSN
+                if obj.get("ISSN"):
+                    get_ISSN = obj.get("ISSN")
+                    if not isinstance(get_ISSN, list):
+                        get_ISSN = [get_ISSN]
+
+                    ISSN = [{"id":x, "schema": "issn"} for x in get_ISSN]
+                    ISSN_v = self.to_validated_id_list(ISSN, "container")
+                    processed_entity['ISSN'] = ISSN_v
+
+                # ISBN
+                if obj.get("ISBN"):
+                    get_ISBN = obj.get("ISBN")
+                    if not isinstance(get_ISBN, list):
+                        get_ISBN = [get_ISBN]
+                    ISBN = [{"id":x, "schema": "isbn"} for x in get_ISBN]
+                    ISBN_v = self.to_validated_id_list(ISBN, "container")
+                    processed_entity['ISBN'] = ISBN_v
+
+                return [processed_entity]
+        return []
+
+    def get_prefetch_ids(self, obj):
+        """This method returns the normalised DOIs of the references and the ISSNs and ISBNs of the entity in
+        input, and the normalised ORCIDs of its authors and editors, which are looked up in redis while
+        processing it (see prefetched)."""
+        br_ids = []
+        ra_ids = []
+        if obj.get("DOI") and obj.get("reference") and self.normalise_id(self._doi_manager, obj['DOI'], include_prefix=False):
+            doi_man = self.get_id_manager("doi", self._id_man_dict)
+            br_ids.extend(self.normalise_id(doi_man, c["DOI"]) for c in obj["reference"] if c.get("DOI"))
+            for schema in ("issn", "isbn"):
+                ids = obj.get(schema.upper())
+                if ids:
+                    id_man = self.get_id_manager(schema, self._id_man_dict)
+                    br_ids.extend(self.normalise_id(id_man, x) for x in (ids if isinstance(ids, list) else [ids]))
+            orcid_man = self.get_id_manager("orcid", self._id_man_dict)
+            for agent in obj.get("author", []) + obj.get("editor", []):
+                if agent.get("ORCID"):
+                    orcid = agent["ORCID"][0] if isinstance(agent["ORCID"], list) else agent["ORCID"]
+                    ra_ids.append(self.normalise_id(orcid_man, str(orcid)))
+        return [x for x in br_ids if x], [x for x in ra_ids if x]
+
+    def resolve_deferred_ids(self, entity):
+        """This method validates the DOIs of the references and the ISSNs and ISBNs of an entity processed in
+        single pass mode, discarding the entity if none of its references is valid (see iter_single_pass). In
+        deferred validation mode, the ORCIDs of its authors and editors are validated too."""
+        entity['reference'] = [c for c in entity['reference'] if self.is_valid_deferred_id(c["DOI"])]
+        if not entity['reference']:
+            return []
+        for key in ("ISSN", "ISBN"):
+            if key in entity:
+                entity[key] = [x for x in entity[key] if self.is_valid_deferred_id(x)]
+        for agent in entity.get("author", []) + entity.get("editor", []):
+            if "ORCID" in agent and not self.is_valid_provisional_id(agent["ORCID"]):
+                del agent["ORCID"]
+        return [entity]
 
     def split_input(self):
 
         data = []
         count = 0
 
-        all_files, targz_fd = self.get_all_files(self._input_dir, self._req_type)
-        for file_idx, file in enumerate(tqdm(all_files), 1):
-            file_data = self.load_json(file, targz_fd)
-            if "items" in file_data:
-                for obj in tqdm(file_data["items"]):
-
-                    if obj.get("DOI") and obj.get("reference"):
-                        doi_entity = self._doi_manager.normalise(obj['DOI'])
-                        if doi_entity:
-
-                            # add k,v pairs which do not need to be modified
-                            processed_entity = {k: v for k, v in obj.items() if
-                                                k in self._entity_keys_to_keep}
-
-                            # update k,v pairs which need to be updated before being added to the processed_entity dict
-
-                            # "reference"
-                            references = self.to_validated_id_list(obj.get("reference"), "citations")
-                            if references:
-                                processed_entity['reference'] = references
-                            else:
-                                continue
-
-                            #"DOI"
-                            processed_entity['DOI'] = doi_entity
-
-                            # "author"
-                            if obj.get("author"):
-                                authors = self.to_validated_id_list(obj.get("author"), "responsible_agents")
-                                processed_entity['author'] = authors
-
-                            #"editor"
-                            if obj.get("editor"):
-                                editors = self.to_validated_id_list(obj.get("editor"), "responsible_agents")
-                                processed_entity['editor'] = editors
-
-                            # ISSN
-                            if obj.get("ISSN"):
-                                get_ISSN = obj.get("ISSN")
-                                if not isinstance(get_ISSN, list):
-                                    get_ISSN = [get_ISSN]
-
-                                ISSN = [{"id":x, "schema": "issn"} for x in get_ISSN]
-                                ISSN_v = self.to_validated_id_list(ISSN, "container")
-                                processed_entity['ISSN'] = ISSN_v
-
-                            # ISBN
-                            if obj.get("ISBN"):
-                                get_ISBN = obj.get("ISBN")
-                                if not isinstance(get_ISBN, list):
-                                    get_ISBN = [get_ISBN]
-                                ISBN = [{"id":x, "schema": "isbn"} for x in get_ISBN]
-                                ISBN_v = self.to_validated_id_list(ISBN, "container")
-                                processed_entity['ISBN'] = ISBN_v
-
-
-                            data.append(processed_entity)
-                            count += 1
-                            if int(count) != 0 and int(count) % int(self._interval) == 0:
-                                data = self.splitted_to_file(count, data, ".json")
-
-
-        if targz_fd is not None:
-            targz_fd.close()
+        if self._single_pass:
+            processed = self.iter_single_pass()
+        elif self._deferred_validation:
+            processed = self.iter_deferred_validation(self.get_record_source())
+        else:
+            processed = self.iter_processed(self.get_record_source())
+        for processed_entities in tqdm(processed):
+            for processed_entity in processed_entities:
+                data.append(processed_entity)
+                count += 1
+                if int(count) != 0 and int(count) % int(self._interval) == 0:
+                    data = self.splitted_to_file(count, data, ".json")
+
         if len(data) > 0:
             count = count + (self._interval - (int(count) % int(self._interval)))
             self.splitted_to_file(count, data, ".json")
@@ -207,7 +208,7 @@ class CrossrefPreProcessing(Preprocessing):
                     filename = filename[:-len(self._req_type)] + "_" + dt_string + self._req_type
                 with open(os.path.join(self._output_dir, filename), "w", encoding="utf8") as json_file:
                     dict_to_json["items"] = data
-                    json.dump(dict_to_json, json_file)
+                    json_file.write(json_dumps(dict_to_json))
                     json_file.close()
                 return []
             else:
@@ -226,13 +227,9 @@ class CrossrefPreProcessing(Preprocessing):
                     else:
                         orcid = str(c['ORCID'])
                     id_man = self.get_id_manager("orcid", self._id_man_dict)
-                    norm_id = id_man.normalise(orcid, include_prefix=True)
-                    if self._redis_db_ra.get(norm_id):
-                        a_processed["ORCID"] = norm_id
-                    elif id_man.is_valid(norm_id):
+                    norm_id = self.normalise_id(id_man, orcid)
+                    if self.validate_id(norm_id, id_man, self._redis_db_ra, citing_map=False):
                         a_processed["ORCID"] = norm_id
-                    else:
-                        pass
 
                 processed_list.append(a_processed)
 
@@ -243,21 +240,14 @@ class CrossrefPreProcessing(Preprocessing):
             processed_list = []
             min_req_dict_list = [x for x in id_dict_list if x.get("DOI")]
             if min_req_dict_list:
-                for c in min_req_dict_list:
-                    c_processed = {k:v for k,v in c.items() if k!= "DOI"}
-                    id = c.get("DOI")
-                    norm_id = id_man.normalise(id, include_prefix=True)
-                    if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                        c_processed["DOI"]= norm_id
-                        processed_list.append(c_processed)
-                    elif self._redis_db.get(norm_id):
-                        c_processed["DOI"]= norm_id
-                        processed_list.append(c_processed)
-                    elif id_man.is_valid(norm_id):
+                norm_ids = [self.normalise_id(id_man, c.get("DOI")) for c in min_req_dict_list]
+                # the DOIs which are not in the citing map nor in redis db are validated concurrently
+                valid_ids = self.validate_ids([(norm_id, id_man) for norm_id in norm_ids], self._redis_db)
+                for c, norm_id, valid in zip(min_req_dict_list, norm_ids, valid_ids):
+                    if valid:
+                        c_processed = {k:v for k,v in c.items() if k!= "DOI"}
                         c_processed["DOI"]= norm_id
                         processed_list.append(c_processed)
-                    else:
-                        pass
 
             return processed_list
 
@@ -267,15 +257,9 @@ class CrossrefPreProcessing(Preprocessing):
                 schema = c.get("schema")
                 id = c.get("id")
                 id_man = self.get_id_manager(schema, self._id_man_dict)
-                norm_id = id_man.normalise(id, include_prefix=True)
-                if self.citing_id_index.get_value(norm_id.split(":")[1]):
+                norm_id = self.normalise_id(id_man, id)
+                if self.validate_id(norm_id, id_man, self._redis_db):
                     processed_list.append(norm_id)
-                elif self._redis_db.get(norm_id):
-                    processed_list.append(norm_id)
-                elif id_man.is_valid(norm_id):
-                    processed_list.append(norm_id)
-                else:
-                    pass
             return processed_list
 
 
@@ -296,10 +280,14 @@ if __name__ == '__main__':
                             help='paremeter to define whether or not the script is executed in testing modality')
     arg_parser.add_argument('-t', '--testing', dest='testing', required=False, type=bool, default=False,
                             help='paremeter to define whether or not the script is executed in testing modality')
-
+    arg_parser.add_argument('-si', '--stream_items', dest='stream_items', required=False, action='store_true',
+                            help='parse the items of each json file one at a time, in order to reduce the memory usage')
+    arg_parser.add_argument('-w', '--workers', dest='workers', required=False, type=int, default=1,
+                            help='Number of processes used for processing the input json files')
+    CrossrefPreProcessing.add_arguments(arg_parser)
     args = arg_parser.parse_args()
 
-    crpp = CrossrefPreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number,citing_map_dir=args.citing_map_dir, testing=args.testing)
+    crpp = CrossrefPreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number,citing_map_dir=args.citing_map_dir, testing=args.testing, stream_items=args.stream_items, workers=args.workers, **CrossrefPreProcessing.get_options(args))
     crpp.split_input()
 
     # HOW TO RUN (example: preprocess) % python -m preprocessing.crossref -in "/Volumes/T7_Touch/LAVORO/COCI/crossref-data-YYYY-MM.tar.gz" -out "/Volumes/T7_Touch/test_preprocess_crossref" -n 100 -t True
\ No newline at end of file
@@ -1,14 +1,11 @@
 import ndjson
 from os import makedirs, listdir
 import glob
-import json
 import os
 from tqdm import tqdm
-import csv
 import os.path
-import shutil
 from os.path import exists, join
-from preprocessing.base import Preprocessing
+from preprocessing.base import Preprocessing, json_dumps
 from oc_idmanager.pmid import PMIDManager
 from oc_idmanager.pmcid import PMCIDManager
 from oc_idmanager.doi import DOIManager
@@ -20,7 +17,6 @@ from oc_idmanager.ror import RORManager
 from oc_idmanager.wikidata import WikidataManager
 from datetime import datetime
 from argparse import ArgumentParser
-from oc_meta.lib.csvmanager import CSVManager
 
 
 class DatacitePreProcessing(Preprocessing):
@@ -44,13 +40,18 @@ class DatacitePreProcessing(Preprocessing):
     # "partCount", "partOfCount", "versionCount", "versionOfCount", "created", "registered", "published", "updated"
     # "publicationYear", "subjects",
 
-    def __init__(self, input_dir, output_dir, interval, citing_map_dir,  testing=False):
+    # size in bytes of the shards in which the ndjson files are split when using more than one worker, so
+    # that also a dump consisting of a single file can be processed in parallel
+    _shard_size = 2 ** 26
+
+    def __init__(self, input_dir, output_dir, interval, citing_map_dir,  testing=False, read_size=None, workers=1, shard_size=None, **params):
         if testing:
             self._redis_db = self.BR_redis_test
             self._redis_db_ra = self.RA_redis_test
         else:
             self._redis_db = self.BR_redis
             self._redis_db_ra = self.RA_redis
+        super(DatacitePreProcessing, self).__init__(**params)
         self._doi_manager = DOIManager()
         self._issn_manager = ISSNManager()
         self._isbn_manager = ISBNManager()
@@ -68,170 +69,184 @@ class DatacitePreProcessing(Preprocessing):
         self._citing_file_dir = citing_map_dir
         if not exists(self._citing_file_dir):
             makedirs(self._citing_file_dir)
-        self._dir_to_compr = os.path.join(self._citing_file_dir, "dir_to_compr")
-        if not exists(self._dir_to_compr):
-            makedirs(self._dir_to_compr)
         self._needed_info = ["relationType", "relatedIdentifierType", "relatedIdentifier"]
         self._id_man_dict = {"doi":self._doi_manager, "pmcid": self._pmcid_manager, "pmid":self._pmid_manager, "wikidata": self._wikidata_manager, "ror": self._ror_manager, "issn": self._issn_manager, "viaf": self._viaf_manager, "isbn": self._isbn_manager, "orcid": self._orcid_manager}
 
         self._interval = interval
+        if read_size:
+            self._read_size = read_size
+        # number of processes used for processing the input ndjson files in split_input
+        self._workers = workers
+        if shard_size:
+            self._shard_size = shard_size
         self._cites_filter = ["references", "cites"]
         self._citedby_filter = ["isreferencedby", "iscitedby"]
         self._csv_col = ["citing", "referenced"]
-        self.zip_filepath = self.create_citing_map()
-        self.citing_id_index = CSVManager(self.zip_filepath)
-        super(DatacitePreProcessing, self).__init__()
+        if not self._single_pass:
+            self.citing_id_index = self.create_citing_map()
+
+    def get_record_source(self):
+        """This method returns the source of the json objects stored in the lines of the DataCite ndjson files.
+        Each line is decoded once, and the malformed ones are reported and skipped. In parallel mode, the files
+        are split in shards of about _shard_size bytes."""
+        return self.record_source(self._input_dir, self._req_type, "ndjson", shard_size=self._shard_size, skip_invalid=True)
+
+    def get_citing_ids(self, linedict):
+        """This method returns the list of the normalised DOIs of the entities stored in the json object in input,
+        in order to build the citing map."""
+        citing_ids = []
+        if linedict:
+            for e in linedict["data"]:
+                if 'id' not in e or 'type' not in e:
+                    continue
+                doi_entity = self.normalise_id(self._doi_manager, e['id'], include_prefix=False)
+                if doi_entity:
+                    citing_ids.append(doi_entity)
+        return citing_ids
 
     def create_citing_map(self):
-        data = []
-        count = 0
-        filecount = 0
-
-        all_files, targz_fd = self.get_all_files(self._input_dir, self._req_type)
-        for file_idx, file in enumerate(tqdm(all_files), 1):
-            f = open(file, encoding="utf8")
-            for line in tqdm(f):
-                if line:
-                    try:
-                        linedict = json.loads(line)
-                    except:
-                        print(ValueError, line)
-                        continue
-                    if linedict:
-                        d = linedict["data"]
-                        for e in d:
-                            if 'id' not in e or 'type' not in e:
-                                continue
-                            doi_entity = self._doi_manager.normalise(e['id'])
-                            if doi_entity:
-                                data.append(doi_entity)
-                                count += 1
-                                if count == 1000:
-                                    # List that we want to add as a new row
-                                    rows_to_append = [[x]for x in data]
-                                    # Open our existing CSV file in append mode
-                                    # Create a file object for this file
-                                    with open(os.path.join(self._dir_to_compr, str(filecount)+".csv"), 'w') as f_object:
-                                        # Pass this file object to csv.writer()
-                                        # and get a writer object
-                                        writer_object = csv.writer(f_object)
-                                        writer_object.writerow(["id"])
-                                        # Pass the list as an argument into
-                                        # the writerow()
-                                        writer_object.writerows(rows_to_append)
-                                        # Close the file object
-                                        f_object.close()
-
-                                    filecount += 1
-                                    count = 0
-                                    data = []
-            if data:
-                rows_to_append = [[x] for x in data]
-                with open(os.path.join(self._dir_to_compr, str(filecount+1)+".csv"), 'w') as f_object:
-                    # Pass this file object to csv.writer()
-                    # and get a writer object
-                    writer_object = csv.writer(f_object)
-                    writer_object.writerow(["id"])
-                    # Pass the list as an argument into
-                    # the writerow()
-                    writer_object.writerows(rows_to_append)
-                    # Close the file object
-                    f_object.close()
-            f.close()
-            print("citing index: created")
-            shutil.make_archive(os.path.join(self._citing_file_dir, "zip_citing_map"), 'zip', self._dir_to_compr)
-            print("citing index: compressed")
-            shutil.rmtree(self._dir_to_compr)
-            compressed_filepath = os.path.join(self._citing_file_dir, "zip_citing_map.zip")
-            return compressed_filepath
-
+        """This method builds the index of the DOIs of the citing entities of the dump (see build_citing_map)."""
+        return self.build_citing_map(self.get_record_source())
+
+    def process_record(self, linedict):
+        processed_entities = []
+
+        # PROCESS START (on entities)
+        if linedict:
+            d = linedict["data"]
+            for e in d:
+                if 'id' not in e or 'type' not in e:
+                    continue
+                doi_entity = self.normalise_id(self._doi_manager, e['id'], include_prefix=False)
+                if doi_entity:
+                    if e['type'] == "dois":
+                        attributes = e["attributes"]
+
+                        # add k,v pairs which do not need to be modified: "titles", "publicationYear",
+                        # "dates", "types", "updated", "publisher"
+                        processed_entity = {k:v for k,v in e.get("attributes").items() if k in self._entity_keys_to_keep}
+
+                        # add an updated version of the k,v pairs which needs some check or validation
+                        #doi
+                        processed_entity["doi"] = doi_entity
+
+                        # relatedIdentifiers
+                        rel_ids = attributes.get("relatedIdentifiers")
+                        if rel_ids:
+
+                            cites_ents, citedby_ents, rel_container = self.to_validated_id_list(rel_ids, "related_ids")
+
+                            # In order to avoid validating data for entities which are not going to be included
+                            # because they are not involved in any citations, the related identifiers are
+                            # checked first, and the process prosecutes only if any related id was found.
+                            if cites_ents or citedby_ents:
+                                valid_rel_id_dict = dict()
+                                valid_rel_id_dict["Cites"] = cites_ents
+                                valid_rel_id_dict["IsCitedBy"] = citedby_ents
+                                valid_rel_id_dict["IsPartOf"] = rel_container
+                                processed_entity["relatedIdentifiers"] = valid_rel_id_dict
+
+                                # contributors
+                                contribs = attributes.get("contributors")
+                                processed_contribs =[]
+                                if contribs:
+                                    processed_contribs = self.to_validated_id_list(contribs, "contributors")
+                                processed_entity["contributors"] = processed_contribs
+
+                                # creators
+                                creators = attributes.get("creators")
+                                processed_creators =[]
+                                if creators:
+                                    processed_creators = self.to_validated_id_list(creators, "creators")
+                                processed_entity["creators"] = processed_creators
+
+                                # identifiers
+                                ids = attributes.get("identifiers")
+                                processed_ids = []
+                                if ids:
+                                    processed_ids = self.to_validated_id_list(ids, "identifiers")
+                                processed_entity["identifiers"] = processed_ids
+
+                                # container
+                                container = attributes.get("container") #one dict
+                                processed_container = dict()
+                                if container:
+                                    processed_container = self.to_validated_id_list([container], "container")
+                                processed_entity["container"] = processed_container
+
+                                processed_entities.append(processed_entity)
+        return processed_entities
+
+    def get_prefetch_ids(self, linedict):
+        """This method returns the normalised related identifiers, identifiers and container identifiers of the
+        entities stored in the json object in input, and the normalised name identifiers of their contributors and
+        creators, which are looked up in redis while processing them (see prefetched)."""
+        br_ids = []
+        ra_ids = []
+        for e in (linedict or dict()).get("data", []):
+            if 'id' not in e or e.get('type') != "dois" or not e.get("attributes"):
+                continue
+            attributes = e["attributes"]
+            if not attributes.get("relatedIdentifiers") or not self.normalise_id(self._doi_manager, e['id'], include_prefix=False):
+                continue
+            candidates = [(ref.get("relatedIdentifierType"), ref.get("relatedIdentifier"), br_ids)
+                          for ref in attributes["relatedIdentifiers"] if all(ref.get(elem) for elem in self._needed_info)]
+            candidates.extend((c.get("identifierType"), c.get("identifier"), br_ids) for c in attributes.get("identifiers") or [])
+            if attributes.get("container"):
+                candidates.append((attributes["container"].get("identifierType"), attributes["container"].get("identifier"), br_ids))
+            for agent in (attributes.get("contributors") or []) + (attributes.get("creators") or []):
+                candidates.extend((nid.get("nameIdentifierScheme"), nid.get("nameIdentifier"), ra_ids)
+                                  for nid in agent.get("nameIdentifiers") or [])
+            for schema, id, id_list in candidates:
+                if not schema or not id:
+                    continue
+                schema = str(schema).lower().strip()
+                if schema not in (self._accepted_ids_ra if id_list is ra_ids else self._accepted_ids):
+                    continue
+                id_man = self.get_id_manager(schema, self._id_man_dict)
+                if id_man:
+                    norm_id = self.normalise_id(id_man, str(id))
+                    if norm_id:
+                        id_list.append(norm_id)
+        return br_ids, ra_ids
+
+    def resolve_deferred_ids(self, entity):
+        """This method validates the related identifiers and the container identifier of an entity processed in
+        single pass mode, discarding the entity if it is not involved in any citation (see iter_single_pass). In
+        deferred validation mode, the name identifiers of its contributors and creators and its other identifiers
+        are validated too."""
+        rel_ids = entity["relatedIdentifiers"]
+        for relation in ("Cites", "IsCitedBy", "IsPartOf"):
+            rel_ids[relation] = [x for x in rel_ids[relation] if self.is_valid_deferred_id(x)]
+        if not rel_ids["Cites"] and not rel_ids["IsCitedBy"]:
+            return []
+        container = entity["container"]
+        if container.get("identifier") and not self.is_valid_deferred_id(container["identifier"][0]):
+            container["identifier"] = []
+        for agent in entity["contributors"] + entity["creators"]:
+            agent["nameIdentifiers"] = [x for x in agent["nameIdentifiers"] if self.is_valid_provisional_id(x)]
+        entity["identifiers"] = [x for x in entity["identifiers"] if self.is_valid_provisional_id(x)]
+        return [entity]
 
     def split_input(self):
 
-        all_files, targz_fd = self.get_all_files(self._input_dir, self._req_type)
         data = []
         count = 0
 
         # PROCESS START (on files)
-        for file_idx, file in enumerate(tqdm(all_files), 1):
-            f = open(file, encoding="utf8")
-            for line in tqdm(f):
-                if line:
-                    try:
-                        linedict = json.loads(line)
-                    except:
-                        print(ValueError, line)
-                        continue
-
-                    # PROCESS START (on entities)
-                    if linedict:
-                        d = linedict["data"]
-                        for e in d:
-                            if 'id' not in e or 'type' not in e:
-                                continue
-                            doi_entity = self._doi_manager.normalise(e['id'])
-                            if doi_entity:
-                                if e['type'] == "dois":
-                                    attributes = e["attributes"]
-
-                                    # add k,v pairs which do not need to be modified: "titles", "publicationYear",
-                                    # "dates", "types", "updated", "publisher"
-                                    processed_entity = {k:v for k,v in e.get("attributes").items() if k in self._entity_keys_to_keep}
-
-                                    # add an updated version of the k,v pairs which needs some check or validation
-                                    #doi
-                                    processed_entity["doi"] = doi_entity
-
-                                    # relatedIdentifiers
-                                    rel_ids = attributes.get("relatedIdentifiers")
-                                    if rel_ids:
-
-                                        cites_ents, citedby_ents, rel_container = self.to_validated_id_list(rel_ids, "related_ids")
-
-                                        # In order to avoid validating data for entities which are not going to be included
-                                        # because they are not involved in any citations, the related identifiers are
-                                        # checked first, and the process prosecutes only if any related id was found.
-                                        if cites_ents or citedby_ents:
-                                            valid_rel_id_dict = dict()
-                                            valid_rel_id_dict["Cites"] = cites_ents
-                                            valid_rel_id_dict["IsCitedBy"] = citedby_ents
-                                            valid_rel_id_dict["IsPartOf"] = rel_container
-                                            processed_entity["relatedIdentifiers"] = valid_rel_id_dict
-
-                                            # contributors
-                                            contribs = attributes.get("contributors")
-                                            processed_contribs =[]
-                                            if contribs:
-                                                processed_contribs = self.to_validated_id_list(contribs, "contributors")
-                                            processed_entity["contributors"] = processed_contribs
-
-                                            # creators
-                                            creators = attributes.get("creators")
-                                            processed_creators =[]
-                                            if creators:
-                                                processed_creators = self.to_validated_id_list(creators, "creators")
-                                            processed_entity["creators"] = processed_creators
-
-                                            # identifiers
-                                            ids = attributes.get("identifiers")
-                                            processed_ids = []
-                                            if ids:
-                                                processed_ids = self.to_validated_id_list(ids, "identifiers")
-                                            processed_entity["identifiers"] = processed_ids
-
-                                            # container
-                                            container = attributes.get("container") #one dict
-                                            processed_container = dict()
-                                            if container:
-                                                processed_container = self.to_validated_id_list([container], "container")
-                                            processed_entity["container"] = processed_container
-
-                                            data.append(processed_entity)
-                                            count += 1
-                                            if int(count) != 0 and int(count) % int(self._interval) == 0:
-                                                data = self.splitted_to_file(count, data, ".ndjson")
-
-            f.close()
+        if self._single_pass:
+            processed = self.iter_single_pass()
+        elif self._deferred_validation:
+            processed = self.iter_deferred_validation(self.get_record_source())
+        else:
+            processed = self.iter_processed(self.get_record_source())
+        for processed_entities in tqdm(processed):
+            for processed_entity in processed_entities:
+                data.append(processed_entity)
+                count += 1
+                if int(count) != 0 and int(count) % int(self._interval) == 0:
+                    data = self.splitted_to_file(count, data, ".ndjson")
+
         if len(data) > 0:
             count = count + (self._interval - (int(count) % int(self._interval)))
             self.splitted_to_file(count, data, ".ndjson")
@@ -246,7 +261,7 @@ class DatacitePreProcessing(Preprocessing):
                     filename = filename[:-len(self._req_type)] + "_" + dt_string + self._req_type
                 with open(os.path.join(self._output_dir, filename), "w", encoding="utf8") as json_file:
                     # Concatenate dictionaries in list "data" with '\n' separator
-                    ndjson = '\n'.join([json.dumps(d, ensure_ascii=False) for d in data])
+                    ndjson = '\n'.join([json_dumps(d, ensure_ascii=False) for d in data])
                     # Write to file
                     json_file.write(ndjson)
                     json_file.close()
@@ -278,14 +293,10 @@ class DatacitePreProcessing(Preprocessing):
                                         id = nid.get("nameIdentifier")
                                         id_man = self.get_id_manager(schema, self._id_man_dict)
                                         if id_man:
-                                            norm_id = id_man.normalise(id, include_prefix=True)
+                                            norm_id = self.normalise_id(id_man, id)
                                             if norm_id:
-                                                if self._redis_db_ra.get(norm_id):
-                                                    norm_identifiers.append(norm_id)
-                                                elif id_man.is_valid(norm_id):
+                                                if self.validate_id(norm_id, id_man, self._redis_db_ra, citing_map=False):
                                                     norm_identifiers.append(norm_id)
-                                                else:
-                                                    pass
 
                     contrib_processed_dict = dict()
                     if process_type == "contributors":
@@ -310,14 +321,11 @@ class DatacitePreProcessing(Preprocessing):
                         id = c.get("identifier")
                         id_man = self.get_id_manager(schema, self._id_man_dict)
                         if id_man:
-                            norm_id = id_man.normalise(id, include_prefix=True)
+                            norm_id = self.normalise_id(id_man, id)
                             if norm_id:
-                                if self._redis_db.get(norm_id): #no check in processed dois index since we assume not to find a doi in this field
+                                #no check in processed dois index since we assume not to find a doi in this field
+                                if self.validate_id(norm_id, id_man, self._redis_db, citing_map=False):
                                     processed_list.append(norm_id)
-                                elif id_man.is_valid(norm_id):
-                                    processed_list.append(norm_id)
-                                else:
-                                    pass
 
             return processed_list
 
@@ -337,15 +345,9 @@ class DatacitePreProcessing(Preprocessing):
                         id = dict_input.get("identifier")
                         id_man = self.get_id_manager(schema, self._id_man_dict)
                         if id_man:
-                            norm_id = id_man.normalise(id, include_prefix=True)
+                            norm_id = self.normalise_id(id_man, id)
                             if norm_id:
-                                if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                                    processed_dict["identifier"] = [norm_id]
-                                    return processed_dict
-                                elif self._redis_db.get(norm_id):
-                                    processed_dict["identifier"] = [norm_id]
-                                    return processed_dict
-                                elif id_man.is_valid(norm_id):
+                                if self.validate_id(norm_id, id_man, self._redis_db):
                                     processed_dict["identifier"] = [norm_id]
                                     return processed_dict
                                 else:
@@ -366,6 +368,9 @@ class DatacitePreProcessing(Preprocessing):
             valid_id_list_citedby = []
             valid_id_container = []
 
+            # the ids are first associated with the list of the relation type, and then validated at once, so that
+            # the ones which are not in the citing dois index nor in redis db are validated concurrently
+            rel_ids = []
             for ref in id_dict_list:
                 if all(ref.get(elem) for elem in self._needed_info):
                     schema = (str(ref["relatedIdentifierType"])).lower().strip()
@@ -373,49 +378,21 @@ class DatacitePreProcessing(Preprocessing):
                     relationType = str(ref["relationType"]).lower().strip()
 
                     if id_man:
-                        norm_id = id_man.normalise(str(ref["relatedIdentifier"]), include_prefix=True)
+                        norm_id = self.normalise_id(id_man, str(ref["relatedIdentifier"]))
                         if norm_id:
                             if relationType == "references" or relationType == "cites":
-                                if norm_id not in valid_id_list_cites:
-                                    # check first if the id is in the citing dois index
-                                    if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                                        valid_id_list_cites.append(norm_id)
-                                    # check if the id is in redis db
-                                    elif self._redis_db.get(norm_id):
-                                        valid_id_list_cites.append(norm_id)
-                                    # if the id is not in redis db, validate it before appending
-                                    elif id_man.is_valid(norm_id):
-                                        valid_id_list_cites.append(norm_id)
-                                    else:
-                                        pass
-
+                                rel_ids.append((valid_id_list_cites, norm_id, id_man))
                             elif relationType == "isreferencedby" or relationType == "iscitedby":
-                                if norm_id not in valid_id_list_citedby:
-                                    # check first if the id is in the citing dois index
-                                    if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                                        valid_id_list_citedby.append(norm_id)
-                                    # check if the id is in redis db
-                                    elif self._redis_db.get(norm_id):
-                                        valid_id_list_citedby.append(norm_id)
-                                    # if the id is not in redis db, validate it before appending
-                                    elif id_man.is_valid(norm_id):
-                                        valid_id_list_citedby.append(norm_id)
-                                    else:
-                                        pass
-
+                                rel_ids.append((valid_id_list_citedby, norm_id, id_man))
                             elif relationType == "ispartof":
                                 if schema in self._accepted_ids_container:
-                                    if norm_id not in valid_id_container:
-                                        if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                                            valid_id_container.append(norm_id)
-                                        # check if the id is in redis db
-                                        elif self._redis_db.get(norm_id):
-                                            valid_id_container.append(norm_id)
-                                        # if the id is not in redis db, validate it before appending
-                                        elif id_man.is_valid(norm_id):
-                                            valid_id_container.append(norm_id)
-                                        else:
-                                            pass
+                                    rel_ids.append((valid_id_container, norm_id, id_man))
+
+            # check the citing dois index first, then redis db, then the API
+            valid_ids = self.validate_ids([(norm_id, id_man) for valid_list, norm_id, id_man in rel_ids], self._redis_db)
+            for (valid_list, norm_id, id_man), valid in zip(rel_ids, valid_ids):
+                if valid and norm_id not in valid_list:
+                    valid_list.append(norm_id)
 
             return valid_id_list_cites, valid_id_list_citedby, valid_id_container
 
@@ -435,11 +412,17 @@ if __name__ == '__main__':
                             help='paremeter to define whether or not the script is executed in testing modality')
     arg_parser.add_argument('-t', '--testing', dest='testing', required=False, type=bool, default=False,
                             help='paremeter to define whether or not the script is executed in testing modality')
-
+    arg_parser.add_argument('-w', '--workers', dest='workers', required=False, type=int, default=1,
+                            help='Number of processes used for processing the input ndjson files')
+    arg_parser.add_argument('-ss', '--shard_size', dest='shard_size', required=False, type=int, default=None,
+                            help='size in bytes of the parts of the input files processed by each worker')
+    arg_parser.add_argument('-rs', '--read_size', dest='read_size', required=False, type=int, default=None,
+                            help='size in bytes of the read buffer used to decompress the zst input file')
+    DatacitePreProcessing.add_arguments(arg_parser)
     args = arg_parser.parse_args()
 
 
-    dcpp = DatacitePreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number,citing_map_dir=args.citing_map_dir,testing=args.testing)
+    dcpp = DatacitePreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number,citing_map_dir=args.citing_map_dir,testing=args.testing, read_size=args.read_size, workers=args.workers, shard_size=args.shard_size, **DatacitePreProcessing.get_options(args))
     dcpp.split_input()
 
     # HOW TO RUN (example: preprocess) % python -m preprocessing.datacite -in "/Volumes/T7_Touch/LAVORO/DOCI/dump2022/datacite_dump_20221118.ndjson.zst" -out "/Volumes/T7_Touch/test_preprocess_datacite" -n 100 -t True
\ No newline at end of file
@@ -0,0 +1,68 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+from preprocessing.datasource.datasource import DataSource
+
+
+class BloomFilterDataSource(DataSource):
+    """This class wraps a data source (e.g.: a RedisDataSource) with a Bloom filter of its keys, so that the
+    keys which are certainly not stored in it are answered without querying the data source. The filter must
+    have been built from the current keys of the data source (see BloomFilter.from_keys): the keys set through
+    this class are added to it, while the ones set directly in the data source are not."""
+
+    def __init__(self, data_source, bloom_filter):
+        super().__init__(getattr(data_source, "_service", None))
+        self._data_source = data_source
+        self._bloom_filter = bloom_filter
+
+    def reset_connections(self):
+        if hasattr(self._data_source, "reset_connections"):
+            self._data_source.reset_connections()
+
+    def get(self, resource_id):
+        if resource_id not in self._bloom_filter:
+            return None
+        return self._data_source.get(resource_id)
+
+    def mget(self, resources_id):
+        result = {resource_id: None for resource_id in resources_id}
+        to_get = [resource_id for resource_id in resources_id if resource_id in self._bloom_filter]
+        if to_get:
+            values = self._data_source.mget(to_get)
+            # the mget of a redis client returns the list of the values
+            result.update(values if isinstance(values, dict) else zip(to_get, values))
+        return result
+
+    def exists(self, resource_id):
+        return resource_id in self._bloom_filter and bool(self._data_source.exists(resource_id))
+
+    def exists_many(self, resources_id):
+        result = {resource_id: False for resource_id in resources_id}
+        to_check = [resource_id for resource_id in resources_id if resource_id in self._bloom_filter]
+        if to_check:
+            if hasattr(self._data_source, "exists_many"):
+                result.update(self._data_source.exists_many(to_check))
+            else:
+                result.update((k, v is not None) for k, v in zip(to_check, self._data_source.mget(to_check)))
+        return result
+
+    def set(self, resource_id, value):
+        self._bloom_filter.add(resource_id)
+        return self._data_source.set(resource_id, value)
+
+    def mset(self, resources):
+        for resource_id in resources:
+            self._bloom_filter.add(resource_id)
+        return self._data_source.mset(resources)
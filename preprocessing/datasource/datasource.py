@@ -37,4 +37,13 @@ class DataSource(metaclass=ABCMeta):
 
     @abstractmethod
     def mset(self, resources):
-        pass
\ No newline at end of file
+        pass
+
+    def exists(self, resource_id):
+        """This method returns True if a value is stored for the resource in input, and False otherwise."""
+        return self.get(resource_id) is not None
+
+    def exists_many(self, resources_id):
+        """This method returns a dictionary associating each resource in input with True if a value is stored
+        for it, and with False otherwise."""
+        return {k: v is not None for k, v in self.mget(resources_id).items()}
@@ -0,0 +1,89 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+from preprocessing.datasource.datasource import DataSource
+
+
+class PrefetchDataSource(DataSource):
+    """This class wraps a data source (e.g.: a RedisDataSource) so that the existence of a group of resources can
+    be checked at once (see prefetch), before checking them one at a time with exists. The results, including
+    the missing resources, are kept until the next call of prefetch or clear, and exists falls back on the data
+    source for the resources which were not prefetched. The other attributes (e.g.: the delete method of a
+    redis client) are the ones of the wrapped data source."""
+
+    def __init__(self, data_source, on_change=None):
+        super().__init__(getattr(data_source, "_service", None))
+        self._data_source = data_source
+        self._prefetched = dict()
+        # function called with each resource set or deleted through this class, e.g. for invalidating a cache
+        self._on_change = on_change
+
+    def _changed(self, resources_id):
+        for resource_id in resources_id:
+            self._prefetched.pop(resource_id, None)
+            if self._on_change is not None:
+                self._on_change(resource_id)
+
+    def __getattr__(self, name):
+        if name == "_data_source":
+            raise AttributeError(name)
+        return getattr(self._data_source, name)
+
+    def reset_connections(self):
+        if hasattr(self._data_source, "reset_connections"):
+            self._data_source.reset_connections()
+
+    def prefetch(self, resources_id):
+        """This method checks with a single request the existence of the resources in input (see
+        exists_many)."""
+        self._prefetched = dict()
+        if resources_id:
+            self._prefetched = self.exists_many(list(resources_id))
+
+    def clear(self):
+        self._prefetched = dict()
+
+    def exists(self, resource_id):
+        if resource_id in self._prefetched:
+            return self._prefetched[resource_id]
+        return bool(self._data_source.exists(resource_id))
+
+    def exists_many(self, resources_id):
+        if hasattr(self._data_source, "exists_many"):
+            return self._data_source.exists_many(resources_id)
+        # the data source is a redis client, whose mget returns the list of the values
+        return {k: v is not None for k, v in zip(resources_id, self._data_source.mget(resources_id))}
+
+    def get(self, resource_id):
+        return self._data_source.get(resource_id)
+
+    def mget(self, resources_id):
+        values = self._data_source.mget(resources_id)
+        # the mget of a redis client returns the list of the values
+        if not isinstance(values, dict):
+            values = dict(zip(resources_id, values))
+        return values
+
+    def set(self, resource_id, value):
+        self._changed([resource_id])
+        return self._data_source.set(resource_id, value)
+
+    def mset(self, resources):
+        self._changed(resources)
+        return self._data_source.mset(resources)
+
+    def delete(self, *resources_id):
+        self._changed(resources_id)
+        return self._data_source.delete(*resources_id)
@@ -27,27 +27,76 @@ conf_file = join(cur_path, "config.ini")
 config.read(conf_file)
 
 
+
+def _config_value(key, cast=str):
+    """This function returns the value of the key in input of the redis section of the configuration file,
+    converted with cast, or None if it is missing or empty."""
+    value = config.get('redis', key, fallback=None)
+    if value is None or not value.strip():
+        return None
+    if cast is bool:
+        return value.strip().lower() in {"true", "yes", "1"}
+    return cast(value)
+
+
+# the sections of the configuration file of the META redis databases
+_databases = {"DB-META-RA": "database 0", "DB-META-BR": "database 1"}
+
+
+def _connection_pool(client, service, host=None, port=None, unix_socket_path=None, max_connections=None,
+                     socket_timeout=None, socket_connect_timeout=None, socket_keepalive=None):
+    """This function returns a connection pool of the redis client module in input (either redis or redis.asyncio)
+    for the META database of the service in input, connecting either to a unix domain socket or to host and
+    port. Each setting not passed in input is read from the redis section of config.ini."""
+    if service not in _databases:
+        raise ValueError
+    params = {
+        "db": int(config.get(_databases[service], 'db')),
+        "password": None,
+        "decode_responses": True,
+        "max_connections": max_connections or _config_value('max_connections', int),
+        "socket_timeout": socket_timeout or _config_value('socket_timeout', float),
+        "socket_connect_timeout": socket_connect_timeout or _config_value('socket_connect_timeout', float)
+    }
+    unix_socket_path = unix_socket_path or _config_value('unix_socket_path')
+    if unix_socket_path:
+        return client.ConnectionPool(connection_class=client.UnixDomainSocketConnection, path=unix_socket_path, **params)
+    return client.ConnectionPool(
+        host=host or _config_value('host') or '127.0.0.1',
+        port=port or int(config.get('redis', 'port')),
+        socket_keepalive=_config_value('socket_keepalive', bool) if socket_keepalive is None else socket_keepalive,
+        **params)
+
+
 class RedisDataSource(DataSource):
-    def __init__(self, service):
+    """This class gives access to one of the META redis databases. The connections are taken from a pool,
+    which connects either to a unix domain socket or to host and port, with the timeouts and the keepalive
+    specified. Each setting not passed to the constructor is read from the redis section of config.ini."""
+
+    def __init__(self, service, host=None, port=None, unix_socket_path=None, max_connections=None,
+                 socket_timeout=None, socket_connect_timeout=None, socket_keepalive=None, batch_size=None,
+                 connection_pool=None):
         super().__init__(service)
-        if service == "DB-META-RA":
-            self._r =  redis.Redis(
-                            host='127.0.0.1',
-                            port=int(config.get('redis', 'port')),
-                            db=(config.get('database 0', 'db')),
-                            password=None,
-                            decode_responses=True
-                        )
-        elif service == "DB-META-BR":
-            self._r = redis.Redis(
-                    host='127.0.0.1',
-                    port=int(config.get('redis', 'port')),
-                    db=(config.get('database 1', 'db')),
-                    password=None,
-                    decode_responses=True
-                )
-        else:
+        if service not in _databases:
             raise ValueError
+        # number of keys looked up by each command of the pipelines of get_many and exists_many
+        self._batch_size = batch_size or _config_value('batch_size', int) or 10000
+        if connection_pool is None:
+            connection_pool = _connection_pool(redis, service, host, port, unix_socket_path, max_connections,
+                                               socket_timeout, socket_connect_timeout, socket_keepalive)
+        self._r = redis.Redis(connection_pool=connection_pool)
+
+    def reset_connections(self):
+        """This method closes the connections of the pool, e.g. after the process has been forked."""
+        self._r.connection_pool.reset()
+
+    def iter_keys(self, count=10000):
+        """This method yields all the keys of the database, scanning it in steps of count keys."""
+        return self._r.scan_iter(count=count)
+
+    def size(self):
+        """This method returns the number of keys of the database."""
+        return self._r.dbsize()
 
     def get(self, resource_id):
         redis_data = self._r.get(resource_id)
@@ -61,6 +110,29 @@ class RedisDataSource(DataSource):
             for i, v in enumerate(self._r.mget(resources_id))
         }
 
+    def get_many(self, resources_id):
+        """This method returns a dictionary associating each id in input with the value stored for it, or with
+        None if it is not stored. The ids are retrieved in groups of _batch_size ids, with a single pipeline."""
+        resources_id = list(resources_id)
+        pipe = self._r.pipeline(transaction=False)
+        for i in range(0, len(resources_id), self._batch_size):
+            pipe.mget(resources_id[i:i + self._batch_size])
+        values = (v for batch in pipe.execute() for v in batch)
+        return {k: json.loads(v) if v is not None else None for k, v in zip(resources_id, values)}
+
+    def exists(self, resource_id):
+        """This method returns True if a value is stored for the id in input, without transferring it."""
+        return self._r.exists(resource_id) > 0
+
+    def exists_many(self, resources_id):
+        """This method returns a dictionary associating each id in input with True if a value is stored for it,
+        and with False otherwise. The ids are checked with a single pipeline, without transferring the values."""
+        resources_id = list(resources_id)
+        pipe = self._r.pipeline(transaction=False)
+        for resource_id in resources_id:
+            pipe.exists(resource_id)
+        return {k: bool(v) for k, v in zip(resources_id, pipe.execute())}
+
     def set(self, resource_id, value):
         return self._r.set(resource_id, json.dumps(value))
 
@@ -0,0 +1,105 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import json
+import asyncio
+import redis.asyncio
+from preprocessing.datasource.datasource import DataSource
+from preprocessing.datasource.redis import _connection_pool, _config_value, _databases
+
+
+class AsyncRedisDataSource(DataSource):
+    """This class gives access to one of the META redis databases as RedisDataSource does, but its methods are
+    coroutines, so that the lookups can be overlapped with other work (e.g.: parsing or API calls) in an asyncio
+    event loop. At most max_in_flight requests are sent at the same time: the others wait for a request to be
+    completed. The instances must be used within a single event loop, and closed with close."""
+
+    def __init__(self, service, max_in_flight=64, host=None, port=None, unix_socket_path=None, socket_timeout=None,
+                 socket_connect_timeout=None, socket_keepalive=None, batch_size=None, connection_pool=None):
+        super().__init__(service)
+        if service not in _databases:
+            raise ValueError
+        # maximum number of requests sent at the same time, which is also the size of the connection pool
+        self._max_in_flight = max_in_flight
+        # number of keys looked up by each request of mget and exists_many
+        self._batch_size = batch_size or _config_value('batch_size', int) or 10000
+        if connection_pool is None:
+            connection_pool = _connection_pool(redis.asyncio, service, host, port, unix_socket_path, max_in_flight,
+                                               socket_timeout, socket_connect_timeout, socket_keepalive)
+        self._r = redis.asyncio.Redis(connection_pool=connection_pool)
+        # the semaphore is created in the event loop of the first request
+        self._semaphore = None
+
+    def _in_flight(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        return self._semaphore
+
+    def reset_connections(self):
+        """This method closes the connections of the pool, e.g. after the process has been forked."""
+        self._r.connection_pool.reset()
+
+    async def close(self):
+        """This method closes the connections of the pool."""
+        await self._r.connection_pool.disconnect()
+
+    async def get(self, resource_id):
+        async with self._in_flight():
+            redis_data = await self._r.get(resource_id)
+        if redis_data is not None:
+            redis_data = json.loads(redis_data)
+        return redis_data
+
+    async def mget(self, resources_id):
+        """This method returns a dictionary associating each id in input with the value stored for it, or with
+        None if it is not stored. The ids are retrieved in groups of _batch_size ids, sent concurrently."""
+        resources_id = list(resources_id)
+
+        async def get_batch(batch):
+            async with self._in_flight():
+                return await self._r.mget(batch)
+
+        batches = [resources_id[i:i + self._batch_size] for i in range(0, len(resources_id), self._batch_size)]
+        values = (v for batch in await asyncio.gather(*(get_batch(b) for b in batches)) for v in batch)
+        return {k: json.loads(v) if v is not None else None for k, v in zip(resources_id, values)}
+
+    async def set(self, resource_id, value):
+        async with self._in_flight():
+            return await self._r.set(resource_id, json.dumps(value))
+
+    async def mset(self, resources):
+        async with self._in_flight():
+            return await self._r.mset({k: json.dumps(v) for k, v in resources.items()})
+
+    async def exists(self, resource_id):
+        """This method returns True if a value is stored for the id in input, without transferring it."""
+        async with self._in_flight():
+            return await self._r.exists(resource_id) > 0
+
+    async def exists_many(self, resources_id):
+        """This method returns a dictionary associating each id in input with True if a value is stored for it,
+        and with False otherwise. The ids are checked in groups of _batch_size ids, each one with a pipeline."""
+        resources_id = list(resources_id)
+
+        async def exists_batch(batch):
+            async with self._in_flight():
+                pipe = self._r.pipeline(transaction=False)
+                for resource_id in batch:
+                    pipe.exists(resource_id)
+                return await pipe.execute()
+
+        batches = [resources_id[i:i + self._batch_size] for i in range(0, len(resources_id), self._batch_size)]
+        results = (v for batch in await asyncio.gather(*(exists_batch(b) for b in batches)) for v in batch)
+        return {k: bool(v) for k, v in zip(resources_id, results)}
@@ -0,0 +1,128 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import mmap
+import math
+import struct
+from argparse import ArgumentParser
+import numpy as np
+from tqdm import tqdm
+from preprocessing.index.hashing import id_hash
+from preprocessing.datasource.redis import RedisDataSource
+
+# the header of the files storing a Bloom filter: a magic string, the number of bits, the number of
+# hashes and the number of items added
+_header = struct.Struct("<8sQQQ")
+_magic = b"OCBLOOM1"
+
+
+class BloomFilter(object):
+    """This class implements a Bloom filter over a set of identifiers, i.e. a bit array answering whether an
+    identifier is certainly not in the set or whether it may be in it, with a false positive rate chosen when
+    the filter is created. The positions of the bits of an identifier are computed by double hashing from its
+    64-bit hash (see id_hash), so that a filter can also be built from the hashes stored in a CitingIdIndex.
+    The filter can be saved to a file and loaded from it, in which case the bits are memory-mapped."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        if not 0 < error_rate < 1:
+            raise ValueError("The error rate of a Bloom filter must be between 0 and 1.")
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def from_hashes(cls, hashes, error_rate=0.001):
+        """This method returns a Bloom filter containing the identifiers whose 64-bit hashes (see id_hash)
+        are in the numpy array in input."""
+        bloom_filter = cls(len(hashes), error_rate)
+        bloom_filter.add_hashes(hashes)
+        return bloom_filter
+
+    @classmethod
+    def from_keys(cls, keys, capacity, error_rate=0.001):
+        """This method returns a Bloom filter sized for capacity items and containing the keys in input, which
+        can be either strings or bytes (e.g.: the keys of a redis database, see RedisDataSource.iter_keys)."""
+        bloom_filter = cls(capacity, error_rate)
+        for key in keys:
+            bloom_filter.add(key.decode("utf-8") if isinstance(key, bytes) else key)
+        return bloom_filter
+
+    @classmethod
+    def load(cls, path):
+        """This method loads a Bloom filter from the file in input, written with save. The file is mapped in
+        copy-on-write mode, so that the items added afterwards are not written to it."""
+        bloom_filter = cls.__new__(cls)
+        with open(path, "rb") as f:
+            magic, bloom_filter.num_bits, bloom_filter.num_hashes, bloom_filter.count = _header.unpack(f.read(_header.size))
+            if magic != _magic:
+                raise ValueError("The file %s does not contain a Bloom filter." % path)
+            bloom_filter._bits = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))[_header.size:]
+        return bloom_filter
+
+    def save(self, path):
+        """This method writes the Bloom filter to the file in input."""
+        with open(path, "wb") as f:
+            f.write(_header.pack(_magic, self.num_bits, self.num_hashes, self.count))
+            f.write(self._bits)
+
+    def __positions(self, cur_hash):
+        low = cur_hash & 0xFFFFFFFF
+        high = (cur_hash >> 32) | 1
+        return ((low + i * high) % self.num_bits for i in range(self.num_hashes))
+
+    def add_hash(self, cur_hash):
+        for pos in self.__positions(cur_hash):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def add_hashes(self, hashes):
+        """This method adds the identifiers whose 64-bit hashes are in the numpy array in input, in bulk."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        bits = np.frombuffer(self._bits, dtype=np.uint8)
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        for i in range(self.num_hashes):
+            pos = (low + np.uint64(i) * high) % np.uint64(self.num_bits)
+            np.bitwise_or.at(bits, pos >> np.uint64(3), (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+        self.count += len(hashes)
+
+    def add(self, id_string):
+        self.add_hash(id_hash(id_string))
+
+    def contains_hash(self, cur_hash):
+        bits = self._bits
+        for pos in self.__positions(cur_hash):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __contains__(self, id_string):
+        return self.contains_hash(id_hash(id_string))
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser('bloom.py', description='This script creates the Bloom filter of the keys of the META redis databases, '
+                                                       'used for skipping the redis lookups of the identifiers which are not stored in META')
+    arg_parser.add_argument('-out', '--output', dest='output', required=True,
+                            help='Path of the file where the Bloom filter is stored')
+    arg_parser.add_argument('-er', '--error_rate', dest='error_rate', required=False, type=float, default=0.001,
+                            help='False positive rate of the Bloom filter')
+    args = arg_parser.parse_args()
+    sources = [RedisDataSource("DB-META-BR"), RedisDataSource("DB-META-RA")]
+    keys = (key for source in sources for key in source.iter_keys())
+    bloom = BloomFilter.from_keys(tqdm(keys), sum(source.size() for source in sources), args.error_rate)
+    bloom.save(args.output)
@@ -0,0 +1,259 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import os
+import mmap
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists, getsize
+import numpy as np
+from preprocessing.index.hashing import id_hash
+from preprocessing.index.bloom import BloomFilter
+
+# the hashes and the offsets are stored as unsigned 64-bit little endian integers
+_index_dtype = np.dtype("<u8")
+# the lengths of the identifiers in the runs are stored as unsigned 32-bit little endian integers
+_length_dtype = np.dtype("<u4")
+
+
+def build_id_run(id_strings):
+    """This function returns the run of the identifiers in input, i.e. a tuple (hashes, data, lengths) where
+    hashes is the sorted array of the 64-bit hashes of the distinct identifiers (see id_hash), data are the
+    utf-8 encoded identifiers concatenated in the same order, and lengths is the array of their lengths in
+    bytes. The runs are merged in a CitingIdIndex by CitingIdIndexWriter.add_run."""
+    distinct_ids = list(dict.fromkeys(id_strings))
+    encoded = [id_string.encode("utf-8") for id_string in distinct_ids]
+    hashes = np.fromiter(map(id_hash, distinct_ids), dtype=np.uint64, count=len(distinct_ids))
+    order = np.argsort(hashes, kind="stable").tolist()
+    return (hashes[order], b"".join(encoded[i] for i in order),
+            np.fromiter((len(encoded[i]) for i in order), dtype=np.uint32, count=len(order)))
+
+
+def _merge_bucket(prefix):
+    # sorts the identifiers stored in the files of a bucket of CitingIdIndexWriter, removing the duplicated ones,
+    # and stores them in the '.merged' files of the bucket. It returns the number of identifiers stored
+    hashes = np.fromfile(prefix + ".hashes", dtype=_index_dtype)
+    lengths = np.fromfile(prefix + ".lengths", dtype=_length_dtype)
+    with open(prefix + ".ids", "rb") as f:
+        data = f.read()
+    offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    offsets = offsets.tolist()
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    keep = np.ones(len(order), dtype=bool)
+    # only the identifiers with the same hash of the previous one can be duplicates
+    same_hash = set()
+    last = -1
+    for i in (np.nonzero(sorted_hashes[1:] == sorted_hashes[:-1])[0] + 1).tolist():
+        if i - 1 != last:
+            j = int(order[i - 1])
+            same_hash = {data[offsets[j]:offsets[j + 1]]}
+        j = int(order[i])
+        cur_id = data[offsets[j]:offsets[j + 1]]
+        if cur_id in same_hash:
+            keep[i] = False
+        same_hash.add(cur_id)
+        last = i
+    order = order[keep]
+    sorted_hashes[keep].astype(_index_dtype).tofile(prefix + ".merged.hashes")
+    lengths[order].astype(_length_dtype).tofile(prefix + ".merged.lengths")
+    with open(prefix + ".merged.ids", "wb") as f:
+        f.write(b"".join(data[offsets[j]:offsets[j + 1]] for j in order.tolist()))
+    for ext in (".hashes", ".lengths", ".ids"):
+        os.remove(prefix + ext)
+    return len(order)
+
+
+class CitingIdIndex(object):
+    """This class implements a compact on-disk index of the identifiers of the citing entities of a dump,
+    which can be queried without loading the identifiers in memory. The index consists of three files,
+    sharing the same path prefix:
+    - '.hashes': the sorted 64-bit hashes of the identifiers (see id_hash);
+    - '.ids': the utf-8 encoded identifiers, concatenated in the order of their hashes;
+    - '.offsets': the position of each identifier in the '.ids' file, plus the size of the file.
+    All the files are memory-mapped, so that they are shared across the worker processes and only the
+    pages needed by the lookups are loaded. An identifier is searched by binary search among the hashes
+    and, since different identifiers can have the same hash, it is then compared with the identifiers
+    stored in the '.ids' file, so that the lookups are exact. The index is built with CitingIdIndexWriter.
+    If the index has a Bloom filter (the '.bloom' file), the identifiers which are certainly not in the index
+    are discarded by checking a few bits, without searching the hashes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._hashes = self.__map_array(path + ".hashes")
+        self._offsets = self.__map_array(path + ".offsets")
+        self._ids = b""
+        if getsize(path + ".ids"):
+            with open(path + ".ids", "rb") as f:
+                self._ids = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bloom_filter = BloomFilter.load(path + ".bloom") if exists(path + ".bloom") else None
+
+    @staticmethod
+    def __map_array(path):
+        if getsize(path):
+            return np.memmap(path, dtype=_index_dtype, mode="r")
+        return np.empty(0, dtype=_index_dtype)
+
+    @staticmethod
+    def exists(path):
+        """This method returns True if all the files of the index with the path prefix in input exist."""
+        return all(exists(path + ext) for ext in (".hashes", ".offsets", ".ids"))
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, id_string):
+        cur_hash = id_hash(id_string)
+        if self._bloom_filter is not None and not self._bloom_filter.contains_hash(cur_hash):
+            return False
+        data = id_string.encode("utf-8")
+        i = int(np.searchsorted(self._hashes, np.uint64(cur_hash)))
+        while i < len(self._hashes) and self._hashes[i] == cur_hash:
+            if self._ids[self._offsets[i]:self._offsets[i + 1]] == data:
+                return True
+            i += 1
+        return False
+
+    def set_bloom_filter(self, error_rate):
+        """This method builds the Bloom filter of the index with the false positive rate in input from the hashes
+        of its identifiers, without reading them, or removes it if error_rate is None."""
+        bloom_path = self.path + ".bloom"
+        if error_rate:
+            BloomFilter.from_hashes(np.asarray(self._hashes), error_rate).save(bloom_path)
+            self._bloom_filter = BloomFilter.load(bloom_path)
+        else:
+            if exists(bloom_path):
+                os.remove(bloom_path)
+            self._bloom_filter = None
+
+    def get_value(self, id_string):
+        """This method returns True if the identifier in input is in the index, and None otherwise, so that
+        the index can be queried as the CSVManager previously used for storing the citing ids."""
+        if id_string in self:
+            return True
+        return None
+
+
+class CitingIdIndexWriter(object):
+    """This class builds a CitingIdIndex at the path prefix in input. The identifiers can be added either one
+    at a time (duplicates are allowed), or as runs built elsewhere (see build_id_run), e.g. by the processes
+    reading the input dump. The single identifiers are buffered and stored as runs of run_size identifiers.
+    The hash space is split in buckets (2 ** bucket_bits) and each run is appended to the temporary files of
+    the buckets of its hashes, so that only a run is kept in memory. When the writer is closed, each bucket is
+    sorted and its duplicated identifiers are removed, using worker processes if workers is greater than one,
+    and the index files are the concatenation of the buckets, since they store consecutive ranges of hashes.
+    If bloom_error_rate is specified, a Bloom filter of the identifiers with such false positive rate is
+    stored together with the index. The writer can be used as a context manager."""
+
+    def __init__(self, path, bloom_error_rate=None, workers=1, bucket_bits=6, run_size=2 ** 20):
+        self.path = path
+        self._bloom_error_rate = bloom_error_rate
+        self._workers = workers
+        self._bucket_bits = max(1, bucket_bits)
+        self._run_size = run_size
+        self._buffer = []
+        self._tmp_dir = path + ".tmp"
+        if exists(self._tmp_dir):
+            shutil.rmtree(self._tmp_dir)
+        os.makedirs(self._tmp_dir)
+        self._bucket_files = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__close_bucket_files()
+            shutil.rmtree(self._tmp_dir)
+
+    def __bucket_prefix(self, bucket):
+        return os.path.join(self._tmp_dir, str(bucket))
+
+    def __close_bucket_files(self):
+        for files in self._bucket_files.values():
+            for f in files:
+                f.close()
+        self._bucket_files = dict()
+
+    def add(self, id_string):
+        self._buffer.append(id_string)
+        if len(self._buffer) >= self._run_size:
+            self.flush()
+
+    def add_all(self, id_strings):
+        for id_string in id_strings:
+            self.add(id_string)
+
+    def flush(self):
+        """This method stores the identifiers added one at a time as a run."""
+        if self._buffer:
+            self.add_run(*build_id_run(self._buffer))
+            self._buffer = []
+
+    def add_run(self, hashes, data, lengths):
+        """This method stores a run of identifiers, as returned by build_id_run."""
+        if not len(hashes):
+            return
+        offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+        np.cumsum(lengths, out=offsets[1:])
+        buckets = hashes >> np.uint64(64 - self._bucket_bits)
+        bounds = np.searchsorted(buckets, np.arange((1 << self._bucket_bits) + 1, dtype=np.uint64)).tolist()
+        for bucket, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            if start == end:
+                continue
+            if bucket not in self._bucket_files:
+                prefix = self.__bucket_prefix(bucket)
+                self._bucket_files[bucket] = tuple(open(prefix + ext, "wb") for ext in (".hashes", ".ids", ".lengths"))
+            hashes_file, ids_file, lengths_file = self._bucket_files[bucket]
+            hashes_file.write(hashes[start:end].astype(_index_dtype).tobytes())
+            ids_file.write(data[int(offsets[start]):int(offsets[end])])
+            lengths_file.write(lengths[start:end].astype(_length_dtype).tobytes())
+
+    def close(self):
+        """This method writes the files of the index, and returns the number of identifiers stored."""
+        self.flush()
+        buckets = sorted(self._bucket_files)
+        self.__close_bucket_files()
+        prefixes = [self.__bucket_prefix(bucket) for bucket in buckets]
+        if self._workers > 1 and len(prefixes) > 1:
+            with ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context("fork")
+                                     if "fork" in multiprocessing.get_all_start_methods() else None) as executor:
+                counts = list(executor.map(_merge_bucket, prefixes))
+        else:
+            counts = [_merge_bucket(prefix) for prefix in prefixes]
+        size = 0
+        with open(self.path + ".hashes", "wb") as hashes_file, open(self.path + ".ids", "wb") as ids_file, \
+                open(self.path + ".offsets", "wb") as offsets_file:
+            offsets_file.write(np.zeros(1, dtype=_index_dtype).tobytes())
+            for prefix in prefixes:
+                with open(prefix + ".merged.hashes", "rb") as f:
+                    shutil.copyfileobj(f, hashes_file)
+                with open(prefix + ".merged.ids", "rb") as f:
+                    shutil.copyfileobj(f, ids_file)
+                offsets = np.cumsum(np.fromfile(prefix + ".merged.lengths", dtype=_length_dtype), dtype=np.uint64)
+                offsets_file.write((offsets + np.uint64(size)).astype(_index_dtype).tobytes())
+                if len(offsets):
+                    size += int(offsets[-1])
+        if self._bloom_error_rate:
+            BloomFilter.from_hashes(np.fromfile(self.path + ".hashes", dtype=_index_dtype),
+                                    self._bloom_error_rate).save(self.path + ".bloom")
+        elif exists(self.path + ".bloom"):
+            os.remove(self.path + ".bloom")
+        shutil.rmtree(self._tmp_dir)
+        return sum(counts)
@@ -1,19 +1,15 @@
 
-from preprocessing.base import Preprocessing
+from preprocessing.base import Preprocessing, json_dumps
 from os import makedirs
 from oc_idmanager.doi import DOIManager
 from oc_idmanager.issn import ISSNManager
 from preprocessing.identifier_manager.jid import JIDManager
 from os.path import exists
 import os
-import csv
-import shutil
 import datetime
-import json
 from tqdm import tqdm
 from datetime import datetime
 from argparse import ArgumentParser
-from oc_meta.lib.csvmanager import CSVManager
 
 class JalcPreProcessing(Preprocessing):
     _req_type = ".json"
@@ -21,12 +17,15 @@ class JalcPreProcessing(Preprocessing):
     _accepted_ids_venue = {"issn", "jid"}
     _entity_keys_to_discard = {"relation_list", "keyword_list", "sequence", "affiliation_list", "original_text", "url"}
     _entity_keys_to_update = {"citation_list", "creator_list", "journal_id_list"}
+    # number of json files sent at once to a worker process
+    _batch_size = 1000
 
-    def __init__(self, input_dir, output_dir, interval, citing_map_dir,  testing=False):
+    def __init__(self, input_dir, output_dir, interval, citing_map_dir,  testing=False, workers=1, batch_size=None, **params):
         if testing:
             self._redis_db = self.BR_redis_test
         else:
             self._redis_db = self.BR_redis
+        super(JalcPreProcessing, self).__init__(**params)
         self._input_dir = input_dir
         self._output_dir = output_dir
         if not exists(self._output_dir):
@@ -34,75 +33,37 @@ class JalcPreProcessing(Preprocessing):
         self._citing_file_dir = citing_map_dir
         if not exists(self._citing_file_dir):
             makedirs(self._citing_file_dir)
-        self._dir_to_compr = os.path.join(self._citing_file_dir, "dir_to_compr")
-        if not exists(self._dir_to_compr):
-            makedirs(self._dir_to_compr)
         self._n = interval
+        # number of processes used for processing the json files, both in create_citing_map and in split_input
+        self._workers = workers
+        if batch_size:
+            self._batch_size = batch_size
         self._doi_manager = DOIManager()
         self._issn_manager = ISSNManager()
         self._jid_manager = JIDManager()
         self._id_man_dict = {"doi" :self._doi_manager, "issn": self._issn_manager, "jid": self._jid_manager}
-        self.zip_filepath = self.create_citing_map()
-        self.citing_id_index = CSVManager(self.zip_filepath)
-        super(JalcPreProcessing, self).__init__()
+        if not self._single_pass:
+            self.citing_id_index = self.create_citing_map()
 
-    def create_citing_map(self):
-        data = []
-        count = 0
-        filecount = 0
+    def get_record_source(self):
+        """This method returns the source of the JaLC json files, each one storing a single entity. The
+        per-journal zip archives nested in the input are read in memory, without extracting them. In
+        parallel mode, the json files are sent to the worker processes in batches of _batch_size files."""
+        return self.record_source(self._input_dir, self._req_type, "json", nested=True, batch_size=self._batch_size)
 
-        all_files, targz_fd = self.get_all_files(self._input_dir, ".zip")
-        for i, el in enumerate(tqdm(all_files), 1):
-            if el:
-                all_files_unzipped, targz_fd_el = self.get_all_files(el, self._req_type)
-                for file_idx, file in enumerate(tqdm(all_files_unzipped), 1):
-                    f = open(file, encoding="utf-8")
-                    my_dict = json.load(f)
-                    obj = my_dict.get("data")
-                    if obj.get("doi"):
-                        doi_entity = self._doi_manager.normalise(obj['doi'])
-                        if doi_entity:
-                            data.append(doi_entity)
-                            count += 1
-                            if count == 1000:
-                                # List that we want to add as a new row
-                                rows_to_append = [[x]for x in data]
-                                # Open our existing CSV file in append mode
-                                # Create a file object for this file
-                                with open(os.path.join(self._dir_to_compr, str(filecount)+".csv"), 'w') as f_object:
-                                    # Pass this file object to csv.writer()
-                                    # and get a writer object
-                                    writer_object = csv.writer(f_object)
-                                    writer_object.writerow(["id"])
-                                    # Pass the list as an argument into
-                                    # the writerow()
-                                    writer_object.writerows(rows_to_append)
-                                    # Close the file object
-                                    f_object.close()
+    def get_citing_ids(self, my_dict):
+        """This method returns the list containing the normalised DOI of the entity in input, if any, in
+        order to build the citing map."""
+        obj = my_dict.get("data")
+        if obj.get("doi"):
+            doi_entity = self.normalise_id(self._doi_manager, obj['doi'], include_prefix=False)
+            if doi_entity:
+                return [doi_entity]
+        return []
 
-                                filecount += 1
-                                count = 0
-                                data = []
-                    f.close()
-        if data:
-            rows_to_append = [[x] for x in data]
-            with open(os.path.join(self._dir_to_compr, str(filecount+1)+".csv"), 'w') as f_object:
-                # Pass this file object to csv.writer()
-                # and get a writer object
-                writer_object = csv.writer(f_object)
-                writer_object.writerow(["id"])
-                # Pass the list as an argument into
-                # the writerow()
-                writer_object.writerows(rows_to_append)
-                # Close the file object
-                f_object.close()
-        print("citing index: created")
-        shutil.make_archive(os.path.join(self._citing_file_dir, "zip_citing_map"), 'zip', self._dir_to_compr)
-        print("citing index: compressed")
-        shutil.rmtree(self._dir_to_compr)
-        compressed_filepath = os.path.join(self._citing_file_dir, "zip_citing_map.zip")
-
-        return compressed_filepath
+    def create_citing_map(self):
+        """This method builds the index of the DOIs of the citing entities of the dump (see build_citing_map)."""
+        return self.build_citing_map(self.get_record_source())
 
     def to_validated_id_list(self, id_dict_list, process_type):
         if process_type == "venue":
@@ -114,66 +75,40 @@ class JalcPreProcessing(Preprocessing):
                         id = v.get("journal_id")
                         id_man = self.get_id_manager(schema, self._id_man_dict)
                         if id_man:
-                            norm_id = id_man.normalise(id, include_prefix=True)
-                            # check first if the id is in the citing dois mapping
-                            if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                                norm_identifiers.append(norm_id)
-                            # check if the id is in redis db
-                            elif self._redis_db.get(norm_id):
-                                norm_identifiers.append(norm_id)
-                            # if the id is not in redis db, validate it before appending
-                            elif id_man.is_valid(norm_id):
+                            norm_id = self.normalise_id(id_man, id)
+                            # check the citing dois mapping first, then redis db, then the API
+                            if self.validate_id(norm_id, id_man, self._redis_db):
                                 norm_identifiers.append(norm_id)
             return norm_identifiers
         if process_type == "citation":
             processed_list = []
-            norm_identifiers = []
-            for c in id_dict_list:
-                if c.get("doi"):
-                    schema = "doi"
-                    id = c.get("doi")
-                    id_man = self.get_id_manager(schema, self._id_man_dict)
-                    if id_man:
-                        norm_id = id_man.normalise(id, include_prefix=True)
-                        # check first if the doi is in the citing dois mapping
-                        if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                            norm_identifiers.append(norm_id)
-                        # check if the id is in redis db
-                        elif self._redis_db.get(norm_id):
-                            norm_identifiers.append(norm_id)
-                        # if the id is not in redis db, validate it before appending
-                        elif id_man.is_valid(norm_id):
-                            norm_identifiers.append(norm_id)
-                        if norm_id in norm_identifiers:
-                            citation_processed_dict = dict()
-                            citation_processed_dict["doi"] = norm_id
-                            citation_processed_dict.update({k: v for (k, v) in c.items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update and k not in
-                                                                {"doi"}})
-                            if c.get("creator_list"):
-                                cited_entities_creators = []
-                                for author in c.get("creator_list"):
-                                    creator = {k: v for (k, v) in author.items() if
-                                               k not in self._entity_keys_to_discard}
-                                    cited_entities_creators.append(creator)
-                                citation_processed_dict["creator_list"] = cited_entities_creators
-                            processed_list.append(citation_processed_dict)
-                        else:
-                            pass
+            id_man = self.get_id_manager("doi", self._id_man_dict)
+            citations = [(c, self.normalise_id(id_man, c.get("doi"))) for c in id_dict_list if c.get("doi")]
+            # check the citing dois mapping first, then redis db, then the API, validating the DOIs concurrently
+            valid_ids = self.validate_ids([(norm_id, id_man) for c, norm_id in citations], self._redis_db)
+            for (c, norm_id), valid in zip(citations, valid_ids):
+                if valid:
+                    citation_processed_dict = dict()
+                    citation_processed_dict["doi"] = norm_id
+                    citation_processed_dict.update({k: v for (k, v) in c.items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update and k not in
+                                                        {"doi"}})
+                    if c.get("creator_list"):
+                        cited_entities_creators = []
+                        for author in c.get("creator_list"):
+                            creator = {k: v for (k, v) in author.items() if
+                                       k not in self._entity_keys_to_discard}
+                            cited_entities_creators.append(creator)
+                        citation_processed_dict["creator_list"] = cited_entities_creators
+                    processed_list.append(citation_processed_dict)
             return processed_list
         # in this case id_dict_list is just a single doi
         if process_type == "citing_entity":
             schema = "doi"
             id_man = self.get_id_manager(schema, self._id_man_dict)
             if id_man:
-                norm_id = id_man.normalise(id_dict_list, include_prefix=True)
-                # check first if the doi is in the citing dois mapping
-                if self.citing_id_index.get_value(norm_id.split(":")[1]):
-                    return norm_id
-                # check if the id is in redis db
-                elif self._redis_db.get(norm_id):
-                    return norm_id
-                # if the id is not in redis db, validate it before appending
-                elif id_man.is_valid(norm_id):
+                norm_id = self.normalise_id(id_man, id_dict_list)
+                # check the citing dois mapping first, then redis db, then the API
+                if self.validate_id(norm_id, id_man, self._redis_db):
                     return norm_id
                 else:
                     return None
@@ -188,7 +123,7 @@ class JalcPreProcessing(Preprocessing):
                     filename = filename[:-len(".ndjson")] + "_" + dt_string + ".ndjson"
                 with open(os.path.join(self._output_dir, filename), "w", encoding="utf8") as f_out:
                     # Concatenate dictionaries in list "data" with '\n' separator
-                    json_str = '\n'.join([json.dumps(x, ensure_ascii=False) for x in data])
+                    json_str = '\n'.join([json_dumps(x, ensure_ascii=False) for x in data])
                     f_out.write(json_str)
                     f_out.close()
                 return []
@@ -197,56 +132,87 @@ class JalcPreProcessing(Preprocessing):
         else:
             return data
 
+    def process_record(self, my_dict):
+        d = my_dict.get("data")
+        # filtering out entities without citations
+        if "citation_list" in d:
+            cit_list = d["citation_list"]
+            cit_list_doi = [x for x in cit_list if x.get("doi")]
+            # filtering out entities with citations without dois
+            if cit_list_doi:
+                # citing_entity
+                citing_id_to_keep = self.to_validated_id_list(d.get("doi"), "citing_entity")
+                if citing_id_to_keep:
+                    # start creating reduced entity file
+                    entity_data = dict()
+                    entity_data["doi"] = citing_id_to_keep
+                    entity_data.update({k: v for (k, v) in d.items() if
+                                        k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update and k not in {
+                                            "doi"}})
+                    # journal_id_list
+                    if d.get("journal_id_list"):
+                        venues = d.get("journal_id_list")
+                        processed_venues = self.to_validated_id_list(venues, "venue")
+                        entity_data["journal_id_list"] = processed_venues
+                    # creator_list
+                    if d.get("creator_list"):
+                        entity_data["creator_list"] = []
+                        for x in d.get("creator_list"):
+                            creator = {k: v for (k, v) in x.items() if
+                                       k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
+                            entity_data["creator_list"].append(creator)
+                    # citation_list
+                    citations = d.get("citation_list")
+                    processed_citations = self.to_validated_id_list(citations, "citation")
+                    entity_data["citation_list"] = processed_citations
+
+                    return [entity_data]
+        return []
+
+    def get_prefetch_ids(self, my_dict):
+        """This method returns the normalised DOIs of the entity in input and of its citations, together with the
+        ids of its venue, which are looked up in redis while processing it (see prefetched)."""
+        br_ids = []
+        d = my_dict.get("data")
+        if "citation_list" in d and any(x.get("doi") for x in d["citation_list"]) and d.get("doi"):
+            doi_man = self.get_id_manager("doi", self._id_man_dict)
+            br_ids.append(self.normalise_id(doi_man, d["doi"]))
+            br_ids.extend(self.normalise_id(doi_man, c["doi"]) for c in d["citation_list"] if c.get("doi"))
+            for v in d.get("journal_id_list") or []:
+                schema = (v.get("type") or "").lower().strip()
+                if v.get("journal_id") and schema in self._accepted_ids_venue:
+                    id_man = self.get_id_manager(schema, self._id_man_dict)
+                    if id_man:
+                        br_ids.append(self.normalise_id(id_man, v["journal_id"]))
+        return [x for x in br_ids if x], []
+
+    def resolve_deferred_ids(self, entity_data):
+        """This method validates the DOIs of the entity processed in single pass mode and of its citations, together
+        with the ids of its venue (see iter_single_pass)."""
+        if not self.is_valid_deferred_id(entity_data["doi"]):
+            return []
+        if "journal_id_list" in entity_data:
+            entity_data["journal_id_list"] = [x for x in entity_data["journal_id_list"] if self.is_valid_deferred_id(x)]
+        entity_data["citation_list"] = [c for c in entity_data["citation_list"] if self.is_valid_deferred_id(c["doi"])]
+        return [entity_data]
+
     def split_input(self):
         # an empty list to store the filtered entities to be saved in the output files is created
         data = []
         count = 0
         # iterate over the input data
-        all_files, targz_fd = self.get_all_files(self._input_dir, ".zip")
-        for i, el in enumerate(tqdm(all_files), 1):
-            if el:
-                all_files_unzipped, targz_fd_el = self.get_all_files(el, self._req_type)
-                for file_idx, file in enumerate(tqdm(all_files_unzipped), 1):
-                    f = open(file, encoding="utf-8")
-                    my_dict = json.load(f)
-                    d = my_dict.get("data")
-                    # filtering out entities without citations
-                    if "citation_list" in d:
-                        cit_list = d["citation_list"]
-                        cit_list_doi = [x for x in cit_list if x.get("doi")]
-                        # filtering out entities with citations without dois
-                        if cit_list_doi:
-                            # citing_entity
-                            citing_id_to_keep = self.to_validated_id_list(d.get("doi"), "citing_entity")
-                            if citing_id_to_keep:
-                                # start creating reduced entity file
-                                entity_data = dict()
-                                entity_data["doi"] = citing_id_to_keep
-                                entity_data.update({k: v for (k, v) in d.items() if
-                                                    k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update and k not in {
-                                                        "doi"}})
-                                # journal_id_list
-                                if d.get("journal_id_list"):
-                                    venues = d.get("journal_id_list")
-                                    processed_venues = self.to_validated_id_list(venues, "venue")
-                                    entity_data["journal_id_list"] = processed_venues
-                                # creator_list
-                                if d.get("creator_list"):
-                                    entity_data["creator_list"] = []
-                                    for x in d.get("creator_list"):
-                                        creator = {k: v for (k, v) in x.items() if
-                                                   k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
-                                        entity_data["creator_list"].append(creator)
-                                # citation_list
-                                citations = d.get("citation_list")
-                                processed_citations = self.to_validated_id_list(citations, "citation")
-                                entity_data["citation_list"] = processed_citations
-
-                                data.append(entity_data)
-                                count += 1
-                                if int(count) != 0 and int(count) % int(self._n) == 0:
-                                    data = self.splitted_to_file(count, data, ".ndjson")
-                    f.close()
+        if self._single_pass:
+            processed = self.iter_single_pass()
+        elif self._deferred_validation:
+            processed = self.iter_deferred_validation(self.get_record_source())
+        else:
+            processed = self.iter_processed(self.get_record_source())
+        for processed_entities in tqdm(processed):
+            for entity_data in processed_entities:
+                data.append(entity_data)
+                count += 1
+                if int(count) != 0 and int(count) % int(self._n) == 0:
+                    data = self.splitted_to_file(count, data, ".ndjson")
         if len(data) > 0:
             count = count + (self._n - (int(count) % int(self._n)))
             self.splitted_to_file(count, data, ".ndjson")
@@ -268,7 +234,12 @@ if __name__ == '__main__':
     arg_parser.add_argument('-t', '--testing', dest='testing', required=False, type=bool, default=False,
                             help='paremeter to define whether or not the script is executed in testing modality')
 
+    arg_parser.add_argument('-w', '--workers', dest='workers', required=False, type=int, default=1,
+                            help='Number of processes used for processing the json files')
+    arg_parser.add_argument('-bs', '--batch_size', dest='batch_size', required=False, type=int, default=None,
+                            help='Number of json files sent at once to each worker process')
+    JalcPreProcessing.add_arguments(arg_parser)
     args = arg_parser.parse_args()
 
-    japp = JalcPreProcessing(input_dir=args.input, output_dir=args.output_g, interval=args.number,citing_map_dir=args.citing_map_dir, testing=args.testing)
+    japp = JalcPreProcessing(input_dir=args.input, output_dir=args.output_g, interval=args.number,citing_map_dir=args.citing_map_dir, testing=args.testing, workers=args.workers, batch_size=args.batch_size, **JalcPreProcessing.get_options(args))
     japp.split_input()
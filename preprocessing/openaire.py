@@ -1,11 +1,10 @@
 import gzip
-import json
 from os import makedirs
 import os
 from tqdm import tqdm
 import os.path
 from os.path import exists
-from preprocessing.base import Preprocessing
+from preprocessing.base import Preprocessing, RecordSource, json_dumps
 from oc_idmanager.doi import DOIManager
 from oc_idmanager.pmid import PMIDManager
 from oc_idmanager.pmcid import PMCIDManager
@@ -13,6 +12,26 @@ from datetime import datetime
 from argparse import ArgumentParser
 
 
+class ScholixSource(RecordSource):
+    """This class reads the scholix files stored in the tar archives of an OpenAIRE dump directory, in the
+    alphabetical order of the archives (the other entries of the directory are ignored). In order to process
+    them in parallel, each scholix file is yielded as the byte range it occupies in its archive (see
+    RecordSource.iter_tasks): the worker processes read the scholix files directly from the archives, and
+    the tar archives are not read twice."""
+
+    def _iter_sources(self):
+        for tar in sorted(x for x in os.listdir(self.path) if x.endswith(".tar")):
+            yield RecordSource(os.path.join(self.path, tar), self.req_type, self.record_type, read_size=self.read_size)
+
+    def iter_files(self):
+        for source in self._iter_sources():
+            yield from source.iter_files()
+
+    def iter_tasks(self):
+        for source in self._iter_sources():
+            yield from source.iter_tasks()
+
+
 class OpenirePreProcessing(Preprocessing):
     """This class aims at pre-processing OpenAire dumps.
     In particular, OpenairePreProcessing opens an input directory containing OpenAIRE TAR files, each
@@ -30,107 +49,138 @@ class OpenirePreProcessing(Preprocessing):
     _entity_keys_to_update = {"identifier", "creator", "publisher"}
 
 
-    def __init__(self, input_dir, output_dir, interval, testing=False):
+    def __init__(self, input_dir, output_dir, interval, testing=False, workers=1, read_size=None, max_open_tars=2, **params):
         if testing:
             self._redis_db = self.BR_redis_test
             self._redis_db_ra = self.RA_redis_test
         else:
             self._redis_db = self.BR_redis
             self._redis_db_ra = self.RA_redis
+        super(OpenirePreProcessing, self).__init__(**params)
         self._input_dir = input_dir
         self._output_dir = output_dir
         if not exists(self._output_dir):
             makedirs(self._output_dir)
         self._n = interval
+        # number of processes used for processing the scholix files of each tar in split_input
+        self._workers = workers
+        if read_size:
+            self._read_size = read_size
+        # maximum number of tar archives read at the same time by the worker processes
+        self._max_open_tars = max_open_tars
         self._doi_manager = DOIManager()
         self._pmid_manager = PMIDManager()
         self._pmc_manager = PMCIDManager()
         self._id_man_dict = {"doi":self._doi_manager, "pmid": self._pmid_manager, "pmc": self._pmc_manager}
 
-        super(OpenirePreProcessing, self).__init__()
+    def process_record(self, d):
+        if d:
+            type = (d.get("relationship")).get("name")
+
+            #filter out all duplicate citations expressed as received citations
+            if type == "Cites":
+
+                #instantiate the dict for storing reduced and validated version of the citation data
+                validated_dict = dict()
+
+                citing_data = d.get("source")
+                citing_ids = citing_data.get("identifier")
+                citing_ids_to_keep = []
+                for c_ing_id in citing_ids:
+
+                    # filter out all citing entity ids which are not managed by opencitations
+                    if c_ing_id.get("schema").strip().lower() in self._accepted_ids:
+                        citing_ids_to_keep.append(c_ing_id)
+                # filter out all citing entity ids which are not valid
+                citing_ids_to_keep = self.to_validated_id_list(citing_ids_to_keep, "citations")
+                if citing_ids_to_keep:
+
+                    cited_data = d.get("target")
+                    cited_ids = cited_data.get("identifier")
+                    cited_ids_to_keep = []
+                    for c_ed_id in cited_ids:
+                        if c_ed_id.get("schema").strip().lower() in self._accepted_ids:
+                            cited_ids_to_keep.append(c_ed_id)
+                    cited_ids_to_keep = self.to_validated_id_list(cited_ids_to_keep, "citations")
+
+                    if cited_ids_to_keep:
+                        # BUILD SOURCE
+                        citing_info = {k:v for (k,v) in d.get("source").items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
+                        citing_info["identifier"] = citing_ids_to_keep
+                        if d.get("source").get("publisher"):
+                            citing_info["publisher"] = [i for i in d.get("source").get("publisher")] # MODIFY IF IDS FOR RA ARE PROVIDED
+                        else:
+                            citing_info["publisher"] = []
+                        if d.get("source").get("creator"):
+                            citing_info["creator"] = [i for i in d.get("source").get("creator") ] # MODIFY IF IDS FOR RA ARE PROVIDED
+                        else:
+                            citing_info["creator"] = []
+
+                        #BUILD TARGET
+                        cited_info = {k:v for (k,v) in d.get("target").items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
+                        cited_info["identifier"] = cited_ids_to_keep
+                        if d.get("target").get("publisher"):
+                            cited_info["publisher"] = [i for i in d.get("target").get("publisher")] # MODIFY IF IDS FOR RA ARE PROVIDED
+                        else:
+                            cited_info["publisher"] = []
+                        if d.get("target").get("creator"):
+                            cited_info["creator"] = [i for i in d.get("target").get("creator") ] # MODIFY IF IDS FOR RA ARE PROVIDED
+                        else:
+                            cited_info["creator"] = []
+
+                        # 1 ADD "relationship" TO REDUCED ENTITY DICT
+                        validated_dict["relationship"] = d.get("relationship")
+                        # 2 ADD "source" TO REDUCED ENTITY DICT
+                        validated_dict["source"] = citing_info
+                        # 3 ADD "target" TO REDUCED ENTITY DICT
+                        validated_dict["target"] = cited_info
+
+                        return [validated_dict]
+        return []
+
+    def get_prefetch_ids(self, d):
+        """This method returns the normalised ids of the citing and cited entities of the citation in input, which
+        are looked up in redis while processing it (see prefetched)."""
+        br_ids = []
+        if d:
+            if (d.get("relationship")).get("name") == "Cites":
+                for ent in d.get("source").get("identifier") + d.get("target").get("identifier"):
+                    schema = ent.get("schema").strip().lower()
+                    if schema in self._accepted_ids:
+                        id_man = self.get_id_manager(schema, self._id_man_dict)
+                        if id_man:
+                            br_ids.append(self.normalise_id(id_man, ent.get("identifier")))
+        return [x for x in br_ids if x], []
+
+    def get_record_source(self):
+        """This method returns the source of the citations stored in the lines of the scholix files of the tar
+        archives of the input directory, each of which is decoded once. The lines of each scholix file are
+        decompressed as a stream, by using a buffer of _read_size bytes, so that the memory usage does not depend
+        on the file size."""
+        return ScholixSource(self._input_dir, self._req_type, "ndjson", read_size=self._read_size)
 
     def split_input(self):
+        """This method processes the scholix files of all the tar archives of the input directory. With more
+        than one worker, the scholix files are distributed across the worker processes, reading at most
+        _max_open_tars tar archives at the same time, and the output files are numbered as in a single
+        process run. The method returns the counts of the processed scholix lines and of the citations
+        stored in the output files."""
         data = []
         count = 0
-        # Iterate over each tar in the directory
-        for tar in tqdm(os.listdir(self._input_dir)):
-            all_files, targz_fd = self.get_all_files(os.path.join(self._input_dir,tar), self._req_type)
-            for file_idx, file in enumerate(tqdm(all_files), 1):
-                f = gzip.open(file, 'rb')
-                file_content = f.readlines()  # list
-
-                for entity in tqdm(file_content):
-                    if entity:
-                        d = json.loads(entity.decode('utf-8'))
-                        type = (d.get("relationship")).get("name")
-
-                        #filter out all duplicate citations expressed as received citations
-                        if type == "Cites":
-
-                            #instantiate the dict for storing reduced and validated version of the citation data
-                            validated_dict = dict()
-
-                            citing_data = d.get("source")
-                            citing_ids = citing_data.get("identifier")
-                            citing_ids_to_keep = []
-                            for c_ing_id in citing_ids:
-
-                                # filter out all citing entity ids which are not managed by opencitations
-                                if c_ing_id.get("schema").strip().lower() in self._accepted_ids:
-                                    citing_ids_to_keep.append(c_ing_id)
-                            # filter out all citing entity ids which are not valid
-                            citing_ids_to_keep = self.to_validated_id_list(citing_ids_to_keep, "citations")
-                            if citing_ids_to_keep:
-
-                                cited_data = d.get("target")
-                                cited_ids = cited_data.get("identifier")
-                                cited_ids_to_keep = []
-                                for c_ed_id in cited_ids:
-                                    if c_ed_id.get("schema").strip().lower() in self._accepted_ids:
-                                        cited_ids_to_keep.append(c_ed_id)
-                                cited_ids_to_keep = self.to_validated_id_list(cited_ids_to_keep, "citations")
-
-                                if cited_ids_to_keep:
-                                    # BUILD SOURCE
-                                    citing_info = {k:v for (k,v) in d.get("source").items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
-                                    citing_info["identifier"] = citing_ids_to_keep
-                                    if d.get("source").get("publisher"):
-                                        citing_info["publisher"] = [i for i in d.get("source").get("publisher")] # MODIFY IF IDS FOR RA ARE PROVIDED
-                                    else:
-                                        citing_info["publisher"] = []
-                                    if d.get("source").get("creator"):
-                                        citing_info["creator"] = [i for i in d.get("source").get("creator") ] # MODIFY IF IDS FOR RA ARE PROVIDED
-                                    else:
-                                        citing_info["creator"] = []
-
-                                    #BUILD TARGET
-                                    cited_info = {k:v for (k,v) in d.get("target").items() if k not in self._entity_keys_to_discard and k not in self._entity_keys_to_update}
-                                    cited_info["identifier"] = cited_ids_to_keep
-                                    if d.get("target").get("publisher"):
-                                        cited_info["publisher"] = [i for i in d.get("target").get("publisher")] # MODIFY IF IDS FOR RA ARE PROVIDED
-                                    else:
-                                        cited_info["publisher"] = []
-                                    if d.get("target").get("creator"):
-                                        cited_info["creator"] = [i for i in d.get("target").get("creator") ] # MODIFY IF IDS FOR RA ARE PROVIDED
-                                    else:
-                                        cited_info["creator"] = []
-
-                                    # 1 ADD "relationship" TO REDUCED ENTITY DICT
-                                    validated_dict["relationship"] = d.get("relationship")
-                                    # 2 ADD "source" TO REDUCED ENTITY DICT
-                                    validated_dict["source"] = citing_info
-                                    # 3 ADD "target" TO REDUCED ENTITY DICT
-                                    validated_dict["target"] = cited_info
-
-                                    # data.append(validated_dict)
-                                    data.append(validated_dict)
-                                    count += 1
-                                    if int(count) != 0 and int(count) % int(self._n) == 0:
-                                        data = self.splitted_to_file(count, data, ".gz")
-
+        n_lines = 0
+        for processed_entities in tqdm(self.iter_processed(self.get_record_source(), self._max_open_tars)):
+            n_lines += 1
+            for validated_dict in processed_entities:
+                data.append(validated_dict)
+                count += 1
+                if int(count) != 0 and int(count) % int(self._n) == 0:
+                    data = self.splitted_to_file(count, data, ".gz")
+
+        n_citations = count
         if len(data) > 0:
             count = count + (self._n - (int(count) % int(self._n)))
             self.splitted_to_file(count, data, ".gz")
+        return {"scholix_lines": n_lines, "citations": n_citations}
 
 
     def splitted_to_file(self, cur_n, data, type):
@@ -141,7 +191,7 @@ class OpenirePreProcessing(Preprocessing):
                 dt_string = cur_datetime.strftime("%d%m%Y_%H%M%S")
                 filename = filename[:-len(self._req_type)] + "_" + dt_string + self._req_type
 
-            json_str = ("\n".join([json.dumps(x) for x in data]))
+            json_str = ("\n".join([json_dumps(x) for x in data]))
             json_bytes = json_str.encode('utf-8')
             with gzip.open(os.path.join(self._output_dir, filename), 'w') as fout:
                 fout.write(json_bytes)
@@ -155,7 +205,7 @@ class OpenirePreProcessing(Preprocessing):
         """this method takes in input a list of id dictionaries and returns a list valid and existent ids with prefixes.
         For each id, a first validation try is made by checking its presence in META db. If the id is not in META db yet,
         a second attempt is made by using the specific id-schema API"""
-        valid_id_list = []
+        norm_ids = []
         for ent in id_dict_list:
             schema = ent.get("schema")
             if isinstance(schema, str):
@@ -163,15 +213,12 @@ class OpenirePreProcessing(Preprocessing):
             id = ent.get("identifier")
             id_man = self.get_id_manager(schema, self._id_man_dict)
             if id_man:
-                norm_id = id_man.normalise(id, include_prefix=True)
-                # check if the id is in redis db
+                norm_id = self.normalise_id(id_man, id)
                 if norm_id:
-                    if self._redis_db.get(norm_id):
-                        valid_id_list.append(norm_id)
-                    # if the id is not in redis db, validate it before appending
-                    elif id_man.is_valid(norm_id):
-                        valid_id_list.append(norm_id)
-        return valid_id_list
+                    norm_ids.append((norm_id, id_man))
+        # check if the ids are in redis db, and validate the other ones concurrently before appending
+        valid_ids = self.validate_ids(norm_ids, self._redis_db, citing_map=False)
+        return [norm_id for (norm_id, id_man), valid in zip(norm_ids, valid_ids) if valid]
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser('openaire.py', description='This script preprocesses a directory of tar compressed '
@@ -189,9 +236,16 @@ if __name__ == '__main__':
     arg_parser.add_argument('-t', '--testing', dest='testing', required=False, type=bool, default=False,
                             help='paremeter to define whether or not the script is executed in testing modality')
 
+    arg_parser.add_argument('-w', '--workers', dest='workers', required=False, type=int, default=1,
+                            help='Number of processes used for processing the scholix files')
+    arg_parser.add_argument('-rs', '--read_size', dest='read_size', required=False, type=int, default=None,
+                            help='size in bytes of the read buffer used to decompress the scholix files')
+    arg_parser.add_argument('-mt', '--max_open_tars', dest='max_open_tars', required=False, type=int, default=2,
+                            help='Maximum number of tar files read at the same time by the worker processes')
+    OpenirePreProcessing.add_arguments(arg_parser, citing_map=False)
     args = arg_parser.parse_args()
 
-    oapp = OpenirePreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number, testing=args.testing)
+    oapp = OpenirePreProcessing(input_dir=args.input, output_dir=args.output_g,  interval=args.number, testing=args.testing, workers=args.workers, read_size=args.read_size, max_open_tars=args.max_open_tars, **OpenirePreProcessing.get_options(args))
     oapp.split_input()
 
 #python -m preprocessing.openaire -in "/Volumes/T7_Touch/LAVORO/OROCI/ver_1" -out "/Volumes/T7_Touch/test_preprocess_openaire" -n 500 -t True
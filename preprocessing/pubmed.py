@@ -6,7 +6,6 @@ from os.path import exists
 import json
 import csv
 from bs4 import BeautifulSoup
-import pandas as pd
 from preprocessing.base import Preprocessing
 from argparse import ArgumentParser
 from datetime import datetime
@@ -32,13 +31,14 @@ class NIHPreProcessing(Preprocessing):
     _entity_keys_to_keep = {"pmid","title","authors","year","journal","references"}
     _filter = ["pmid", "doi", "title", "authors", "year", "journal", "references"]
 
-    def __init__(self, input_dir, output_dir, interval, journals_dict_path, testing=False):
+    def __init__(self, input_dir, output_dir, interval, journals_dict_path, testing=False, **params):
         self.journals_dict_path = journals_dict_path
         self.jour_dict = self.issn_data_recover_poci(journals_dict_path)
         if testing:
             self._redis_db = self.BR_redis_test
         else:
             self._redis_db = self.BR_redis
+        super(NIHPreProcessing, self).__init__(**params)
         self._input_dir = input_dir
         self._output_dir = output_dir
         if not exists(self._output_dir):
@@ -49,8 +49,6 @@ class NIHPreProcessing(Preprocessing):
         self._nih_rf = NIHResourceFinder()
         self._id_man_dict = {"doi":self._doi_manager, "pmid": self._pmid_manager}
 
-        super(NIHPreProcessing, self).__init__()
-
     def issn_data_recover_poci(self, path):
         journal_issn_dict = dict()
         if not os.path.exists(path):
@@ -85,54 +83,63 @@ class NIHPreProcessing(Preprocessing):
             return lines
 
 
+    def get_record_source(self):
+        """This method returns the source of the rows of the iCite csv files, read in chunks of 100000
+        rows and restricted to the columns in _filter."""
+        return self.record_source(self._input_dir, self._req_type, "csv",
+                                  csv_params={"usecols": self._filter, "chunksize": 100000})
+
+    def get_prefetch_ids(self, line):
+        """This method returns the normalised DOI of the row in input, which is the only id of the row looked up
+        in redis while processing it (see prefetched)."""
+        if (line.get("cited_by") or line.get("references")) and line.get("doi"):
+            norm_id = self.get_id_manager("doi", self._id_man_dict).normalise(line.get("doi"), include_prefix=True)
+            if norm_id:
+                return [norm_id], []
+        return [], []
+
     def split_input(self):
-        all_files, targz_fd = self.get_all_files(self._input_dir, self._req_type)
         count = 0
         lines = []
 
-        for file_idx, file in enumerate(tqdm(all_files), 1):
-            chunksize = 100000
-            with pd.read_csv(file,  usecols=self._filter, chunksize=chunksize) as reader:
-                for chunk in reader:
-                    chunk.fillna("", inplace=True)
-                    df_dict_list = chunk.to_dict("records")
-                    filt_values = [d for d in df_dict_list if (d.get("cited_by") or d.get("references"))]
-
-                    for line in filt_values:
-                        count += 1
-                        norm_pmid = self.to_validated_id_list([{"id":line.get("pmid"), "schema":"pmid"}], "citations")[0]
-                        if norm_pmid is None:
-                            print("ERROR:", line.get("pmid"), norm_pmid)
-                            continue
-                        ref = line.get("references").split() if line.get("references") else []
-
-                        if ref:
-                            ref_dict_list = [{"id":i, "schema":"pmid"} for i in ref]
-                            norm_ref = ' '.join([x for x in self.to_validated_id_list(ref_dict_list, "citations") if x]).strip()
-                        else:
-                            norm_ref = ""
-
-                        valid_doi = None
-                        if line.get("doi"):
-                            valid_doi = self.to_validated_id_list([{"id":line.get("doi"), "schema":"doi"}], "citations")[0]
-                        if not valid_doi:
-                            valid_doi = ""
-                        valid_venue, self.jour_dict = self.get_venue_title_and_id(line.get("journal"), self.jour_dict, norm_pmid)
-
-                        line["pmid"] = norm_pmid
-                        line["doi"] = valid_doi
-                        line["journal"] = valid_venue
-                        line["references"] = norm_ref
-
-                        lines.append(line)
-                        if int(count) != 0 and int(count) % int(self._interval) == 0:
-                            lines = self.splitted_to_file(count, lines)
-                            self.issn_data_to_cache_poci(self.jour_dict, self.journals_dict_path)
+        for line in tqdm(self.prefetched(self.get_record_source())):
+            if not (line.get("cited_by") or line.get("references")):
+                continue
+            count += 1
+            norm_pmid = self.to_validated_id_list([{"id":line.get("pmid"), "schema":"pmid"}], "citations")[0]
+            if norm_pmid is None:
+                print("ERROR:", line.get("pmid"), norm_pmid)
+                continue
+            ref = line.get("references").split() if line.get("references") else []
+
+            if ref:
+                ref_dict_list = [{"id":i, "schema":"pmid"} for i in ref]
+                norm_ref = ' '.join([x for x in self.to_validated_id_list(ref_dict_list, "citations") if x]).strip()
+            else:
+                norm_ref = ""
+
+            valid_doi = None
+            if line.get("doi"):
+                valid_doi = self.to_validated_id_list([{"id":line.get("doi"), "schema":"doi"}], "citations")[0]
+            if not valid_doi:
+                valid_doi = ""
+            valid_venue, self.jour_dict = self.get_venue_title_and_id(line.get("journal"), self.jour_dict, norm_pmid)
+
+            line["pmid"] = norm_pmid
+            line["doi"] = valid_doi
+            line["journal"] = valid_venue
+            line["references"] = norm_ref
+
+            lines.append(line)
+            if int(count) != 0 and int(count) % int(self._interval) == 0:
+                lines = self.splitted_to_file(count, lines)
+                self.issn_data_to_cache_poci(self.jour_dict, self.journals_dict_path)
 
         if len(lines) > 0:
             count = count + (self._interval - (int(count) % int(self._interval)))
             self.splitted_to_file(count, lines)
             self.issn_data_to_cache_poci(self.jour_dict, self.journals_dict_path)
+        self.flush_validation_store()
 
     def to_validated_id_list(self, id_dict_list, process_type):
         if process_type == "citations":
@@ -151,11 +158,8 @@ class NIHPreProcessing(Preprocessing):
                                 valid_id_list.append(norm_id)
 
                             else:
-                                # check if the id is in redis db
-                                if self._redis_db.get(norm_id):
-                                    valid_id_list.append(norm_id)
-                                # if the id is not in redis db, validate it before appending
-                                elif id_man.is_valid(norm_id):
+                                # check if the id is in redis db, and if it is not, validate it before appending
+                                if self.validate_id(norm_id, id_man, self._redis_db, citing_map=False):
                                     valid_id_list.append(norm_id)
                                 else:
                                     valid_id_list.append(None)
@@ -251,11 +255,11 @@ if __name__ == '__main__':
                                  'new json file is created at the specified location')
     arg_parser.add_argument('-t', '--testing', dest='testing', required=False, type=bool, default=False,
                             help='paremeter to define whether or not the script is executed in testing modality')
-
+    NIHPreProcessing.add_arguments(arg_parser, citing_map=False)
     args = arg_parser.parse_args()
 
 
-    nihpp = NIHPreProcessing(input_dir=args.input, output_dir=args.output, interval=args.number, journals_dict_path=args.jtpath,testing=args.testing)
+    nihpp = NIHPreProcessing(input_dir=args.input, output_dir=args.output, interval=args.number, journals_dict_path=args.jtpath,testing=args.testing, **NIHPreProcessing.get_options(args))
     nihpp.split_input()
 
 
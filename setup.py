@@ -12,6 +12,7 @@ if __name__ == '__main__':
             "beautifulsoup4==4.12.2",
             "fakeredis==2.10.3",
             "ndjson==0.3.1",
+            "numpy==1.24.2",
             "oc_idmanager==0.2.6",
             "pandas==1.5.3",
             "requests==2.28.2",
@@ -23,7 +24,7 @@ if __name__ == '__main__':
         license = "BSD",
         keywords = "preprocessing data dumps",
         url = "https://github.com/opencitations/preprocess",
-        packages=["preprocessing", "preprocessing.finder", "preprocessing.identifier_manager", "preprocessing.datasource"],
+        packages=["preprocessing", "preprocessing.finder", "preprocessing.identifier_manager", "preprocessing.datasource", "preprocessing.index"],
         classifiers=[
             "Programming Language :: Python :: 3",
             "License :: OSI Approved :: ISC License (ISCL)",
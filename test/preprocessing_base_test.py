@@ -0,0 +1,537 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import threading
+import time
+import unittest
+from argparse import ArgumentParser
+from unittest.mock import patch, Mock
+from os.path import join, exists
+from concurrent.futures import Future
+from fakeredis import FakeStrictRedis
+from preprocessing.cache import ValidationStore
+from preprocessing.base import Preprocessing, json_loads, json_dumps, RecordSource, ValidationExecutor, _ordered_map
+
+
+class RecordIdPreProcessing(Preprocessing):
+    """Minimal preprocessor returning the DOIs of the JaLC records, together with the id of the process."""
+
+    def __init__(self, workers=1, **params):
+        self._workers = workers
+        super(RecordIdPreProcessing, self).__init__(**params)
+
+    def process_record(self, record):
+        doi = record["data"]["doi"]
+        if doi.endswith("1"):
+            return []
+        return [(doi, os.getpid())]
+
+    def get_citing_ids(self, record):
+        return [record["data"]["doi"]]
+
+    def split_input(self):
+        pass
+
+    def to_validated_id_list(self, id_dict_list, process_type):
+        return []
+
+    def splitted_to_file(self, cur_n, data, type):
+        pass
+
+
+class RedisPreProcessing(RecordIdPreProcessing):
+    """Minimal preprocessor returning whether the DOIs of the JaLC records are stored in redis."""
+
+    def __init__(self, redis_db, **params):
+        self._redis_db = redis_db
+        super(RedisPreProcessing, self).__init__(**params)
+
+    def get_prefetch_ids(self, record):
+        return ["doi:" + record["data"]["doi"]], []
+
+    def process_record(self, record):
+        return [self._redis_db.exists("doi:" + record["data"]["doi"])]
+
+
+class CountingRedis(FakeStrictRedis):
+    """Fake redis client counting the calls of its exists and mget methods."""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingRedis, self).__init__(*args, **kwargs)
+        self.calls = {"exists": 0, "mget": 0}
+
+    def exists(self, *names):
+        self.calls["exists"] += 1
+        return super(CountingRedis, self).exists(*names)
+
+    def mget(self, keys, *args):
+        self.calls["mget"] += 1
+        return super(CountingRedis, self).mget(keys, *args)
+
+
+class RecordingExecutor(object):
+    """Executor running the tasks when they are submitted, which records the groups of the tasks submitted
+    while the results of the previous ones were not yet consumed."""
+
+    def __init__(self):
+        self.submitted = []
+        self.consumed = 0
+        self.max_pending_groups = 0
+
+    def submit(self, fn, task):
+        self.submitted.append(task)
+        pending_groups = {group for group, n in self.submitted[self.consumed:]}
+        self.max_pending_groups = max(self.max_pending_groups, len(pending_groups))
+        future = Future()
+        future.set_result(fn(task))
+        return future
+
+
+class PreprocessingBaseTest(unittest.TestCase):
+    """This class aims at testing the functionalities shared by all the preprocessors, defined in base.py."""
+
+    def setUp(self):
+        self.test_dir = join("test", "preprocess")
+        self.json_input = join(self.test_dir, "data_crossref", "json_files", "crossref_dump.json")
+        self.ndjson_input = join(self.test_dir, "data_datacite", "ndjson_files", "sample_9.ndjson")
+        self.tmp_dir = join("tmp", "record_source")
+
+    def test_json_loads(self):
+        with open(self.json_input, "rb") as f:
+            json_bytes = f.read()
+        # TESTING THAT: the decoded objects are the same of the standard library, both for bytes and strings
+        self.assertEqual(json_loads(json_bytes), json.loads(json_bytes))
+        self.assertEqual(json_loads(json_bytes.decode("utf-8")), json.loads(json_bytes))
+        with open(self.ndjson_input, "rb") as f:
+            for line in f:
+                self.assertEqual(json_loads(line), json.loads(line))
+
+        # TESTING THAT: documents which are not supported by orjson are decoded anyway
+        self.assertEqual(json_loads(b'{"n": 123456789012345678901234567890}'), {"n": 123456789012345678901234567890})
+        self.assertTrue(math.isnan(json_loads('{"n": NaN}')["n"]))
+        self.assertEqual(json_loads('"\\ud800"'), "\ud800")
+        with self.assertRaises(ValueError):
+            json_loads(b'{"n": ')
+
+        # TESTING THAT: the standard library is used when orjson is not installed
+        with patch("preprocessing.base.orjson", None):
+            self.assertEqual(json_loads(json_bytes), json.loads(json_bytes))
+
+    def test_json_dumps(self):
+        with open(self.json_input, "rb") as f:
+            data = json.loads(f.read())
+        with open(self.ndjson_input, "rb") as f:
+            lines = [json.loads(line) for line in f]
+        data_to_dump = [data, lines, {"title": "Björk — 北村", "n": [1, 2.5, None, True]}]
+
+        # TESTING THAT: the output is byte-identical to the one of json.dumps
+        for obj in data_to_dump:
+            self.assertEqual(json_dumps(obj), json.dumps(obj))
+            self.assertEqual(json_dumps(obj, ensure_ascii=False), json.dumps(obj, ensure_ascii=False))
+            self.assertEqual(json_dumps(obj, ensure_ascii=False).encode("utf-8"), json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    def test_record_source(self):
+        # TESTING THAT: the same records are read from a directory and from the archives containing the same files
+        cr_dir = RecordSource(join(self.test_dir, "data_crossref", "json_files"), ".json", "json_items", json_key="items")
+        cr_tgz = RecordSource(join(self.test_dir, "data_crossref", "crossref_sample.tar.gz"), ".json", "json_items", json_key="items", stream_items=True)
+        cr_items = sorted(json_dumps(x) for x in cr_dir)
+        self.assertTrue(len(cr_items) > 0)
+        self.assertEqual(cr_items, sorted(json_dumps(x) for x in cr_tgz))
+
+        dc_dir = list(RecordSource(join(self.test_dir, "data_datacite", "ndjson_files"), ".ndjson", "ndjson"))
+        dc_zst = list(RecordSource(join(self.test_dir, "data_datacite", "sample_9.ndjson.zst"), ".ndjson", "ndjson", read_size=64))
+        self.assertTrue(len(dc_dir) > 0)
+        self.assertEqual(dc_dir, dc_zst)
+
+        nih_columns = ["pmid", "doi", "title", "authors", "year", "journal", "references"]
+        nih_dir = list(RecordSource(join(self.test_dir, "data_poci", "csv_files"), ".csv", "csv", csv_params={"usecols": nih_columns, "chunksize": 10}))
+        nih_zip = list(RecordSource(join(self.test_dir, "data_poci", "CSV_iCiteMD_zipped.zip"), ".csv", "csv", csv_params={"usecols": nih_columns, "chunksize": 100}))
+        self.assertTrue(len(nih_dir) > 10)
+        self.assertEqual(nih_dir, nih_zip)
+
+        # TESTING THAT: a single gz compressed file is read as the file it contains
+        if exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        gz_path = join(self.tmp_dir, "sample_9.ndjson.gz")
+        with open(self.ndjson_input, "rb") as f_in, gzip.open(gz_path, "wb") as f_out:
+            f_out.write(f_in.read())
+        self.assertEqual(list(RecordSource(gz_path, ".ndjson", "ndjson")), dc_dir)
+        self.assertEqual([name for name, f in RecordSource(gz_path, ".ndjson").iter_files()], [join(self.tmp_dir, "sample_9.ndjson")])
+        self.assertEqual([name for name, f in RecordSource(self.tmp_dir, ".ndjson").iter_files()], [join(self.tmp_dir, "sample_9.ndjson")])
+        shutil.rmtree(self.tmp_dir)
+
+        # TESTING THAT: the zip archives nested in a zip archive are read in nested mode only
+        jalc_input = join(self.test_dir, "data_jalc", "jalc_sample.zip")
+        jalc_records = [(name, record["data"]["doi"]) for name, record in RecordSource(jalc_input, ".json", "json", nested=True).iter_records()]
+        self.assertEqual(len(jalc_records), 22)
+        self.assertTrue(all(name.endswith(".json") for name, doi in jalc_records))
+        self.assertEqual(list(RecordSource(jalc_input, ".json", "json")), [])
+
+        # TESTING THAT: the gz compressed members of a tar archive are decompressed while reading their lines
+        oa_input = join(self.test_dir, "data_openaire", "part0.tar")
+        oa_lines = list(RecordSource(oa_input, ".gz", "lines"))
+        self.assertTrue(len(oa_lines) > 0)
+        oa_gz_lines = []
+        for name, f in RecordSource(oa_input, ".gz").iter_files():
+            oa_gz_lines.extend(gzip.open(f).readlines())
+        self.assertEqual(oa_lines, oa_gz_lines)
+
+        # TESTING THAT: the malformed lines of an ndjson file are skipped only if required
+        os.makedirs(self.tmp_dir)
+        invalid_path = join(self.tmp_dir, "invalid.ndjson")
+        with open(self.ndjson_input, "rb") as f_in, open(invalid_path, "wb") as f_out:
+            f_out.write(b"{malformed\n" + f_in.read())
+        self.assertEqual(list(RecordSource(invalid_path, ".ndjson", "ndjson", skip_invalid=True)), dc_dir)
+        with self.assertRaises(ValueError):
+            list(RecordSource(invalid_path, ".ndjson", "ndjson"))
+        shutil.rmtree(self.tmp_dir)
+
+        with self.assertRaises(ValueError):
+            RecordSource(jalc_input, ".json", "xml")
+
+    def test_iter_processed(self):
+        jalc_input = join(self.test_dir, "data_jalc", "jalc_sample.zip")
+        sequential = RecordIdPreProcessing()
+        expected = list(sequential.iter_processed(sequential.record_source(jalc_input, ".json", "json", nested=True)))
+        self.assertEqual(len(expected), 22)
+        self.assertIn([], expected)
+
+        # TESTING THAT: the results of the worker processes are returned in input order
+        parallel = RecordIdPreProcessing(workers=3)
+        parallel._tasks_per_worker = 1
+        results = list(parallel.iter_processed(parallel.record_source(jalc_input, ".json", "json", nested=True)))
+        self.assertEqual([[doi for doi, pid in x] for x in results], [[doi for doi, pid in x] for x in expected])
+        pids = {pid for x in results for doi, pid in x}
+        self.assertNotIn(os.getpid(), pids)
+
+        # TESTING THAT: the same holds for the files of a directory and the members of a tar archive
+        tasks = list(RecordSource(join(self.test_dir, "data_crossref", "json_files"), ".json", "json_items", json_key="items").iter_tasks())
+        self.assertTrue(all(name == content for name, content in tasks))
+        tgz_source = RecordSource(join(self.test_dir, "data_crossref", "crossref_sample.tar.gz"), ".json", "json_items", json_key="items")
+        for name, content in tgz_source.iter_tasks():
+            self.assertTrue(isinstance(content, bytes))
+            self.assertEqual(list(tgz_source.read_records(name, io.BytesIO(content))), json.loads(content)["items"])
+
+        # TESTING THAT: the members of a plain tar archive are not read in memory, but from their byte range in
+        # the archive
+        tar_source = RecordSource(join(self.test_dir, "data_openaire", "part0.tar"), ".gz", "lines")
+        tar_tasks = list(tar_source.iter_tasks())
+        self.assertTrue(len(tar_tasks) > 0)
+        self.assertTrue(all(tar_source.task_file(name, content) == tar_source.path for name, content in tar_tasks))
+        self.assertEqual([line for name, content in tar_tasks for line in tar_source.read_task(name, content)], list(tar_source))
+
+    def test_iter_processed_executor(self):
+        jalc_input = join(self.test_dir, "data_jalc", "jalc_sample.zip")
+        preprocessor = RecordIdPreProcessing(workers=2, api_workers=4)
+        id_man = Mock()
+        id_man.is_valid.side_effect = lambda norm_id: norm_id.endswith("valid")
+        self.assertEqual(preprocessor._validation_executor.validate([("doi:10.1/valid", id_man)]), [True])
+        pool = preprocessor._validation_executor._pool
+
+        # TESTING THAT: the threads of the validation executor started by the current process are stopped before
+        # forking the worker processes, and they are started again at the next validation
+        results = list(preprocessor.iter_processed(preprocessor.record_source(jalc_input, ".json", "json", nested=True)))
+        self.assertEqual(len(results), 22)
+        self.assertTrue(pool._shutdown)
+        self.assertIsNone(preprocessor._validation_executor._pool)
+        self.assertEqual(preprocessor._validation_executor.validate([("doi:10.1/x", id_man)]), [False])
+        preprocessor._validation_executor.shutdown()
+
+    def test_iter_processed_tasks(self):
+        jalc_input = join(self.test_dir, "data_jalc", "jalc_sample.zip")
+        sequential = RecordIdPreProcessing()
+        source = sequential.record_source(jalc_input, ".json", "json", nested=True, batch_size=5)
+        dois = [record["data"]["doi"] for record in source]
+        expected = list(sequential.iter_processed_tasks(source, "get_citing_id_run"))
+
+        # TESTING THAT: the method is called once for each task, with all the records of the task
+        self.assertEqual([len(hashes) for hashes, data, lengths in expected], [5, 5, 5, 5, 2])
+        for hashes, data, lengths in expected:
+            self.assertTrue(all(hashes[:-1] <= hashes[1:]))
+        self.assertEqual(sorted(data[i:j].decode("utf-8") for hashes, data, lengths in expected
+                                for i, j in zip([0] + list(lengths.cumsum()[:-1]), lengths.cumsum())), sorted(dois))
+
+        # TESTING THAT: the results of the worker processes are returned in input order
+        parallel = RecordIdPreProcessing(workers=2)
+        results = list(parallel.iter_processed_tasks(source, "get_citing_id_run"))
+        self.assertEqual([data for hashes, data, lengths in results], [data for hashes, data, lengths in expected])
+
+    def test_prefetched(self):
+        jalc_input = join(self.test_dir, "data_jalc", "jalc_sample.zip")
+        redis_db = CountingRedis()
+        preprocessor = RedisPreProcessing(redis_db)
+        preprocessor._prefetch_size = 10
+        source = preprocessor.record_source(jalc_input, ".json", "json", nested=True)
+        dois = [record["data"]["doi"] for record in source]
+        for doi in dois[::2]:
+            redis_db.set("doi:" + doi, "value")
+
+        # TESTING THAT: the ids of each group of records are checked with a single request, and the results
+        # are returned without further lookups
+        results = list(preprocessor.iter_processed(source))
+        self.assertEqual(results, [[i % 2 == 0] for i in range(len(dois))])
+        self.assertEqual(redis_db.calls, {"exists": 0, "mget": math.ceil(len(dois) / 10)})
+
+        # TESTING THAT: the results are discarded when a key is updated or deleted, and once all the records
+        # have been processed
+        records = preprocessor.prefetched(source)
+        next(records)
+        preprocessor._redis_db.delete("doi:" + dois[0])
+        preprocessor._redis_db.set("doi:" + dois[1], "new")
+        self.assertFalse(preprocessor._redis_db.exists("doi:" + dois[0]))
+        self.assertTrue(preprocessor._redis_db.exists("doi:" + dois[1]))
+        self.assertTrue(preprocessor._redis_db.exists("doi:" + dois[2]))
+        self.assertEqual(redis_db.calls["exists"], 2)
+        list(records)
+        self.assertEqual(preprocessor._redis_db._prefetched, dict())
+
+        # TESTING THAT: the ids normalised while a group of records is prefetched are normalised once only,
+        # and they are not kept once all the records have been processed
+        id_man = Mock()
+        id_man.normalise.side_effect = lambda id_string, include_prefix=False: "doi:" + id_string
+        records = preprocessor.prefetched(source)
+        next(records)
+        self.assertEqual(preprocessor.normalise_id(id_man, dois[0]), "doi:" + dois[0])
+        self.assertEqual(preprocessor.normalise_id(id_man, dois[0]), "doi:" + dois[0])
+        self.assertEqual(id_man.normalise.call_count, 1)
+        list(records)
+        self.assertEqual(preprocessor.normalise_id(id_man, dois[0]), "doi:" + dois[0])
+        self.assertEqual(id_man.normalise.call_count, 2)
+
+        # TESTING THAT: the statistics of the validation cache are reported once all the records have been
+        # processed, and only if required
+        with patch("preprocessing.base.tqdm.write") as write:
+            list(preprocessor.iter_processed(source))
+            self.assertEqual(write.call_count, 0)
+            preprocessor = RedisPreProcessing(redis_db, cache_stats=True)
+            list(preprocessor.iter_processed(source))
+            self.assertEqual(write.call_count, 1)
+            self.assertTrue(write.call_args.args[0].startswith("validation cache: {'hits': "))
+
+    def test_validate_id(self):
+        redis_db = CountingRedis()
+        redis_db.set("doi:10.1/in-meta", "value")
+        preprocessor = RedisPreProcessing(redis_db)
+        id_man = Mock()
+        id_man.is_valid.side_effect = lambda norm_id: norm_id.endswith("valid")
+        ids = ["doi:10.1/in-meta", "doi:10.1/valid", "doi:10.1/not-found"]
+
+        # TESTING THAT: each id is looked up in redis and validated through the API only the first time
+        for i in range(3):
+            self.assertEqual([preprocessor.validate_id(x, id_man, preprocessor._redis_db, citing_map=False) for x in ids], [True, True, False])
+        self.assertEqual(redis_db.calls["exists"], 3)
+        self.assertEqual(id_man.is_valid.call_count, 2)
+        self.assertEqual(preprocessor._validation_cache.stats(), {"hits": 6, "misses": 3, "evictions": 0, "positive": 2, "negative": 1})
+
+        # TESTING THAT: an id stored in redis through the preprocessor is validated again
+        preprocessor._redis_db.set("doi:10.1/not-found", "value")
+        self.assertTrue(preprocessor.validate_id("doi:10.1/not-found", id_man, preprocessor._redis_db, citing_map=False))
+
+        # TESTING THAT: the results of the API stored in the validation store are reused by other preprocessors
+        store_path = join(self.tmp_dir, "validation.db")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        for i in range(2):
+            preprocessor = RedisPreProcessing(CountingRedis())
+            preprocessor._validation_store = ValidationStore(store_path)
+            self.assertEqual([preprocessor.validate_id(x, id_man, preprocessor._redis_db, citing_map=False) for x in ids], [False, True, False])
+            preprocessor.flush_validation_store()
+        self.assertEqual(id_man.is_valid.call_count, 5)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_validation_executor(self):
+        executor = ValidationExecutor(max_workers=8, limits={"doi": (2, 1000), "pmid": (8, 50)})
+        in_flight = {"doi": 0, "pmid": 0, "jid": 0}
+        max_in_flight = {"doi": 0, "pmid": 0, "jid": 0}
+        lock = threading.Lock()
+
+        def call(norm_id):
+            service = norm_id.split(":")[0]
+            with lock:
+                in_flight[service] += 1
+                max_in_flight[service] = max(max_in_flight[service], in_flight[service])
+            time.sleep(0.01)
+            with lock:
+                in_flight[service] -= 1
+            return norm_id.upper()
+
+        # TESTING THAT: the results are returned in input order, and the calls to each service are limited by its
+        # concurrency
+        ids = ["doi:10.1/%d" % i for i in range(10)] + ["pmid:%d" % i for i in range(10)]
+        self.assertEqual(executor.map(lambda x: x.split(":")[0], call, ids), [x.upper() for x in ids])
+        self.assertEqual(max_in_flight["doi"], 2)
+        self.assertGreater(max_in_flight["pmid"], 2)
+
+        # TESTING THAT: the calls to a service which is not in the limits are limited by the default limit, i.e. at
+        # most 4 concurrent calls
+        jids = ["jid:%d" % i for i in range(10)]
+        self.assertEqual(executor.map(lambda x: x.split(":")[0], call, jids), [x.upper() for x in jids])
+        self.assertEqual(max_in_flight["jid"], 4)
+
+        # TESTING THAT: the calls to each service are limited by its rate, after a burst of rate calls
+        start = time.monotonic()
+        executor.map(lambda x: "pmid", lambda x: x, range(100))
+        self.assertGreaterEqual(time.monotonic() - start, 0.8)
+
+        id_man = Mock()
+        id_man.is_valid.side_effect = lambda norm_id: norm_id.endswith("valid")
+        self.assertEqual(executor.validate([("doi:10.1/valid", id_man), ("doi:10.1/x", id_man)]), [True, False])
+        executor.shutdown()
+
+    def test_validation_executor_first_calls(self):
+        executor = ValidationExecutor(max_workers=16, limits={"pmid": (2, 1000)})
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        semaphores = []
+        bounded_semaphore = threading.BoundedSemaphore
+
+        def slow_semaphore(value):
+            # the creation of the semaphore is slowed down, so that the first calls of the threads overlap
+            semaphores.append(value)
+            time.sleep(0.05)
+            return bounded_semaphore(value)
+
+        def call(norm_id):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return norm_id
+
+        # TESTING THAT: the many first calls to a service made at the same time share its limits
+        with patch("preprocessing.base.threading.BoundedSemaphore", slow_semaphore):
+            executor.map(lambda x: "pmid", call, ["pmid:%d" % i for i in range(50)])
+        self.assertEqual(semaphores, [2])
+        self.assertLessEqual(in_flight[1], 2)
+        executor.shutdown()
+
+    def test_validate_ids(self):
+        redis_db = CountingRedis()
+        redis_db.set("doi:10.1/in-meta", "value")
+        preprocessor = RedisPreProcessing(redis_db)
+        id_man = Mock()
+        id_man.is_valid.side_effect = lambda norm_id: norm_id.endswith("valid")
+        ids = ["doi:10.1/valid", "doi:10.1/in-meta", "doi:10.1/x", "doi:10.1/valid", "doi:10.2/valid"]
+
+        # TESTING THAT: the results are returned in input order, and each id is validated through the API once
+        self.assertEqual(preprocessor.validate_ids([(x, id_man) for x in ids], preprocessor._redis_db, citing_map=False),
+                         [True, True, False, True, True])
+        self.assertEqual(sorted(c.args[0] for c in id_man.is_valid.call_args_list), ["doi:10.1/valid", "doi:10.1/x", "doi:10.2/valid"])
+        self.assertEqual(preprocessor.validate_ids([(x, id_man) for x in ids[::-1]], preprocessor._redis_db, citing_map=False),
+                         [True, True, False, True, True][::-1])
+        self.assertEqual(id_man.is_valid.call_count, 3)
+
+    def test_options(self):
+        arg_parser = ArgumentParser()
+        RedisPreProcessing.add_arguments(arg_parser)
+        store_path = join(self.test_dir, "validation_options.sqlite")
+        args = arg_parser.parse_args(["-pcs", "10", "-ncs", "0", "-vs", store_path, "-aw", "1", "-dv"])
+
+        # TESTING THAT: the shared command line options are passed to the constructor of the preprocessor, and the
+        # options which are not specified keep their default values
+        preprocessor = RedisPreProcessing(CountingRedis(), **RedisPreProcessing.get_options(args))
+        self.assertEqual((preprocessor._validation_cache.positive_size, preprocessor._validation_cache.negative_size), (10, 0))
+        self.assertEqual(preprocessor._validation_store_path, store_path)
+        self.assertIsNone(preprocessor._validation_executor)
+        self.assertTrue(preprocessor._deferred_validation)
+        self.assertFalse(preprocessor._single_pass)
+        self.assertIsNone(preprocessor._bloom_error_rate)
+        preprocessor._validation_store.close()
+        os.remove(store_path)
+
+        # TESTING THAT: the options of the citing map are not added to the preprocessors which do not build it
+        arg_parser = ArgumentParser()
+        RedisPreProcessing.add_arguments(arg_parser, citing_map=False)
+        self.assertEqual(RedisPreProcessing.get_options(arg_parser.parse_args(["-aw", "2"])),
+                         {"redis_bloom": None, "positive_cache_size": None, "negative_cache_size": None,
+                          "validation_store": None, "api_workers": 2, "cache_stats": False})
+        preprocessor = RedisPreProcessing(CountingRedis(), **RedisPreProcessing.get_options(arg_parser.parse_args([])))
+        self.assertEqual(preprocessor._api_workers, Preprocessing._api_workers)
+
+        # TESTING THAT: by default the ids are validated through the APIs one at a time, without threads
+        self.assertEqual(Preprocessing._api_workers, 1)
+        self.assertIsNone(preprocessor._validation_executor)
+
+    def test_validate_ids_distinct(self):
+        preprocessor = RedisPreProcessing(CountingRedis(), api_workers=8)
+        id_man = Mock()
+        id_man.is_valid.side_effect = lambda norm_id: norm_id.endswith("valid")
+        batches = []
+        validate = ValidationExecutor.validate
+
+        def distinct_validate(executor, ids):
+            batches.append([norm_id for norm_id, id_man in ids])
+            return validate(executor, ids)
+
+        # TESTING THAT: the same id is never validated by two threads at the same time, since the id managers
+        # are shared by the threads
+        ids = ["doi:10.1/valid", "doi:10.1/x", "doi:10.1/valid", "doi:10.1/x", "doi:10.2/valid", "doi:10.1/valid"]
+        with patch.object(ValidationExecutor, "validate", distinct_validate):
+            self.assertEqual(preprocessor.validate_ids([(x, id_man) for x in ids], preprocessor._redis_db, citing_map=False),
+                             [True, False, True, False, True, True])
+        self.assertEqual(batches, [["doi:10.1/valid", "doi:10.1/x", "doi:10.2/valid"]])
+
+    def test_iter_tasks_shards(self):
+        dc_dir = join(self.test_dir, "data_datacite", "ndjson_files")
+        dc_zst = join(self.test_dir, "data_datacite", "sample_9.ndjson.zst")
+        expected = list(RecordSource(dc_dir, ".ndjson", "ndjson"))
+
+        # TESTING THAT: a single ndjson file is split in byte ranges aligned to the start of the lines, which
+        # contain all the records of the file, in the same order
+        for shard_size in [1, 1000, 50000, 10 ** 9]:
+            source = RecordSource(dc_dir, ".ndjson", "ndjson", shard_size=shard_size)
+            tasks = list(source.iter_tasks())
+            ranges = [content[1:] for name, content in tasks]
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], os.path.getsize(self.ndjson_input))
+            self.assertTrue(all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1)))
+            self.assertEqual([record for name, content in tasks for record in source.read_task(name, content)], expected)
+            if shard_size < 10 ** 9:
+                self.assertTrue(len(tasks) > 1)
+
+            # TESTING THAT: a compressed file is split in blocks of complete lines
+            zst_source = RecordSource(dc_zst, ".ndjson", "ndjson", shard_size=shard_size, read_size=64)
+            zst_tasks = list(zst_source.iter_tasks())
+            self.assertEqual(len(zst_tasks), len(tasks))
+            self.assertTrue(all(name == dc_zst[:-len(".zst")] and isinstance(content, bytes) for name, content in zst_tasks))
+            self.assertEqual([record for name, content in zst_tasks for record in zst_source.read_task(name, content)], expected)
+
+        # TESTING THAT: the files are not split if no shard size is specified
+        self.assertEqual(list(RecordSource(dc_zst, ".ndjson", "ndjson").iter_tasks()), [(dc_zst, dc_zst)])
+
+    def test_ordered_map(self):
+        tasks = [("a", 1), ("a", 2), ("b", 3), ("c", 4), ("c", 5), ("a", 6), ("d", 7)]
+        for max_pending, max_groups, exp_max_groups in [(1, None, 1), (10, None, 4), (10, 1, 1), (10, 2, 2), (2, 3, 2)]:
+            executor = RecordingExecutor()
+            results = []
+            for result in _ordered_map(executor, lambda task: task[1] * 10, tasks, max_pending, lambda task: task[0], max_groups):
+                results.append(result)
+                executor.consumed += 1
+            # TESTING THAT: the results are returned in input order, and the tasks waiting at the same time
+            # belong to at most max_groups groups
+            self.assertEqual(results, [n * 10 for group, n in tasks])
+            self.assertEqual(executor.max_pending_groups, exp_max_groups)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import os
+import time
+import shutil
+import unittest
+import multiprocessing
+from os.path import join, exists
+from unittest.mock import patch
+from preprocessing.cache import ValidationCache, ValidationStore
+
+
+def _store_ids(path, ids):
+    store = ValidationStore(path, batch_size=3)
+    for norm_id in ids:
+        store.put(norm_id, True)
+    store.close()
+
+
+class ValidationCacheTest(unittest.TestCase):
+    """This class aims at testing the class ValidationCache."""
+
+    def test_lru(self):
+        cache = ValidationCache(positive_size=2, negative_size=1)
+        cache.put("doi:10.1/a", True)
+        cache.put("doi:10.1/b", True)
+        cache.put("doi:10.1/x", False)
+        self.assertTrue(cache.get("doi:10.1/a"))
+        self.assertFalse(cache.get("doi:10.1/x"))
+        self.assertIsNone(cache.get("doi:10.1/c"))
+
+        # TESTING THAT: the least recently used id is evicted, and that valid and invalid ids do not evict
+        # each other
+        cache.put("doi:10.1/c", True)
+        self.assertTrue(cache.contains("doi:10.1/a"))
+        self.assertFalse(cache.contains("doi:10.1/b"))
+        self.assertTrue(cache.contains("doi:10.1/x"))
+        cache.put("doi:10.1/y", False)
+        self.assertFalse(cache.contains("doi:10.1/x"))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "evictions": 2, "positive": 2, "negative": 1})
+
+        # TESTING THAT: an id can be removed, and that a size of 0 disables the cache
+        cache.discard("doi:10.1/a")
+        self.assertIsNone(cache.get("doi:10.1/a"))
+        cache = ValidationCache(positive_size=1, negative_size=0)
+        cache.put("doi:10.1/x", False)
+        self.assertIsNone(cache.get("doi:10.1/x"))
+
+
+
+class ValidationStoreTest(unittest.TestCase):
+    """This class aims at testing the class ValidationStore."""
+
+    def setUp(self):
+        self._store_dir = join("test", "preprocess", "tmp_validation_store")
+        if not exists(self._store_dir):
+            os.makedirs(self._store_dir)
+        self._store_path = join(self._store_dir, "validation.db")
+
+    def tearDown(self):
+        shutil.rmtree(self._store_dir)
+
+    def test_store(self):
+        store = ValidationStore(self._store_path, ttl={"orcid": 10}, default_ttl=100, batch_size=3)
+        store.put("doi:10.1/a", True)
+        store.put("doi:10.1/x", False)
+        # TESTING THAT: the results are written in batches, and that the pending ones are returned as well
+        self.assertEqual(ValidationStore(self._store_path).get("doi:10.1/a"), None)
+        self.assertTrue(store.get("doi:10.1/a"))
+        store.put("orcid:0000-0003-0530-4305", True)
+        other = ValidationStore(self._store_path)
+        self.assertTrue(other.get("doi:10.1/a"))
+        self.assertFalse(other.get("doi:10.1/x"))
+        self.assertIsNone(other.get("doi:10.1/b"))
+        store.put("doi:10.1/b", True)
+        store.close()
+        self.assertTrue(other.get("doi:10.1/b"))
+
+        # TESTING THAT: the results expire after the time to live of their schema
+        store = ValidationStore(self._store_path, ttl={"orcid": 10}, default_ttl=100)
+        with patch("preprocessing.cache.time.time", return_value=time.time() + 50):
+            self.assertTrue(store.get("doi:10.1/a"))
+            self.assertIsNone(store.get("orcid:0000-0003-0530-4305"))
+        with patch("preprocessing.cache.time.time", return_value=time.time() + 150):
+            self.assertIsNone(store.get("doi:10.1/a"))
+
+    def test_concurrent_processes(self):
+        ValidationStore(self._store_path).close()
+        ids = [["doi:10.%d/%d" % (p, i) for i in range(20)] for p in range(4)]
+        processes = [multiprocessing.Process(target=_store_ids, args=(self._store_path, cur_ids)) for cur_ids in ids]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # TESTING THAT: the results written by more processes at the same time are all stored
+        store = ValidationStore(self._store_path)
+        self.assertTrue(all(store.get(norm_id) for cur_ids in ids for norm_id in cur_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
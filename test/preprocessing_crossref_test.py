@@ -1,6 +1,9 @@
 import unittest
+import io
 import json
+import tarfile
 from preprocessing.crossref import CrossrefPreProcessing
+from preprocessing.base import iter_json_items
 from os.path import exists, join
 import os.path
 import shutil
@@ -27,24 +30,18 @@ class PreprocessingTestCrossref(unittest.TestCase):
         self._dc_pp = CrossrefPreProcessing(self.decompr_input, self._output_dir_cr, self._interval, self._dirt_to_compress, testing=True)
         self._dc_pp.split_input()
         entities_w_citations = []
-        all_files, targz_fd = self._dc_pp.get_all_files(self.decompr_input, self._dc_pp._req_type)
-        for file_idx, file in enumerate(all_files, 1):
-            f = open(file, encoding="utf8")
+        for name, f in self._dc_pp.record_source(self.decompr_input, self._dc_pp._req_type).iter_files():
             dict_loaded = json.load(f)
             lines = [line for line in dict_loaded["items"] if line.get("DOI") and line.get("reference")]
             entities_w_citations.extend(lines)
 
-            f.close()
             n_ents_w_cit = len(entities_w_citations)
 
             n_out_ents = 0
-            all_files_out, targz_fd = self._dc_pp.get_all_files(self._output_dir_cr, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files_out, 1):
-                fo = open(file, encoding="utf8")
+            for name, fo in self._dc_pp.record_source(self._output_dir_cr, self._dc_pp._req_type).iter_files():
                 dict_loaded_out = json.load(fo)
                 lines_out = [line for line in dict_loaded_out["items"] if line.get("DOI") and line.get("reference")]
                 n_out_ents += len(lines_out)
-                fo.close()
 
             # TESTING THAT: the number of filtered entities in output is the same as
             # the n of input entities having citations
@@ -68,22 +65,18 @@ class PreprocessingTestCrossref(unittest.TestCase):
         self._dc_pp = CrossrefPreProcessing(self.compr_input, self._output_dir_cr_compr, self._interval, self._dirt_to_compress, testing=True)
         self._dc_pp.split_input()
         entities_w_citations = []
-        all_files, targz_fd = self._dc_pp.get_all_files(self.compr_input, self._dc_pp._req_type)
-        for file_idx, file in enumerate(all_files, 1):
-            dict_loaded = self._dc_pp.load_json(file, targz_fd)
+        for name, f in self._dc_pp.record_source(self.compr_input, self._dc_pp._req_type).iter_files():
+            dict_loaded = json.load(f)
             lines = [line for line in dict_loaded["items"] if line.get("DOI") and line.get("reference")]
             entities_w_citations.extend(lines)
 
             n_ents_w_cit = len(entities_w_citations)
 
             n_out_ents = 0
-            all_files_out, targz_fd = self._dc_pp.get_all_files(self._output_dir_cr_compr, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files_out, 1):
-                fo = open(file, encoding="utf8")
+            for name, fo in self._dc_pp.record_source(self._output_dir_cr_compr, self._dc_pp._req_type).iter_files():
                 dict_loaded_out = json.load(fo)
                 lines_out = [line for line in dict_loaded_out["items"] if line.get("DOI") and line.get("reference")]
                 n_out_ents += len(lines_out)
-                fo.close()
 
             # TESTING THAT: the number of filtered entities in output is the same as
             # the n of input entities having citations
@@ -101,6 +94,41 @@ class PreprocessingTestCrossref(unittest.TestCase):
 
             self.assertEqual(exp_n_out_file, len_out_files)
 
+    def test_record_source_tar_gz(self):
+        self._cr_pp5 = CrossrefPreProcessing(self.decompr_input, self._output_dir_cr, self._interval, self._dirt_to_compress, testing=True)
+        expected = []
+        with tarfile.open(self.compr_input, "r:gz") as targz_fd:
+            for member in targz_fd:
+                if member.name.endswith(self._cr_pp5._req_type):
+                    expected.append((member.name, json.load(targz_fd.extractfile(member))))
+
+        # TESTING THAT: the tar.gz members are streamed in a single pass, with the same content
+        # of the members of the archive
+        streamed = [(name, json.load(f)) for name, f in self._cr_pp5.record_source(self.compr_input, self._cr_pp5._req_type).iter_files()]
+        self.assertEqual(streamed, expected)
+
+        # TESTING THAT: the same content is yielded for the decompressed directory
+        streamed_dir = [json.load(f) for name, f in self._cr_pp5.record_source(self.decompr_input, self._cr_pp5._req_type).iter_files()]
+        self.assertEqual(streamed_dir, [d for n, d in expected])
+
+    def test_iter_json_items(self):
+        self._cr_pp6 = CrossrefPreProcessing(self.compr_input, self._output_dir_cr, self._interval, self._dirt_to_compress, testing=True, stream_items=True)
+        for name, f in self._cr_pp6.record_source(self.decompr_input, self._cr_pp6._req_type).iter_files():
+            json_bytes = f.read()
+        expected = json.loads(json_bytes)["items"]
+
+        # TESTING THAT: the items are parsed one by one, also when the file is read in chunks splitting
+        # json values and multibyte characters
+        for read_size in [1, 7, 1000]:
+            items = list(iter_json_items(io.BytesIO(json_bytes), "items", read_size))
+            self.assertEqual(items, expected)
+
+        # TESTING THAT: the other keys of the object are skipped and malformed files raise an error
+        items = list(iter_json_items(io.BytesIO(b'{"status": "ok", "n": 1.5e3, "items": [{"DOI": "10.1/a"}, 2]}'), "items", 2))
+        self.assertEqual(items, [{"DOI": "10.1/a"}, 2])
+        with self.assertRaises(ValueError):
+            list(iter_json_items(io.BytesIO(b'{"items": [{"DOI": "10.1/a"}}'), "items", 2))
+
     def test_to_validated_id_list_API(self):
         self._cr_pp2 = CrossrefPreProcessing(self.decompr_input, self._output_dir_cr, self._interval, self._dirt_to_compress, testing=True)
         cit_list = [
@@ -158,14 +186,11 @@ class PreprocessingTestCrossref(unittest.TestCase):
         self.assertEqual(output_file_n, expected_n)
 
         all_dict_in_out = []
-        all_fi, op = self._dc_pp4.get_all_files(self._output_dir_cr, ".json")
-        for fi in all_fi:
-            f = open(fi, encoding="utf8")
+        for fi, f in self._dc_pp4.record_source(self._output_dir_cr, ".json").iter_files():
             dict_f = json.load(f)
             data_f = dict_f.get("items")
             for lined in data_f:
                 all_dict_in_out.append(lined)
-            f.close()
 
         self.assertTrue(all(item in data_to_file for item in all_dict_in_out))
         self.assertTrue(all(item in all_dict_in_out for item in data_to_file))
@@ -43,9 +43,7 @@ class PreprocessingTestDatacite(unittest.TestCase):
             self._dc_pp = DatacitePreProcessing(self._input_dir_dc, self._output_dir_dc_lm, self._interval, self._dirt_to_compress, testing=True)
             self._dc_pp.split_input()
             entities_w_citations = []
-            all_files, targz_fd = self._dc_pp.get_all_files(self._input_dir_dc, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files, 1):
-                f = open(file, encoding="utf8")
+            for name, f in self._dc_pp.record_source(self._input_dir_dc, self._dc_pp._req_type).iter_files():
                 lines = [json.loads(line) for line in f]
                 ents = [d for d in lines if d.get("data")]
                 lists_of_dicts = [d.get("data") for d in ents if d.get("data")]
@@ -61,16 +59,12 @@ class PreprocessingTestDatacite(unittest.TestCase):
                                     if e.get("relatedIdentifierType").lower().strip() == "doi":
                                         entities_w_citations.append(lrid)
                                         break
-                f.close()
             n_ents_w_cit = len(entities_w_citations)
 
             n_out_ents = 0
-            all_files_out, targz_fd = self._dc_pp.get_all_files(self._output_dir_dc_lm, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files_out, 1):
-                fo = open(file, encoding="utf8")
+            for name, fo in self._dc_pp.record_source(self._output_dir_dc_lm, self._dc_pp._req_type).iter_files():
                 lines_out = [json.loads(line) for line in fo if line]
                 n_out_ents += len(lines_out)
-                fo.close()
 
             # TESTING THAT: the number of filtered entities in output is the same as
             # the n of input entities having citations
@@ -94,9 +88,7 @@ class PreprocessingTestDatacite(unittest.TestCase):
             self._dc_pp = DatacitePreProcessing(self._compr_input_dir_dc, self._compr_output_dir_dc_lm, self._interval, self._dirt_to_compress, testing=True)
             self._dc_pp.split_input()
             entities_w_citations = []
-            all_files, targz_fd = self._dc_pp.get_all_files(self._compr_input_dir_dc, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files, 1):
-                f = open(file, encoding="utf8")
+            for name, f in self._dc_pp.record_source(self._compr_input_dir_dc, self._dc_pp._req_type).iter_files():
                 lines = [json.loads(line) for line in f]
                 ents = [d for d in lines if d.get("data")]
                 lists_of_dicts = [d.get("data") for d in ents if d.get("data")]
@@ -112,16 +104,12 @@ class PreprocessingTestDatacite(unittest.TestCase):
                                     if e.get("relatedIdentifierType").lower().strip() == "doi":
                                         entities_w_citations.append(lrid)
                                         break
-                f.close()
             n_ents_w_cit = len(entities_w_citations)
 
             n_out_ents = 0
-            all_files_out, targz_fd = self._dc_pp.get_all_files(self._compr_output_dir_dc_lm, self._dc_pp._req_type)
-            for file_idx, file in enumerate(all_files_out, 1):
-                fo = open(file, encoding="utf8")
+            for name, fo in self._dc_pp.record_source(self._compr_output_dir_dc_lm, self._dc_pp._req_type).iter_files():
                 lines_out = [json.loads(line) for line in fo if line]
                 n_out_ents += len(lines_out)
-                fo.close()
 
             # TESTING THAT: the number of filtered entities in output is the same as
             # the n of input entities having citations
@@ -139,10 +127,21 @@ class PreprocessingTestDatacite(unittest.TestCase):
 
             self.assertEqual(exp_n_out_file, len_out_files)
 
-            #remove the directory where the zst was extracted
-            decompr_dir_filepath = self._compr_input_dir_dc.split(".")[0]+"_decompr_zst_dir"
-            if exists(decompr_dir_filepath):
-                shutil.rmtree(decompr_dir_filepath)
+        def test_record_source_zst(self):
+            self._dc_pp5 = DatacitePreProcessing(self._input_dir_dc, self._output_dir_dc_lm, self._interval, self._dirt_to_compress, testing=True, read_size=64)
+            expected = []
+            for name, f in self._dc_pp5.record_source(self._input_dir_dc, self._dc_pp5._req_type).iter_files():
+                expected.extend([line for line in f])
+
+            # TESTING THAT: the zst input is decompressed line by line, even with a read buffer which is
+            # smaller than a single line, and no decompressed copy of the input is stored on disk
+            input_dir_content = os.listdir(join(self.test_dir, "data_datacite"))
+            streamed = []
+            for name, f in self._dc_pp5.record_source(self._compr_input_dir_dc, self._dc_pp5._req_type).iter_files():
+                self.assertEqual(name, join(self.test_dir, "data_datacite", "sample_9.ndjson"))
+                streamed.extend([line for line in f])
+            self.assertEqual(streamed, expected)
+            self.assertEqual(os.listdir(join(self.test_dir, "data_datacite")), input_dir_content)
 
         def test_to_validated_id_list_API(self):
             self._dc_pp2 = DatacitePreProcessing(self._input_dir_dc, self._output_dir_dc_lm, self._interval, self._dirt_to_compress, testing=True)
@@ -309,14 +308,7 @@ class PreprocessingTestDatacite(unittest.TestCase):
             expected_n = 2
             self.assertEqual(output_file_n, expected_n)
 
-            all_dict_in_out = []
-            all_fi, op = self._dc_pp4.get_all_files(self._output_dir_dc_lm, ".ndjson")
-            for fi in all_fi:
-                f = open(fi, encoding="utf8")
-                for line in f:
-                    lined = json.loads(line)
-                    all_dict_in_out.append(lined)
-                f.close()
+            all_dict_in_out = list(self._dc_pp4.record_source(self._output_dir_dc_lm, ".ndjson", "ndjson"))
 
             self.assertTrue(all(item in data_to_file for item in all_dict_in_out))
             self.assertTrue(all(item in all_dict_in_out for item in data_to_file))
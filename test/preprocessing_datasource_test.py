@@ -0,0 +1,144 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import asyncio
+import unittest
+import redis
+import redis.asyncio
+from fakeredis import FakeConnection, FakeServer
+from fakeredis import aioredis
+from preprocessing.datasource.redis import RedisDataSource
+from preprocessing.datasource.redis_async import AsyncRedisDataSource
+
+
+class RedisDataSourceTest(unittest.TestCase):
+    """This class aims at testing the methods of the class RedisDataSource, on a fake redis server."""
+
+    def setUp(self):
+        pool = redis.ConnectionPool(connection_class=FakeConnection, server=FakeServer(), decode_responses=True)
+        self.redis_db = RedisDataSource("DB-META-BR", connection_pool=pool, batch_size=2)
+        self.redis_db.mset({"doi:10.1/a": {"valid": True}, "doi:10.1/b": [1], "doi:10.1/c": None})
+
+    def test_connection_pool(self):
+        # TESTING THAT: the connections are created with the settings in input, either to a unix domain socket
+        # or to host and port
+        unix_db = RedisDataSource("DB-META-RA", unix_socket_path="/tmp/redis.sock", max_connections=4, socket_timeout=2)
+        pool = unix_db._r.connection_pool
+        self.assertIs(pool.connection_class, redis.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs["path"], "/tmp/redis.sock")
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 2)
+        self.assertEqual(pool.max_connections, 4)
+        tcp_db = RedisDataSource("DB-META-BR", host="localhost", port=6380, socket_keepalive=False)
+        self.assertEqual(tcp_db._r.connection_pool.connection_kwargs["host"], "localhost")
+        self.assertEqual(tcp_db._r.connection_pool.connection_kwargs["port"], 6380)
+        self.assertFalse(tcp_db._r.connection_pool.connection_kwargs["socket_keepalive"])
+        with self.assertRaises(ValueError):
+            RedisDataSource("DB-META-ID")
+
+    def test_get_many(self):
+        ids = ["doi:10.1/a", "doi:10.1/x", "doi:10.1/b", "doi:10.1/c", "doi:10.1/a"]
+        # TESTING THAT: the values are the same as those returned by mget, also when the ids are split in batches
+        self.assertEqual(self.redis_db.get_many(ids), self.redis_db.mget(ids))
+        self.assertEqual(self.redis_db.get_many(ids), {"doi:10.1/a": {"valid": True}, "doi:10.1/x": None, "doi:10.1/b": [1], "doi:10.1/c": None})
+        self.assertEqual(self.redis_db.get_many([]), dict())
+
+    def test_exists_many(self):
+        # TESTING THAT: the keys storing a null value exist as well
+        self.assertTrue(self.redis_db.exists("doi:10.1/c"))
+        self.assertFalse(self.redis_db.exists("doi:10.1/x"))
+        self.assertEqual(self.redis_db.exists_many(["doi:10.1/a", "doi:10.1/x", "doi:10.1/c"]),
+                         {"doi:10.1/a": True, "doi:10.1/x": False, "doi:10.1/c": True})
+
+
+
+class AsyncRedisDataSourceTest(unittest.TestCase):
+    """This class aims at testing the methods of the class AsyncRedisDataSource, on a fake redis server and,
+    if available, on a local redis server."""
+
+    def setUp(self):
+        self.values = {"doi:10.1/a": {"valid": True}, "doi:10.1/b": [1], "doi:10.1/c": None}
+        self.ids = ["doi:10.1/a", "doi:10.1/x", "doi:10.1/b", "doi:10.1/c", "doi:10.1/y"]
+
+    def run_lookups(self, redis_db):
+        async def lookups():
+            try:
+                await redis_db.mset(self.values)
+                await redis_db.set("doi:10.1/d", "value")
+                return (await redis_db.get("doi:10.1/d"), await redis_db.get("doi:10.1/x"),
+                        await redis_db.mget(self.ids), await redis_db.exists("doi:10.1/c"),
+                        await redis_db.exists_many(self.ids))
+            finally:
+                await redis_db._r.delete(*self.values, "doi:10.1/d")
+                await redis_db.close()
+        return asyncio.run(lookups())
+
+    def check_lookups(self, redis_db):
+        value, missing, values, exists, exist = self.run_lookups(redis_db)
+        self.assertEqual(value, "value")
+        self.assertIsNone(missing)
+        self.assertEqual(values, {"doi:10.1/a": {"valid": True}, "doi:10.1/x": None, "doi:10.1/b": [1], "doi:10.1/c": None, "doi:10.1/y": None})
+        self.assertTrue(exists)
+        self.assertEqual(exist, {"doi:10.1/a": True, "doi:10.1/x": False, "doi:10.1/b": True, "doi:10.1/c": True, "doi:10.1/y": False})
+
+    def test_fake_server(self):
+        pool = redis.asyncio.ConnectionPool(connection_class=aioredis.FakeConnection, server=FakeServer(), decode_responses=True)
+        self.check_lookups(AsyncRedisDataSource("DB-META-BR", batch_size=2, connection_pool=pool))
+
+    def test_local_server(self):
+        redis_db = AsyncRedisDataSource("DB-META-BR", batch_size=2, socket_connect_timeout=1)
+
+        async def ping():
+            try:
+                return await redis_db._r.ping()
+            finally:
+                await redis_db.close()
+
+        try:
+            asyncio.run(ping())
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, OSError):
+            self.skipTest("no local redis server")
+        self.check_lookups(AsyncRedisDataSource("DB-META-BR", batch_size=2))
+
+    def test_max_in_flight(self):
+        pool = redis.asyncio.ConnectionPool(connection_class=aioredis.FakeConnection, server=FakeServer(), decode_responses=True)
+        redis_db = AsyncRedisDataSource("DB-META-BR", max_in_flight=3, batch_size=1, connection_pool=pool)
+        in_flight = {"cur": 0, "max": 0}
+        execute_command = redis_db._r.execute_command
+
+        async def slow_execute_command(*args, **kwargs):
+            in_flight["cur"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["cur"])
+            await asyncio.sleep(0.01)
+            try:
+                return await execute_command(*args, **kwargs)
+            finally:
+                in_flight["cur"] -= 1
+
+        redis_db._r.execute_command = slow_execute_command
+
+        async def lookups():
+            await redis_db.mset(self.values)
+            results = await asyncio.gather(redis_db.mget(self.ids), *(redis_db.get(x) for x in self.ids * 4))
+            await redis_db.close()
+            return results
+
+        # TESTING THAT: the requests are sent concurrently, but never more than max_in_flight at the same time
+        results = asyncio.run(lookups())
+        self.assertEqual(results[1:], [self.values.get(x) for x in self.ids * 4])
+        self.assertEqual(in_flight["max"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
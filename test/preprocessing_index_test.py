@@ -0,0 +1,168 @@
+#!python
+# Copyright (c) 2022 The OpenCitations Index Authors.
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose
+# with or without fee is hereby granted, provided that the above copyright notice
+# and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT,
+# OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE,
+# DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
+# SOFTWARE.
+
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+from os.path import join, exists
+import fakeredis
+from preprocessing.index.citing import CitingIdIndex, CitingIdIndexWriter, build_id_run
+from preprocessing.index.hashing import id_hash
+from preprocessing.index.bloom import BloomFilter
+from preprocessing.datasource.bloom import BloomFilterDataSource
+
+
+class CitingIdIndexTest(unittest.TestCase):
+    """This class aims at testing the classes CitingIdIndex and CitingIdIndexWriter."""
+
+    def setUp(self):
+        self._test_dir = join("test", "preprocess")
+        self._index_dir = join(self._test_dir, "tmp_citing_index")
+        if not exists(self._index_dir):
+            os.makedirs(self._index_dir)
+        self._index_path = join(self._index_dir, "citing_ids")
+        self._ids = ["10.1002/ijc.28156", "10.1007/978-3-662-07918-8_3", "10.11178/jdsa.10.91", "10.14778/3402707.3402743"]
+
+    def tearDown(self):
+        if exists(self._index_dir):
+            shutil.rmtree(self._index_dir)
+
+    def test_citing_id_index(self):
+        with CitingIdIndexWriter(self._index_path) as index_writer:
+            index_writer.add_all(self._ids)
+            index_writer.add_all(self._ids[:2])
+        self.assertTrue(CitingIdIndex.exists(self._index_path))
+        self.assertFalse(exists(self._index_path + ".ids.tmp"))
+
+        index = CitingIdIndex(self._index_path)
+        # TESTING THAT: the duplicated identifiers are stored only once
+        self.assertEqual(len(index), 4)
+        for id_string in self._ids:
+            self.assertIn(id_string, index)
+            self.assertTrue(index.get_value(id_string))
+        self.assertNotIn("10.1002/ijc.2815", index)
+        self.assertIsNone(index.get_value("10.1002/ijc.28157"))
+
+    def test_empty_citing_id_index(self):
+        with CitingIdIndexWriter(self._index_path):
+            pass
+        index = CitingIdIndex(self._index_path)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get_value("10.1002/ijc.28156"))
+
+    def test_hash_collisions(self):
+        # all the identifiers have the same hash, so that they can only be found by comparing them
+        with patch("preprocessing.index.citing.id_hash", lambda id_string: 42):
+            with CitingIdIndexWriter(self._index_path) as index_writer:
+                index_writer.add_all(self._ids + self._ids)
+            index = CitingIdIndex(self._index_path)
+            self.assertEqual(len(index), 4)
+            for id_string in self._ids:
+                self.assertTrue(index.get_value(id_string))
+            self.assertIsNone(index.get_value("10.1002/ijc.28157"))
+
+
+    def test_citing_id_index_runs(self):
+        ids = ["10.%d/test.%d" % (i % 7, i) for i in range(3000)]
+        with CitingIdIndexWriter(self._index_path, run_size=100) as index_writer:
+            index_writer.add_all(ids + ids[:500])
+        with open(self._index_path + ".ids", "rb") as f:
+            expected = f.read()
+
+        # TESTING THAT: the runs built elsewhere and merged by the worker processes give the same index
+        with CitingIdIndexWriter(self._index_path, workers=2, bucket_bits=3) as index_writer:
+            for i in range(0, 3000, 700):
+                index_writer.add_run(*build_id_run(ids[i:i + 1000]))
+        self.assertFalse(exists(self._index_path + ".tmp"))
+        with open(self._index_path + ".ids", "rb") as f:
+            self.assertEqual(f.read(), expected)
+        index = CitingIdIndex(self._index_path)
+        self.assertEqual(len(index), 3000)
+        self.assertTrue(all(id_string in index for id_string in ids))
+        self.assertNotIn("10.1/test.3001", index)
+
+    def test_citing_id_index_bloom_filter(self):
+        with CitingIdIndexWriter(self._index_path, bloom_error_rate=0.01) as index_writer:
+            index_writer.add_all(self._ids)
+        self.assertTrue(exists(self._index_path + ".bloom"))
+        index = CitingIdIndex(self._index_path)
+        for id_string in self._ids:
+            self.assertTrue(index.get_value(id_string))
+        self.assertIsNone(index.get_value("10.1002/ijc.28157"))
+
+        # TESTING THAT: the filter is removed when the index is built again without it
+        with CitingIdIndexWriter(self._index_path) as index_writer:
+            index_writer.add_all(self._ids)
+        self.assertFalse(exists(self._index_path + ".bloom"))
+
+
+class BloomFilterTest(unittest.TestCase):
+    """This class aims at testing the classes BloomFilter and BloomFilterDataSource."""
+
+    def setUp(self):
+        self._bloom_path = join("test", "preprocess", "tmp_bloom_filter.bloom")
+        self._ids = ["doi:10.%d/test.%d" % (i % 97, i) for i in range(5000)]
+        self._absent_ids = ["doi:10.%d/absent.%d" % (i % 97, i) for i in range(20000)]
+
+    def tearDown(self):
+        if exists(self._bloom_path):
+            os.remove(self._bloom_path)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(len(self._ids), 0.01)
+        for id_string in self._ids:
+            bloom.add(id_string)
+
+        # TESTING THAT: there are no false negatives, and the false positive rate is close to the required one
+        self.assertTrue(all(id_string in bloom for id_string in self._ids))
+        false_positives = sum(id_string in bloom for id_string in self._absent_ids)
+        self.assertLess(false_positives / len(self._absent_ids), 0.02)
+
+        # TESTING THAT: the filter built in bulk from the hashes and the one loaded from a file are the same
+        hashes = [id_hash(id_string) for id_string in self._ids]
+        self.assertEqual(bytes(BloomFilter.from_hashes(hashes, 0.01)._bits), bytes(bloom._bits))
+        bloom.save(self._bloom_path)
+        loaded = BloomFilter.load(self._bloom_path)
+        self.assertEqual((loaded.num_bits, loaded.num_hashes, loaded.count), (bloom.num_bits, bloom.num_hashes, 5000))
+        self.assertEqual([id_string in loaded for id_string in self._absent_ids], [id_string in bloom for id_string in self._absent_ids])
+
+        # TESTING THAT: the items added to a loaded filter are not written to its file
+        loaded.add("doi:10.1/added")
+        self.assertIn("doi:10.1/added", loaded)
+        self.assertEqual(BloomFilter.load(self._bloom_path).count, 5000)
+
+    def test_bloom_filter_data_source(self):
+        redis_db = fakeredis.FakeStrictRedis()
+        redis_db.set("doi:10.1/in-meta", "{}")
+        bloom = BloomFilter.from_keys(redis_db.scan_iter(), redis_db.dbsize(), 0.01)
+        data_source = BloomFilterDataSource(redis_db, bloom)
+        self.assertTrue(data_source.get("doi:10.1/in-meta"))
+        with patch.object(redis_db, "get", wraps=redis_db.get) as get:
+            self.assertIsNone(data_source.get("doi:10.1/not-in-meta"))
+            # TESTING THAT: the ids which are certainly not in the database are not looked up
+            get.assert_not_called()
+        data_source.set("doi:10.1/added", "{}")
+        self.assertTrue(data_source.get("doi:10.1/added"))
+        with patch.object(redis_db, "exists", wraps=redis_db.exists) as redis_exists:
+            self.assertTrue(data_source.exists("doi:10.1/in-meta"))
+            self.assertFalse(data_source.exists("doi:10.1/not-in-meta"))
+            self.assertEqual(redis_exists.call_count, 1)
+        self.assertEqual(data_source.exists_many(["doi:10.1/in-meta", "doi:10.1/not-in-meta", "doi:10.1/added"]),
+                         {"doi:10.1/in-meta": True, "doi:10.1/not-in-meta": False, "doi:10.1/added": True})
+
+
+if __name__ == '__main__':
+    unittest.main()
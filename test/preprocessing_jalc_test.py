@@ -5,6 +5,11 @@ import os.path
 from preprocessing.jalc import JalcPreProcessing
 from os.path import join, exists
 import pathlib
+from array import array
+from unittest.mock import patch
+from oc_idmanager.doi import DOIManager
+from oc_idmanager.issn import ISSNManager
+from preprocessing.identifier_manager.jid import JIDManager
 
 class JalcPPTest(unittest.TestCase):
     """This class aims at testing the methods of the classes OpenAirePreProcessing."""
@@ -157,6 +162,132 @@ class JalcPPTest(unittest.TestCase):
         outp = self.JAPP2.to_validated_id_list(doi_invalid, "citing_entity")
         self.assertEqual(outp, expected)
 
+    def test_record_source_nested_zip(self):
+        self.JAPP3 = JalcPreProcessing(self._input_dir_dj, self._output_dir_dj, self._interval, self._dirt_to_compress, testing=True)
+        input_dir_content = os.listdir(self._cont_input_dir)
+        dois = []
+        for file_name, f in self.JAPP3.record_source(self._input_dir_dj, self.JAPP3._req_type, nested=True).iter_files():
+            self.assertTrue(file_name.endswith(self.JAPP3._req_type))
+            dois.append(json.load(f).get("data").get("doi"))
+
+        # TESTING THAT: all the json files of the nested zip archives are read
+        self.assertEqual(len(dois), 22)
+        self.assertIn("10.11178/jdsa.10.91", dois)
+
+        # TESTING THAT: no extraction directory is created while reading the archives
+        self.assertEqual(os.listdir(self._cont_input_dir), input_dir_content)
+
+    def test_batch_tasks(self):
+        self.JAPP4 = JalcPreProcessing(self._input_dir_dj, self._output_dir_dj, self._interval, self._dirt_to_compress, testing=True)
+        input_dir_content = os.listdir(self._cont_input_dir)
+        seq_citing_map = self.__read_citing_map(self.JAPP4.citing_id_index)
+        self.JAPP5 = JalcPreProcessing(self._input_dir_dj, self._output_dir_dj, self._interval, join(self._cont_input_dir, "citing_map_par"), testing=True, workers=2, batch_size=5)
+        par_citing_map = self.__read_citing_map(self.JAPP5.citing_id_index)
+
+        # TESTING THAT: the citing map built by the worker processes is the same of the one built sequentially
+        self.assertEqual(len(seq_citing_map), 22)
+        self.assertEqual(par_citing_map, seq_citing_map)
+
+        # TESTING THAT: the json files of the nested zip archives are sent to the workers in batches, read in memory
+        source = self.JAPP5.get_record_source()
+        tasks = list(source.iter_tasks())
+        self.assertEqual([len(content) for name, content in tasks], [5, 5, 5, 5, 2])
+        self.assertEqual([r for name, content in tasks for r in source.read_task(name, content)], list(source))
+        shutil.rmtree(join(self._cont_input_dir, "citing_map_par"))
+        self.assertEqual(os.listdir(self._cont_input_dir), input_dir_content)
+
+    def test_citing_map_reuse(self):
+        input_copy_dir = self.__get_output_directory("data_jalc_input_copy")
+        input_copy = join(input_copy_dir, "jalc_sample.zip")
+        shutil.copy(self._input_dir_dj, input_copy)
+        citing_map_dir = join(input_copy_dir, "citing_map")
+        JAPP7 = JalcPreProcessing(input_copy, self._output_dir_dj, self._interval, citing_map_dir, testing=True)
+        index_path = JAPP7.citing_id_index.path
+        citing_map = self.__read_citing_map(JAPP7.citing_id_index)
+        self.assertTrue(exists(index_path + ".fingerprint"))
+        os.utime(index_path + ".ids", ns=(0, 0))
+
+        # TESTING THAT: the citing map built from the same input is reused, adding the Bloom filter if required
+        JAPP8 = JalcPreProcessing(input_copy, self._output_dir_dj, self._interval, citing_map_dir, testing=True, bloom_error_rate=0.01)
+        self.assertEqual(os.stat(index_path + ".ids").st_mtime_ns, 0)
+        self.assertTrue(exists(index_path + ".bloom"))
+        self.assertEqual(self.__read_citing_map(JAPP8.citing_id_index), citing_map)
+        self.assertTrue(all(JAPP8.citing_id_index.get_value(doi) for doi in citing_map))
+
+        # TESTING THAT: the citing map is built again if the input changes, or if required
+        os.utime(input_copy, ns=(10 ** 18, 10 ** 18))
+        JalcPreProcessing(input_copy, self._output_dir_dj, self._interval, citing_map_dir, testing=True, bloom_error_rate=0.01)
+        self.assertNotEqual(os.stat(index_path + ".ids").st_mtime_ns, 0)
+        os.utime(index_path + ".ids", ns=(0, 0))
+        JalcPreProcessing(input_copy, self._output_dir_dj, self._interval, citing_map_dir, testing=True, bloom_error_rate=0.01, rebuild_citing_map=True)
+        self.assertNotEqual(os.stat(index_path + ".ids").st_mtime_ns, 0)
+        shutil.rmtree(input_copy_dir)
+
+    def __read_citing_map(self, citing_id_index):
+        with open(citing_id_index.path + ".ids", "rb") as f:
+            ids = f.read()
+        with open(citing_id_index.path + ".offsets", "rb") as f:
+            offsets = array("Q", f.read())
+        return sorted(ids[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:]))
+
+    def test_split_input_single_pass(self):
+        two_pass_dir = self.__get_output_directory("data_jalc_output_two_pass")
+        single_pass_dir = self.__get_output_directory("data_jalc_output_single_pass")
+        single_pass_map_dir = join(self._cont_input_dir, "citing_map_single_pass")
+        # the ids are validated offline, accepting half of them
+        is_valid = lambda id_man, norm_id, get_extra_info=False: len(norm_id) % 2 == 0
+        with patch.object(DOIManager, "is_valid", is_valid), patch.object(ISSNManager, "is_valid", is_valid), \
+                patch.object(JIDManager, "is_valid", is_valid):
+            JalcPreProcessing(self._input_dir_dj, two_pass_dir, 4, self._dirt_to_compress, testing=True).split_input()
+            JAPP6 = JalcPreProcessing(self._input_dir_dj, single_pass_dir, 4, single_pass_map_dir, testing=True, workers=2, batch_size=5, single_pass=True)
+            # TESTING THAT: the citing map is not built before processing the input dump
+            self.assertFalse(exists(join(single_pass_map_dir, "citing_ids.ids")))
+            JAPP6.split_input()
+
+        # TESTING THAT: the output files of the single pass mode are the same of the two pass mode
+        self.assertEqual(sorted(os.listdir(single_pass_dir)), sorted(os.listdir(two_pass_dir)))
+        for name in os.listdir(two_pass_dir):
+            with open(join(two_pass_dir, name), "rb") as f_two_pass, open(join(single_pass_dir, name), "rb") as f_single_pass:
+                self.assertEqual(f_single_pass.read(), f_two_pass.read())
+
+        # TESTING THAT: the citing map is built in the single pass, and the spill file is removed
+        self.assertEqual(len(self.__read_citing_map(JAPP6.citing_id_index)), 22)
+        self.assertEqual(sorted(os.listdir(single_pass_map_dir)), ["citing_ids.fingerprint", "citing_ids.hashes", "citing_ids.ids", "citing_ids.offsets"])
+        shutil.rmtree(two_pass_dir)
+        shutil.rmtree(single_pass_dir)
+        shutil.rmtree(single_pass_map_dir)
+
+    def test_split_input_deferred_validation(self):
+        inline_dir = self.__get_output_directory("data_jalc_output_inline")
+        deferred_dir = self.__get_output_directory("data_jalc_output_deferred")
+        deferred_map_dir = join(self._cont_input_dir, "citing_map_deferred")
+        # the ids are validated offline, accepting half of them and recording the ids validated by this process
+        validated = []
+        def is_valid(id_man, norm_id, get_extra_info=False):
+            validated.append(norm_id)
+            return len(norm_id) % 2 == 0
+        with patch.object(DOIManager, "is_valid", is_valid), patch.object(ISSNManager, "is_valid", is_valid), \
+                patch.object(JIDManager, "is_valid", is_valid):
+            JalcPreProcessing(self._input_dir_dj, inline_dir, 4, self._dirt_to_compress, testing=True).split_input()
+            JAPP9 = JalcPreProcessing(self._input_dir_dj, deferred_dir, 4, deferred_map_dir, testing=True, workers=2, batch_size=5, deferred_validation=True)
+            validated.clear()
+            JAPP9.split_input()
+
+        # TESTING THAT: the output files of the deferred validation mode are the same of the inline validation
+        self.assertEqual(sorted(os.listdir(deferred_dir)), sorted(os.listdir(inline_dir)))
+        for name in os.listdir(inline_dir):
+            with open(join(inline_dir, name), "rb") as f_inline, open(join(deferred_dir, name), "rb") as f_deferred:
+                self.assertEqual(f_deferred.read(), f_inline.read())
+
+        # TESTING THAT: the ids are validated in the bulk phase, each one only once, and the spool files are removed
+        self.assertTrue(validated)
+        self.assertEqual(len(validated), len(set(validated)))
+        self.assertEqual(set(validated), set(JAPP9._deferred_results))
+        self.assertEqual(sorted(os.listdir(deferred_map_dir)), ["citing_ids.fingerprint", "citing_ids.hashes", "citing_ids.ids", "citing_ids.offsets"])
+        shutil.rmtree(inline_dir)
+        shutil.rmtree(deferred_dir)
+        shutil.rmtree(deferred_map_dir)
+
     def test_split_input(self):
         if exists(self._output_dir_dj):
             shutil.rmtree(self._output_dir_dj)
@@ -167,37 +298,28 @@ class JalcPPTest(unittest.TestCase):
 
         entities_w_citations = []
         # iterate over the input data
-        all_files, targz_fd  = self.JAPP.get_all_files(self._input_dir_dj, ".zip")
-        for i, el in enumerate(all_files, 1):
-            if el:
-                all_files_unzipped, targz_fd_el = self.JAPP.get_all_files(el, self.JAPP._req_type)
-                for file_idx, file in enumerate(all_files_unzipped, 1):
-                    f = open(file, encoding="utf-8")
-                    my_dict = json.load(f)
-                    d = my_dict.get("data")
-                    # filtering out entities without citations
-                    if "citation_list" in d:
-                        cit_list = d["citation_list"]
-                        cit_list_doi = [x for x in cit_list if x.get("doi")]
-                        # filtering out entities with citations without dois
-                        if cit_list_doi:
-                            # citing_entity
-                            citing_id_to_keep = self.JAPP.to_validated_id_list(d.get("doi"), "citing_entity")
-                            if citing_id_to_keep:
-                                citations = d.get("citation_list")
-                                processed_citations = self.JAPP.to_validated_id_list(citations, "citation")
-                                if processed_citations:
-                                    entities_w_citations.append(citing_id_to_keep)
-                    f.close()
+        for file_name, f in self.JAPP.record_source(self._input_dir_dj, self.JAPP._req_type, nested=True).iter_files():
+            my_dict = json.load(f)
+            d = my_dict.get("data")
+            # filtering out entities without citations
+            if "citation_list" in d:
+                cit_list = d["citation_list"]
+                cit_list_doi = [x for x in cit_list if x.get("doi")]
+                # filtering out entities with citations without dois
+                if cit_list_doi:
+                    # citing_entity
+                    citing_id_to_keep = self.JAPP.to_validated_id_list(d.get("doi"), "citing_entity")
+                    if citing_id_to_keep:
+                        citations = d.get("citation_list")
+                        processed_citations = self.JAPP.to_validated_id_list(citations, "citation")
+                        if processed_citations:
+                            entities_w_citations.append(citing_id_to_keep)
         n_ents_w_cit = len(entities_w_citations)
 
         n_out_ents = 0
-        all_files_out, targz_fd = self.JAPP.get_all_files(self._output_dir_dj, ".ndjson")
-        for file_idx, file in enumerate(all_files_out, 1):
-            fo = open(file, encoding="utf8")
+        for file_name, fo in self.JAPP.record_source(self._output_dir_dj, ".ndjson").iter_files():
             lines_out = [line for line in fo if line]
             n_out_ents += len(lines_out)
-            fo.close()
 
         # TESTING THAT: the number of filtered entities in output is the same as
         # the n of input entities having citations
@@ -215,12 +337,8 @@ class JalcPPTest(unittest.TestCase):
 
         self.assertEqual(exp_n_out_file, len_out_files)
 
-        todel = [join(self._cont_input_dir, x)for x in os.listdir(self._cont_input_dir) if x.endswith("_decompr_zip_dir")]
-        self.assertTrue(len(todel)>0)
-        for t in todel:
-            self.assertTrue(exists(t))
-            shutil.rmtree(t)
-            self.assertFalse(exists(t))
+        # TESTING THAT: the nested zip archives are read without extracting them
+        self.assertEqual([x for x in os.listdir(self._cont_input_dir) if x.endswith("_decompr_zip_dir")], [])
 
 
  #python -m unittest discover -s test -p "preprocessing_jalc_test.py"
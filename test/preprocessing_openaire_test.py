@@ -16,11 +16,14 @@
 import unittest
 from os.path import join, exists
 import os.path
-from preprocessing.openaire import OpenirePreProcessing
+from preprocessing.openaire import OpenirePreProcessing, ScholixSource
 import shutil
 import os
 import gzip
 import json
+import io
+import tarfile
+import tracemalloc
 
 
 class OpenAirePPTest(unittest.TestCase):
@@ -90,21 +93,14 @@ class OpenAirePPTest(unittest.TestCase):
         self.OAPP = OpenirePreProcessing(self.input_dir, self.output_dir, self.num_1, testing=True)
         self.OAPP.split_input()
 
-        #delete all decompressed subdirectories just generated with get_all_files, in order to avoid counting data twice
-        for root, dirs, files in os.walk(self.input_dir):
-            for d in dirs:
-                if not d.endswith(".tar"):
-                    shutil.rmtree(join(root,d))
-
         # checks that the output directory is generated in the process.
         self.assertTrue(exists(self.output_dir))
         x = 0
         len_total_ent = 0
         data = []
-        for tar in os.listdir(self.input_dir):
-            all_files, targz_fd = self.OAPP.get_all_files(os.path.join(self.input_dir,tar), self.req_type)
-            for file_idx, file in enumerate(all_files, 1):
-                f = gzip.open(file, 'rb')
+        for tar in sorted(x for x in os.listdir(self.input_dir) if x.endswith(".tar")):
+            for file_name, tar_member in self.OAPP.record_source(os.path.join(self.input_dir,tar), self.req_type).iter_files():
+                f = gzip.open(tar_member, 'rb')
                 file_content = f.readlines()  # list
                 for entity in file_content:
                     if entity:
@@ -124,7 +120,7 @@ class OpenAirePPTest(unittest.TestCase):
                                     len_total_ent += 1
 
         expected_num_files = len_total_ent // self.num_1 if len_total_ent % self.num_1 == 0 else len_total_ent // self.num_1 + 1
-        files, targz_fd = self.OAPP.get_all_files(self.output_dir, self.req_type)
+        files = [name for name, f in self.OAPP.record_source(self.output_dir, self.req_type).iter_files()]
         len_files = len(files)
 
         self.assertEqual(len_files, expected_num_files)
@@ -141,11 +137,107 @@ class OpenAirePPTest(unittest.TestCase):
 
         self.assertEqual(len_total_ent, len_lines_output)
 
-        #delete all decompressed subdirectories just generated with get_all_files, in order to avoid counting data twice
-        for root, dirs, files in os.walk(self.input_dir):
-            for d in dirs:
-                if not d.endswith(".tar"):
-                    shutil.rmtree(join(root,d))
+    def test_split_input_memory(self):
+        tmp_dir = self.__get_output_directory("data_openaire_memory")
+        tar_path = join(tmp_dir, "part_big.tar")
+        # a scholix file of about 8 MB, obtained by repeating the lines of the test data
+        lines = []
+        # only the tar archives are read, since the directories extracted by other tests may be left in the input
+        for tar in sorted(x for x in os.listdir(self.input_dir) if x.endswith(".tar")):
+            with tarfile.open(join(self.input_dir, tar)) as tf:
+                for member in tf.getmembers():
+                    if member.isfile() and member.name.endswith(self.req_type):
+                        lines.extend(gzip.decompress(tf.extractfile(member).read()).splitlines())
+        scholix = b"\n".join(lines * (8 * 2 ** 20 // len(b"\n".join(lines)) + 1))
+        with tarfile.open(tar_path, "w") as tf:
+            data = gzip.compress(scholix)
+            info = tarfile.TarInfo("scholix/part_big.gz")
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+        self.OAPP6 = OpenirePreProcessing(self.input_dir, self.output_dir, self.num_1, testing=True, read_size=2 ** 16)
+
+        # peak memory when reading all the lines of the scholix file at once, as in the previous implementation
+        tracemalloc.start()
+        n_lines_readlines = 0
+        for file_name, tar_member in self.OAPP6.record_source(tar_path, self.req_type).iter_files():
+            for entity in gzip.open(tar_member, 'rb').readlines():
+                n_lines_readlines += 1
+        peak_readlines = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # peak memory when streaming the lines of the scholix file, as in split_input
+        tracemalloc.start()
+        n_lines_stream = 0
+        for entity in self.OAPP6.record_source(tar_path, self.req_type, "lines"):
+            n_lines_stream += 1
+        peak_stream = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("OpenAIRE scholix file of %d bytes, peak memory: readlines %d bytes, streaming %d bytes (%.1fx lower)" %
+              (len(scholix), peak_readlines, peak_stream, peak_readlines / peak_stream))
+
+        # TESTING THAT: the same lines are read, and the memory used by streaming is bounded by the read buffer
+        # instead of growing with the size of the scholix file
+        self.assertEqual(n_lines_stream, n_lines_readlines)
+        self.assertGreater(peak_readlines, len(scholix))
+        self.assertLess(peak_stream, len(scholix) / 10)
+        shutil.rmtree(tmp_dir)
+
+    def test_scholix_source_tasks(self):
+        self.OAPP7 = OpenirePreProcessing(self.input_dir, self.output_dir, self.num_1, testing=True, workers=2)
+        input_dir_content = os.listdir(self.input_dir)
+        source = self.OAPP7.get_record_source()
+        self.assertTrue(isinstance(source, ScholixSource))
+        lines = list(source)
+        tasks = list(source.iter_tasks())
+
+        # TESTING THAT: each scholix file is a task reading its byte range in the tar archive, and the lines read
+        # from the tasks are the same lines read sequentially
+        self.assertEqual(len(tasks), 8)
+        for name, content in tasks:
+            tar_path, start, end = content
+            self.assertTrue(name.endswith(self.req_type) and tar_path.endswith(".tar"))
+            self.assertEqual(source.task_file(name, content), tar_path)
+        self.assertEqual([line for name, content in tasks for line in source.read_task(name, content)], lines)
+        self.assertEqual(os.listdir(self.input_dir), input_dir_content)
+
+        # TESTING THAT: the tar archives are read in alphabetical order, and the other entries of the input
+        # directory are ignored
+        tar_paths = [tar_path for name, (tar_path, start, end) in tasks]
+        self.assertEqual(tar_paths, sorted(tar_paths))
+        other_dir = join(self.input_dir, "part0_extracted")
+        os.makedirs(other_dir)
+        tar_path, start, end = tasks[0][1]
+        with open(tar_path, "rb") as f_in, open(join(other_dir, "part_extracted.gz"), "wb") as f_out:
+            f_in.seek(start)
+            f_out.write(f_in.read(end - start))
+        try:
+            self.assertEqual(list(source), lines)
+            self.assertEqual(list(source.iter_tasks()), tasks)
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_record_source_tar(self):
+        self.OAPP5 = OpenirePreProcessing(self.input_dir, self.output_dir, self.num_1, testing=True)
+        input_dir_content = os.listdir(self.input_dir)
+        tars = sorted(x for x in input_dir_content if x.endswith(".tar"))
+        streamed = dict()
+        for tar in tars:
+            for file_name, tar_member in self.OAPP5.record_source(join(self.input_dir, tar), self.req_type).iter_files():
+                with gzip.open(tar_member, 'rb') as f:
+                    streamed[os.path.basename(file_name)] = f.read()
+
+        # TESTING THAT: the scholix files are read from the tar archives without extracting them
+        self.assertEqual(os.listdir(self.input_dir), input_dir_content)
+
+        # TESTING THAT: the content of the streamed scholix files is the same of the members of the archives
+        expected = dict()
+        for tar in tars:
+            with tarfile.open(join(self.input_dir, tar)) as tf:
+                for member in tf.getmembers():
+                    if member.isfile() and member.name.endswith(self.req_type):
+                        expected[os.path.basename(member.name)] = gzip.decompress(tf.extractfile(member).read())
+        self.assertEqual(streamed, expected)
 
     def test_splitted_to_file(self):
         if exists(self.output_dir):
@@ -166,8 +258,7 @@ class OpenAirePPTest(unittest.TestCase):
         self.assertEqual(output_file_n, expected_n)
 
         all_dict_in_out = []
-        all_fi, op = self.OAPP4.get_all_files(self.output_dir, ".gz")
-        for file in all_fi:
+        for file, fo in self.OAPP4.record_source(self.output_dir, ".gz").iter_files():
             f = gzip.open(file, 'rb')
             file_content = f.readlines()  # list
 
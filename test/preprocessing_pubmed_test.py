@@ -60,10 +60,9 @@ class PubMedPPTest(unittest.TestCase):
 
         # checks that the input lines where stored in the correct number of files, with respect to the parameters specified.
         # checks that the number of filtered lines is equal to the number of lines in input - the number of discarded lines
-        input_files, targz_fd = self.NIHPPmd.get_all_files(self.input_md_dir, self.req_type)
         len_discarded_lines = 0
         len_total_lines = 0
-        for idx, file in enumerate(input_files):
+        for name, file in self.NIHPPmd.record_source(self.input_md_dir, self.req_type).iter_files():
             df = pd.read_csv(file, usecols=self.NIHPPmd._filter, low_memory=True)
             df.fillna("", inplace=True)
             df_dict_list = df.to_dict("records")
@@ -72,7 +71,7 @@ class PubMedPPTest(unittest.TestCase):
 
         expected_num_files = (len_total_lines - len_discarded_lines) // self.num_2 if (len_total_lines - len_discarded_lines) % self.num_2 == 0 else (
                                                                                                                                                                             len_total_lines - len_discarded_lines) // self.num_2 + 1
-        files, targz_fd = self.NIHPPmd.get_all_files(self.output_md_dir, self.req_type)
+        files = [name for name, f in self.NIHPPmd.record_source(self.output_md_dir, self.req_type).iter_files()]
         len_files = len(files)
         self.assertEqual(len_files, expected_num_files)
 
@@ -96,10 +95,9 @@ class PubMedPPTest(unittest.TestCase):
 
         # checks that the input lines where stored in the correct number of files, with respect to the parameters specified.
         # checks that the number of filtered lines is equal to the number of lines in input - the number of discarded lines
-        input_files, targz_fd = self.NIHPPmd.get_all_files(self.compr_input_md_dir, self.req_type)
         len_discarded_lines = 0
         len_total_lines = 0
-        for idx, file in enumerate(input_files):
+        for name, file in self.NIHPPmd.record_source(self.compr_input_md_dir, self.req_type).iter_files():
             df = pd.read_csv(file, usecols=self.NIHPPmd._filter, low_memory=True)
             df.fillna("", inplace=True)
             df_dict_list = df.to_dict("records")
@@ -108,7 +106,7 @@ class PubMedPPTest(unittest.TestCase):
 
         expected_num_files = (len_total_lines - len_discarded_lines) // self.num_2 if (len_total_lines - len_discarded_lines) % self.num_2 == 0 else (
                                                                                                                                                                             len_total_lines - len_discarded_lines) // self.num_2 + 1
-        files, targz_fd = self.NIHPPmd.get_all_files(self.compr_output_md_dir, self.req_type)
+        files = [name for name, f in self.NIHPPmd.record_source(self.compr_output_md_dir, self.req_type).iter_files()]
         len_files = len(files)
         self.assertEqual(len_files, expected_num_files)
 
@@ -119,10 +117,6 @@ class PubMedPPTest(unittest.TestCase):
                 next(reader, None)
                 len_filtered_lines += len(list(reader))
         self.assertEqual(len_filtered_lines, len_total_lines - len_discarded_lines)
-        # remove the directory where the zst was extracted
-        decompr_dir_filepath = self.compr_input_md_dir.split(".")[0] + "_decompr_zip_dir"
-        if exists(decompr_dir_filepath):
-            shutil.rmtree(decompr_dir_filepath)
 
     def test_to_validated_id_list_API(self):
         self.NIHPP_ids = NIHPreProcessing(self.input_md_dir, self.output_md_dir, self.num_2, self.jt_path_json, testing=True)
@@ -199,8 +193,7 @@ class PubMedPPTest(unittest.TestCase):
         self.assertEqual(output_file_n, expected_n)
 
         all_dict_in_out = []
-        all_fi, op = self.NIHPP_files.get_all_files(self.output_md_dir, ".csv")
-        for fi in all_fi:
+        for fi, f in self.NIHPP_files.record_source(self.output_md_dir, ".csv").iter_files():
             myfi = open(fi, 'r')
             reader = csv.DictReader(myfi)
             for dictionary in reader: